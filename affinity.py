@@ -0,0 +1,184 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Worker selection that keeps builds on workers with warm caches.
+
+The package caches, the Flatpak state directory and the checkouts all
+live on the workers, so a build is much faster on the worker that
+last ran the same builder for the same codebases and package.
+CacheAffinity provides nextWorker and nextBuild functions for
+BuilderConfig that prefer that worker, wait for it for a while when it
+is busy and no other worker is idle, and then fall back to the least
+loaded worker.
+"""
+
+import datetime
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+__all__ = [
+    'CacheAffinity',
+]
+
+# Properties that make requests of the same builder build different
+# things, such as the packages triggered by archlinux-build
+KEY_PROPERTIES = ('package', 'channel')
+
+
+def _request_properties(breq):
+    properties = getattr(breq, 'properties', None)
+    if properties is None:
+        return ()
+    return tuple((name, properties.getProperty(name)) for name in KEY_PROPERTIES
+                 if properties.getProperty(name) is not None)
+
+
+def _request_key(builder, breq):
+    """
+    Returns the cache key of a build request: the builder, which
+    includes the channel, the codebases it builds and the properties
+    that tell what it builds.
+    """
+    return (builder.name, tuple(sorted(breq.sources or {})), _request_properties(breq))
+
+
+def _submitted_at(breq):
+    submitted = breq.submittedAt
+    if isinstance(submitted, datetime.datetime):
+        return (submitted - datetime.datetime(1970, 1, 1, tzinfo=submitted.tzinfo)).total_seconds()
+    return submitted or time.time()
+
+
+def _busy(worker):
+    return len([wfb for wfb in worker.workerforbuilders.values() if wfb.isBusy()])
+
+
+def _free_capacity(worker):
+    """
+    Returns the number of builds the worker can still run,
+    workers without a limit count as one.
+    """
+    if not worker.max_builds:
+        return 1
+    return worker.max_builds - _busy(worker)
+
+
+class CacheAffinity(object):
+    """
+    Cache-aware worker selection policy, shared by the builders.
+
+    A build request goes to the worker that last built its builder and
+    codebases, and its package or channel, if it is available.  When
+    that worker is busy and no other worker is idle, the request waits
+    up to wait seconds, then goes to the worker with the most free
+    capacity.  Statistics are kept in the stats dictionary.
+    """
+
+    def __init__(self, wait=10*60):
+        self.wait = wait
+        # (builder, codebases, properties) -> worker name, (builder, None) for any request
+        self.last_worker = {}
+        self.seeded = set()
+        self.retries = {}
+        self.stats = {'hits': 0, 'misses': 0, 'cold': 0, 'waits': 0}
+
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return float(self.stats['hits']) / total if total else 0.0
+
+    @defer.inlineCallbacks
+    def _seed(self, builder):
+        """
+        Remembers the worker of the last build of the builder,
+        so that the affinity survives a restart of the master.
+        """
+        if builder.name in self.seeded:
+            return
+        self.seeded.add(builder.name)
+        try:
+            builderid = yield builder.getBuilderId()
+            builds = yield builder.master.db.builds.getBuilds(builderid=builderid)
+            if builds:
+                last = max(builds, key=lambda build: build['number'])
+                worker = yield builder.master.db.workers.getWorker(workerid=last['workerid'])
+                if worker:
+                    self.last_worker.setdefault((builder.name, None), worker['name'])
+        except Exception as e:
+            log.err(e, 'while looking up the last worker of %s' % builder.name)
+
+    def _warm_worker(self, builder, breq):
+        key = _request_key(builder, breq)
+        if key in self.last_worker:
+            return self.last_worker[key]
+        # The last worker of the builder only helps requests that build
+        # the same thing whatever their properties
+        if _request_properties(breq):
+            return None
+        return self.last_worker.get((builder.name, None))
+
+    def _record(self, builder, breq, workername):
+        self.last_worker[_request_key(builder, breq)] = workername
+        self.last_worker[(builder.name, None)] = workername
+
+    def _retry_later(self, builder, delay):
+        """
+        Makes sure the builder looks for a worker again when the wait
+        is over, even if no worker becomes available in the meantime.
+        """
+        call = self.retries.get(builder.name)
+        if call is not None and call.active():
+            return
+        self.retries[builder.name] = reactor.callLater(
+            delay, builder.master.botmaster.maybeStartBuildsForBuilder, builder.name)
+
+    @defer.inlineCallbacks
+    def nextWorker(self, builder, workers, breq):
+        yield self._seed(builder)
+        if not workers:
+            defer.returnValue(None)
+            return
+        warm = self._warm_worker(builder, breq)
+        by_name = dict((wfb.worker.workername, wfb) for wfb in workers)
+        if warm in by_name:
+            self.stats['hits'] += 1
+            log.msg('cacheaffinity: %s goes to %s, warm' % (builder.name, warm))
+            self._record(builder, breq, warm)
+            defer.returnValue(by_name[warm])
+            return
+        attached = [wfb.worker.workername for wfb in builder.workers]
+        idle = [wfb for wfb in workers if _busy(wfb.worker) == 0]
+        if warm is not None and warm in attached and not idle:
+            waited = time.time() - _submitted_at(breq)
+            if waited < self.wait:
+                self.stats['waits'] += 1
+                log.msg('cacheaffinity: %s waits for %s, busy for %d more seconds at most' %
+                        (builder.name, warm, self.wait - waited))
+                self._retry_later(builder, self.wait - waited)
+                defer.returnValue(None)
+                return
+        chosen = max(workers, key=lambda wfb: _free_capacity(wfb.worker))
+        name = chosen.worker.workername
+        if warm is None:
+            self.stats['cold'] += 1
+            log.msg('cacheaffinity: %s goes to %s, no warm worker' % (builder.name, name))
+        else:
+            self.stats['misses'] += 1
+            log.msg('cacheaffinity: %s goes to %s, %s is not available (hit rate %.0f%%)' %
+                    (builder.name, name, warm, self.hit_rate() * 100))
+        self._record(builder, breq, name)
+        defer.returnValue(chosen)
+
+    def nextBuild(self, builder, requests):
+        """
+        Starts with the oldest request whose warm worker is
+        available, or the oldest request.
+        """
+        available = set(wfb.worker.workername for wfb in builder.workers if wfb.isAvailable())
+        requests = sorted(requests, key=_submitted_at)
+        for breq in requests:
+            if self._warm_worker(builder, breq) in available:
+                return breq
+        return requests[0] if requests else None
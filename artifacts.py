@@ -0,0 +1,381 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Generations of build artifacts kept on the master.
+
+Artifacts are keyed by builder and channel, each key holds numbered
+generation directories and a "current" symbolic link:
+
+    <basedir>/<builder>/<channel>/00000042/
+    <basedir>/<builder>/<channel>/current -> 00000042
+
+A committed generation is never modified: a writer clones the current
+generation with hard links, changes the clone (replacing files rather
+than rewriting them) and commits it by switching the link.  When the
+generations have a manifest, the generation the commit would evict is
+reused instead of cloning, only the entries that differ from the
+current generation are linked again.  Readers
+hold the counting side of the key lock so that their generation is not
+evicted, writers and eviction hold the exclusive side.
+
+Keys can also be served read-only over HTTP by ArtifactServer, which
+always serves the current generation.
+"""
+
+import os
+import shutil
+import tarfile
+
+from buildbot import config
+from buildbot import locks
+from buildbot.util import service
+from twisted.internet import defer, reactor
+from twisted.web import resource, server, static
+
+from liribotcfg import treesync
+
+__all__ = [
+    'ArtifactStore',
+    'ArtifactServer',
+    'listen',
+]
+
+CURRENT = 'current'
+
+# Manifest of the entries of a generation, written by the tree transfers
+MANIFEST = '.treesync-manifest.json'
+
+
+def _clone_tree(src, dst):
+    """
+    Copies src to dst with hard links, like "cp -al".
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        dstdir = os.path.normpath(os.path.join(dst, reldir))
+        if not os.path.isdir(dstdir):
+            os.makedirs(dstdir)
+        for name in dirnames + filenames:
+            srcpath = os.path.join(dirpath, name)
+            dstpath = os.path.join(dstdir, name)
+            if os.path.islink(srcpath):
+                os.symlink(os.readlink(srcpath), dstpath)
+            elif not os.path.isdir(srcpath):
+                os.link(srcpath, dstpath)
+
+
+def _covered(generation, manifest):
+    """
+    Returns whether the manifest lists every entry of the generation.
+    """
+    top = set(relpath.split('/')[0] for relpath in manifest)
+    return not set(os.listdir(generation)) - top - set([MANIFEST])
+
+
+def _update_tree(path, current):
+    """
+    Turns the generation in path into a copy of current with hard
+    links, like _clone_tree(), changing only the entries whose
+    manifest entries differ.  Returns False when the manifests are
+    missing or do not cover the generations.
+    """
+    old = treesync.load_manifest(os.path.join(path, MANIFEST))
+    new = treesync.load_manifest(os.path.join(current, MANIFEST))
+    if not old or not new or not _covered(path, old) or not _covered(current, new):
+        return False
+    changed, deleted, stats = treesync.diff_manifests(new, old)
+    for relpath in deleted:
+        _remove(os.path.join(path, relpath))
+    for relpath in changed:
+        srcpath = os.path.join(current, relpath)
+        dstpath = os.path.join(path, relpath)
+        if os.path.isdir(srcpath) and not os.path.islink(srcpath):
+            if os.path.islink(dstpath) or (os.path.lexists(dstpath) and not os.path.isdir(dstpath)):
+                os.unlink(dstpath)
+            if not os.path.isdir(dstpath):
+                os.makedirs(dstpath)
+            continue
+        _remove(dstpath)
+        if os.path.islink(srcpath):
+            os.symlink(os.readlink(srcpath), dstpath)
+        else:
+            os.link(srcpath, dstpath)
+    _remove(os.path.join(path, MANIFEST))
+    os.link(os.path.join(current, MANIFEST), os.path.join(path, MANIFEST))
+    return True
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _disk_usage(path, seen):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            inode = (st.st_dev, st.st_ino)
+            if inode not in seen:
+                seen.add(inode)
+                size += st.st_size
+    return size
+
+
+def _links(path):
+    """
+    Returns the files of path by inode, with the number of their hard
+    links in path, their number of hard links and their size.
+    """
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            inode = (st.st_dev, st.st_ino)
+            count = inodes[inode][0] if inode in inodes else 0
+            inodes[inode] = (count + 1, st.st_nlink, st.st_size)
+    return inodes
+
+
+class ArtifactStore(object):
+    """
+    Master-side store of build artifacts.
+
+    At most keep generations are kept for each key.  When max_size is
+    set, writing a key also evicts its older generations until the whole
+    store fits, current generations are never evicted.
+    """
+
+    def __init__(self, basedir='artifacts', keep=3, max_size=None, max_readers=100):
+        self.basedir = basedir
+        self.keep = max(keep, 1)
+        self.max_size = max_size
+        self.max_readers = max_readers
+
+    def _keydir(self, builder, channel):
+        return os.path.join(self.basedir, builder, channel or 'default')
+
+    def _generations(self, builder, channel):
+        keydir = self._keydir(builder, channel)
+        if not os.path.isdir(keydir):
+            return []
+        return sorted(name for name in os.listdir(keydir) if name.isdigit())
+
+    def lock(self, builder, channel):
+        """
+        Returns the reader/writer lock of a key, use access('counting')
+        to read and access('exclusive') to write.
+        """
+        return locks.MasterLock('artifacts-%s-%s' % (builder, channel or 'default'), maxCount=self.max_readers)
+
+    def current_link(self, builder, channel):
+        """
+        Returns the path of the link to the current generation, it
+        keeps following the current generation after a commit.
+        """
+        return os.path.join(self._keydir(builder, channel), CURRENT)
+
+    def current(self, builder, channel):
+        """
+        Returns the path of the current generation, or None.
+        """
+        link = self.current_link(builder, channel)
+        if not os.path.isdir(link):
+            return None
+        return os.path.realpath(link)
+
+    def begin(self, builder, channel):
+        """
+        Returns the path of a new generation, with the content of the
+        current one.  It must run with exclusive access to the key.
+
+        The oldest generation is reused when the commit would evict
+        it, so that it is gone even if the new generation is discarded.
+        """
+        keydir = self._keydir(builder, channel)
+        if not os.path.isdir(keydir):
+            os.makedirs(keydir)
+        generations = self._generations(builder, channel)
+        number = int(generations[-1]) + 1 if generations else 1
+        path = os.path.join(keydir, '%08d' % number)
+        current = self.current(builder, channel)
+        if not current:
+            os.makedirs(path)
+            return path
+        last = os.path.basename(current)
+        old = [name for name in generations if name < last]
+        if old and len(old) >= self.keep - 1:
+            oldest = os.path.join(keydir, old[0])
+            if _update_tree(oldest, current):
+                os.rename(oldest, path)
+                return path
+        _clone_tree(current, path)
+        return path
+
+    def commit(self, builder, channel, path):
+        """
+        Makes path the current generation of the key.
+        """
+        keydir = self._keydir(builder, channel)
+        tmplink = os.path.join(keydir, CURRENT + '.new')
+        if os.path.lexists(tmplink):
+            os.unlink(tmplink)
+        os.symlink(os.path.basename(path), tmplink)
+        os.rename(tmplink, os.path.join(keydir, CURRENT))
+
+    def add_file(self, path, source, name, move=True):
+        """
+        Adds a file to the generation in path, by renaming or
+        linking it when possible.
+        """
+        dest = os.path.join(path, name)
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        try:
+            if move:
+                os.rename(source, dest)
+            else:
+                os.link(source, dest)
+        except OSError:
+            shutil.copy2(source, dest)
+            if move:
+                os.unlink(source)
+
+    def discard(self, path):
+        """
+        Removes a generation that was not committed.
+        """
+        shutil.rmtree(path, ignore_errors=True)
+
+    def import_legacy(self, builder, channel, sources, paths):
+        """
+        Creates the first generation of a key from the first of the
+        tarballs or directories used before the store existed, only the
+        given paths are imported.  Returns the imported source, if any.
+        """
+        sources = [source for source in sources if os.path.exists(source)]
+        if not sources or self.current(builder, channel):
+            return None
+        source = sources[0]
+        path = self.begin(builder, channel)
+        if os.path.basename(source) in paths:
+            # Opaque artifact, such as a tarball kept as is
+            self.add_file(path, source, os.path.basename(source), move=False)
+        elif os.path.isdir(source):
+            for name in paths:
+                if os.path.isdir(os.path.join(source, name)):
+                    _clone_tree(os.path.join(source, name), os.path.join(path, name))
+        else:
+            with tarfile.open(source) as tar:
+                members = [m for m in tar.getmembers() if m.name.split('/')[0] in paths]
+                tar.extractall(path, members)
+        self.commit(builder, channel, path)
+        return source
+
+    def evict(self, builder, channel, progress=None):
+        """
+        Removes the generations of the key beyond the ones to keep, then
+        its oldest generations while the store is larger than max_size,
+        as long as removing them frees space.  It must run with
+        exclusive access to the key.
+        """
+        current = self.current(builder, channel)
+        keydir = self._keydir(builder, channel)
+        # Generations newer than the current one are still being written
+        last = os.path.basename(current) if current else None
+        old = [os.path.join(keydir, name) for name in self._generations(builder, channel)
+               if last is None or name < last]
+        for path in old[:max(len(old) - (self.keep - 1), 0)]:
+            if progress:
+                progress('evicting %s' % path)
+            self.discard(path)
+        if not self.max_size:
+            return
+        # Only this key is locked, the generations of other keys may have readers
+        old = [path for path in old if os.path.isdir(path)]
+        size = self.size()
+        if size <= self.max_size:
+            return
+        # A file is freed once all its hard links are evicted, those
+        # from the current generation or the published repositories
+        # never are: evict the fewest generations that free the most
+        evicted = {}
+        freed = 0
+        best = (0, 0)
+        for i, path in enumerate(old):
+            for inode, (count, nlink, filesize) in _links(path).items():
+                evicted[inode] = evicted.get(inode, 0) + count
+                if evicted[inode] == nlink:
+                    freed += filesize
+            if freed > best[1]:
+                best = (i + 1, freed)
+            if size - freed <= self.max_size:
+                break
+        for path in old[:best[0]]:
+            if progress:
+                progress('evicting %s, the store is over its size limit' % path)
+            self.discard(path)
+        if size - best[1] > self.max_size and progress:
+            progress('the store is still over its size limit, the files of its older generations are in use')
+
+    def size(self):
+        """
+        Returns the disk usage of the store, files hard linked
+        between generations are counted once.
+        """
+        if not os.path.isdir(self.basedir):
+            return 0
+        return _disk_usage(self.basedir, set())
+
+
+def _segment(name):
+    return name.encode('utf-8')
+
+
+def listen(store, exports, port=0, interface=''):
+    """
+    Serves the exported keys of the store over HTTP and returns the
+    listening port.
+
+    Each export is a (builder, channel, path) tuple, path being the
+    directory of the generations to serve at /<builder>/<channel>/.
+    """
+    root = resource.Resource()
+    builders = {}
+    for builder, channel, path in exports:
+        if builder not in builders:
+            builders[builder] = resource.Resource()
+            root.putChild(_segment(builder), builders[builder])
+        directory = os.path.join(store.current_link(builder, channel), path)
+        builders[builder].putChild(_segment(channel or 'default'), static.File(directory))
+    return reactor.listenTCP(port, server.Site(root), interface=interface)
+
+
+class ArtifactServer(service.BuildbotService):
+    """
+    Serves keys of the artifact store over HTTP, such as the OSTree
+    repository the workers pull from.
+    """
+
+    name = 'artifact-server'
+    listening = None
+
+    def checkConfig(self, store, exports, port=8020, interface=''):
+        if not exports:
+            config.error('ArtifactServer needs at least one export')
+
+    @defer.inlineCallbacks
+    def reconfigService(self, store, exports, port=8020, interface=''):
+        if self.listening is not None:
+            yield self.listening.stopListening()
+        self.listening = listen(store, exports, port, interface)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if self.listening is not None:
+            yield self.listening.stopListening()
+            self.listening = None
+        yield service.BuildbotService.stopService(self)
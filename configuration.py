@@ -31,6 +31,10 @@ class Configuration(object):
     def num_master_workers(self):
         return self._get_config('num-master-workers', 4)
 
+    @property
+    def local_workers(self):
+        return self._get_config('local-workers', default={})
+
     @property
     def admin_username(self):
         return self._get_config('admin-username')
@@ -47,6 +51,10 @@ class Configuration(object):
     def github_auth_secret(self):
         return self._get_config('github-auth-secret')
 
+    @property
+    def github_webhook_secret(self):
+        return self._get_config('github-webhook-secret')
+
     @property
     def slack_reporter(self):
         return self._get_config('slack-reporter', default={})
@@ -59,10 +67,74 @@ class Configuration(object):
     def docker_workers(self):
         return self._get_config('docker-workers', default={})
 
+    @property
+    def warm_containers(self):
+        """
+        Returns the number of idle containers to keep
+        started for each class of docker workers.
+        """
+        return self._get_config('warm-containers', default={})
+
+    @property
+    def worker_jobs(self):
+        """
+        Returns the number of parallel build jobs set for each
+        worker in config.json, keyed by worker name.
+        """
+        jobs = {}
+        for name, info in self.workers.items():
+            if 'jobs' in info:
+                jobs[name] = info['jobs']
+        for basename, info in self.docker_workers.items():
+            if 'jobs' in info:
+                for i in range(1, info.get('instances', 1) + 1):
+                    jobs[basename + str(i)] = info['jobs']
+        return jobs
+
     @property
     def docker_hub_triggers(self):
         return self._get_configv('docker-hub-triggers')
 
+    @property
+    def artifacts(self):
+        return self._get_config('artifacts', default={})
+
+    @property
+    def treesync(self):
+        return self._get_config('treesync', default={})
+
+    @property
+    def ostree(self):
+        return self._get_config('ostree', default={})
+
+    @property
+    def provisioning(self):
+        return self._get_config('provisioning', default={})
+
+    @property
+    def git_cache(self):
+        return self._get_config('git-cache', default={})
+
+    @property
+    def package_cache(self):
+        return self._get_config('package-cache', default={})
+
+    @property
+    def worker_affinity(self):
+        return self._get_config('worker-affinity', default={})
+
+    @property
+    def images(self):
+        return self._get_config('images', default={})
+
+    @property
+    def metrics(self):
+        return self._get_config('metrics', default={})
+
+    @property
+    def logs(self):
+        return self._get_config('logs', default={})
+
     @property
     def flatpak(self):
         return self._get_config('flatpak', default={})
@@ -0,0 +1,265 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Docker latent workers that start builds faster.
+
+The image is only pulled when the digest of the local image differs
+from the digest in the registry, which is looked up at most once every
+digest_ttl seconds for all the workers.  Workers of the same class
+share a WarmPool that keeps some containers started and idle, so a
+build can attach to one right away.  A container left idle after a
+build only stops after build_wait_timeout when the pool has enough idle
+ones, and the pool starts another container whenever a build takes one
+of its idle containers.
+"""
+
+import threading
+import time
+
+from buildbot import config
+from buildbot.plugins import worker
+from buildbot.process.properties import Properties
+from buildbot.util import datetime2epoch
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+
+try:
+    import docker
+except ImportError:
+    # Reported by the checkConfig() of DockerLatentWorker
+    docker = None
+
+__all__ = [
+    'WarmDockerLatentWorker',
+    'WarmPool',
+]
+
+# Hooks of the latent workers WarmDockerLatentWorker relies on
+LATENT_HOOKS = ('renderWorkerProps', 'substantiate', 'start_instance', 'stop_instance', 'buildFinished')
+
+# Remote digests by image, with the time they were looked up
+_remote_digests = {}
+_remote_digests_lock = threading.Lock()
+
+
+def _remote_digest(client, image, ttl):
+    """
+    Returns the digest of image in the registry, or None if the
+    Docker API cannot tell it.
+    """
+    with _remote_digests_lock:
+        cached = _remote_digests.get(image)
+    if cached is not None and time.time() - cached[1] < ttl:
+        return cached[0]
+    inspect = getattr(client, 'inspect_distribution', None)
+    if inspect is None:
+        return None
+    digest = inspect(image)['Descriptor']['digest']
+    with _remote_digests_lock:
+        _remote_digests[image] = (digest, time.time())
+    return digest
+
+
+def _local_digests(client, image):
+    try:
+        info = client.inspect_image(image)
+    except Exception:
+        return []
+    return [repodigest.partition('@')[2] for repodigest in info.get('RepoDigests') or []]
+
+
+class WarmPool(object):
+    """
+    Keeps size containers of a class of workers started and idle.
+    """
+
+    # Seconds before trying again when no worker can be started
+    retry = 30
+
+    def __init__(self, name, size=1):
+        self.name = name
+        self.size = size
+        self.workers = []
+        self.timer = None
+
+    def register(self, w):
+        if w not in self.workers:
+            self.workers.append(w)
+
+    def idle(self):
+        return [w for w in self.workers if w.started and w.conn is not None and not w.building]
+
+    def keep(self, w):
+        """
+        Returns whether the idle worker w should keep its container
+        started past build_wait_timeout.
+        """
+        return len([other for other in self.idle() if other is not w]) < self.size
+
+    def maintain(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        idle = self.idle()
+        starting = [w for w in self.workers if w.starting]
+        missing = self.size - len(idle) - len(starting)
+        for w in self.workers:
+            if missing <= 0:
+                break
+            if w.can_prestart():
+                w.prestart()
+                missing -= 1
+        # Containers still detaching cannot be started again yet
+        if missing > 0 and any(w.running and not w.stopping for w in self.workers):
+            self.timer = reactor.callLater(self.retry, self.maintain)
+
+
+class WarmDockerLatentWorker(worker.DockerLatentWorker):
+    """
+    DockerLatentWorker that checks digests instead of pulling on
+    every start, and can be part of a WarmPool.
+
+    Only the public hooks of the latent workers are overridden, the
+    build that starts on a container is seen through the message
+    queue.
+    """
+
+    consumer = None
+
+    def checkConfig(self, name, password, docker_host, digest_ttl=10*60, pool=None, **kwargs):
+        missing = [hook for hook in LATENT_HOOKS if not hasattr(worker.DockerLatentWorker, hook)]
+        if missing:
+            config.error('WarmDockerLatentWorker needs the %s hooks of DockerLatentWorker' %
+                         ', '.join(missing))
+        worker.DockerLatentWorker.checkConfig(self, name, password, docker_host, **kwargs)
+
+    @defer.inlineCallbacks
+    def reconfigService(self, name, password, docker_host, digest_ttl=10*60, pool=None, **kwargs):
+        # The digest check replaces the pull on every start
+        kwargs['alwaysPull'] = False
+        yield worker.DockerLatentWorker.reconfigService(self, name, password, docker_host, **kwargs)
+        self.digest_ttl = digest_ttl
+        self.idle_timeout = kwargs.get('build_wait_timeout', 10*60)
+        self.refresh = kwargs.get('autopull', False)
+        self.docker_args = {'base_url': docker_host}
+        for arg in ('version', 'tls'):
+            if kwargs.get(arg) is not None:
+                self.docker_args[arg] = kwargs[arg]
+        self.pool = pool
+        if pool is not None:
+            pool.register(self)
+        if not hasattr(self, 'stats'):
+            self.stats = {'pulls': 0, 'pull_skips': 0, 'prestarts': 0, 'warm_starts': 0,
+                          'cold_starts': 0, 'first_step_seconds': None}
+        # Build requests a container was started for
+        self.cold_requests = set()
+        self.starting = False
+        self.started = False
+        self.stopping = False
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield worker.DockerLatentWorker.startService(self)
+        self.consumer = yield self.master.mq.startConsuming(self._build_new, ('builds', None, 'new'))
+        if self.pool is not None:
+            reactor.callLater(0, self.pool.maintain)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self.stopping = True
+        # Kept containers are stopped with the others
+        self.build_wait_timeout = self.idle_timeout
+        if self.consumer is not None:
+            self.consumer.stopConsuming()
+            self.consumer = None
+        yield worker.DockerLatentWorker.stopService(self)
+
+    def can_prestart(self):
+        return (self.running and not self.stopping and not self.starting and not self.started and
+                self.conn is None)
+
+    def prestart(self):
+        log.msg('Pre-starting container for worker %s' % self.name)
+        d = self.substantiate(None, None)
+        d.addErrback(log.err, 'while pre-starting %s' % self.name)
+
+    @defer.inlineCallbacks
+    def _build_new(self, key, build):
+        if build['workerid'] != self.workerid:
+            return
+        request = yield self.master.data.get(('buildrequests', build['buildrequestid']))
+        if build['buildrequestid'] in self.cold_requests:
+            self.cold_requests.discard(build['buildrequestid'])
+            self.stats['cold_starts'] += 1
+        else:
+            self.stats['warm_starts'] += 1
+        if request is not None and request['submitted_at'] is not None:
+            self.stats['first_step_seconds'] = time.time() - datetime2epoch(request['submitted_at'])
+            log.msg('Worker %s started a build %.1f seconds after the request '
+                    '(%d warm, %d cold starts, %d pulls skipped)' %
+                    (self.name, self.stats['first_step_seconds'], self.stats['warm_starts'],
+                     self.stats['cold_starts'], self.stats['pull_skips']))
+        if self.pool is not None:
+            self.pool.maintain()
+
+    def buildFinished(self, wfb):
+        # A negative build_wait_timeout keeps the container started
+        if self.pool is not None and not self.stopping:
+            self.build_wait_timeout = -1 if self.pool.keep(self) else self.idle_timeout
+        return worker.DockerLatentWorker.buildFinished(self, wfb)
+
+    def _docker_client(self):
+        if hasattr(docker, 'APIClient'):
+            return docker.APIClient(**self.docker_args)
+        return docker.Client(**self.docker_args)
+
+    def _refresh_image(self, image):
+        """
+        Pulls image if the registry has a newer one.
+        """
+        client = self._docker_client()
+        local = _local_digests(client, image)
+        if not local:
+            # Pulled by the base class when autopull is set
+            return
+        try:
+            remote = _remote_digest(client, image, self.digest_ttl)
+        except Exception as e:
+            log.msg('Cannot look up the digest of %s, pulling it: %s' % (image, e))
+            remote = None
+        if remote is not None and remote in local:
+            self.stats['pull_skips'] += 1
+            return
+        log.msg('Image %s is not the one in the registry, pulling it' % image)
+        client.pull(image)
+        self.stats['pulls'] += 1
+
+    @defer.inlineCallbacks
+    def start_instance(self, build):
+        # Pre-started containers have no build to render for
+        if build is None:
+            self.stats['prestarts'] += 1
+            build = Properties()
+        requests = set(request.id for request in getattr(build, 'requests', []))
+        self.cold_requests.update(requests)
+        self.starting = True
+        try:
+            image = (yield self.renderWorkerProps(build))[0]
+            if image is not None and self.refresh:
+                yield threads.deferToThread(self._refresh_image, image)
+            result = yield worker.DockerLatentWorker.start_instance(self, build)
+            self.started = True
+        except Exception:
+            self.cold_requests -= requests
+            raise
+        finally:
+            self.starting = False
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def stop_instance(self, fast=False):
+        try:
+            yield worker.DockerLatentWorker.stop_instance(self, fast)
+        finally:
+            self.started = False
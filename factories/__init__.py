@@ -1,8 +1,12 @@
 # -*- python -*-
 # ex: set filetype=python:
 
-from ._archlinux import ArchPackagesBuildFactory, ArchISOBuildFactory
-from ._ostree import OSTreeFactory
+from ._archlinux import ArchPackagesBuildFactory, ArchPackageBuildFactory, ArchISOBuildFactory
+from ._ostree import OSTreeFactory, OSTreeMatrix, OSTreeMatrixFactory, OSTreeSummaryFactory
 from ._docker import DockerHubBuildFactory
 from ._flatpak import FlatpakFactory
 from ._image import ImageBuildFactory
+from ._gitcache import GitCache
+from ._pkgcache import PackageCache
+from ._provision import Provisioning
+from ._sync import TreeSyncTransfer
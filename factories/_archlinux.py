@@ -2,60 +2,277 @@
 # ex: set filetype=python:
 
 from buildbot.plugins import *
+from buildbot.process import buildstep
 from buildbot.steps.worker import CompositeStepMixin
 from buildbot import locks
 from twisted.internet import defer
 
 import buildbot
-import os.path
+import os
 import json
+import re
 
 from liribotcfg import utils
+from ._docker import DockerHubTriggerStep
+from ._gitcache import GitCache, GitCacheStep
+from ._image import ImagePublishStep
+from ._sync import MasterThreadStep
 
 __all__ = [
     'ArchPackagesBuildFactory',
+    'ArchPackageBuildFactory',
     'ArchISOBuildFactory',
 ]
 
+GRAPH_SCRIPT = '.archgraph.py'
+REPO_SCRIPT = '.archrepo.sh'
 
-class ArchLinuxBuildStep(steps.BuildStep, CompositeStepMixin):
+DATABASE = '/repo/liri-unstable.db.tar.gz'
+
+# Packages are built here, then added to the database all at once
+STAGING = '/repo/.staging'
+
+# Hashes of the package directories last built successfully, on the master
+STATE = 'archlinux-packages.json'
+
+state_lock = locks.MasterLock('archlinux-packages-state')
+repo_lock = locks.MasterLock('archlinux-repo')
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return utils.json_to_ascii(json.load(f))
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _reverse_dependencies(graph):
+    """
+    Returns the packages depending on each package of the graph.
+    """
+    providers = {}
+    for name, info in graph.items():
+        for provided in info['names']:
+            providers[provided] = name
+    reverse = dict((name, set()) for name in graph)
+    for name, info in graph.items():
+        for dependency in info['depends']:
+            provider = providers.get(dependency)
+            if provider is not None and provider != name:
+                reverse[provider].add(name)
+    return reverse
+
+
+def _dirty_packages(graph, changed):
+    """
+    Returns the changed packages and all the packages
+    that depend on them, directly or not.
+    """
+    reverse = _reverse_dependencies(graph)
+    dirty = set()
+    pending = list(changed)
+    while pending:
+        name = pending.pop()
+        if name not in dirty:
+            dirty.add(name)
+            pending.extend(reverse[name])
+    return dirty
+
+
+def _build_levels(order, graph, dirty):
+    """
+    Sorts the dirty packages by dependency level, the packages of a
+    level only depend on the packages of the previous levels.
+
+    Packages in a dependency cycle are built one at a time
+    at the end, in the order of the channel.
+    """
+    reverse = _reverse_dependencies(graph)
+    remaining = dict((name, 0) for name in order if name in dirty)
+    for name in remaining:
+        for dependent in reverse[name]:
+            if dependent in remaining:
+                remaining[dependent] += 1
+    levels = []
+    while remaining:
+        level = [name for name in order if remaining.get(name) == 0]
+        if not level:
+            levels.extend([name] for name in order if name in remaining)
+            break
+        for name in level:
+            del remaining[name]
+            for dependent in reverse[name]:
+                if dependent in remaining:
+                    remaining[dependent] -= 1
+        levels.append(level)
+    return levels
+
+
+class ArchLinuxBuildStep(buildstep.ShellMixin, steps.BuildStep, CompositeStepMixin):
     """
     Build step to build the ArchLinux packages.
+
+    Only the packages that changed since their last successful build
+    are built, along with the packages depending on them.  Packages
+    are built by dependency level, the packages of a level are built
+    at the same time by the triggered builder and then added to the
+    database together.
     """
 
-    def __init__(self, triggers=None, **kwargs):
+    def __init__(self, scheduler='archlinux-package', state=STATE, database=DATABASE, **kwargs):
+        self.scheduler = scheduler
+        self.state = state
+        self.database = database
+        self.setupShellMixin({'logEnviron': False})
         steps.BuildStep.__init__(self, haltOnFailure=True, **kwargs)
 
     @defer.inlineCallbacks
     def run(self):
-        builddir = self.build.properties.getProperty('builddir')
         content = yield self.getFileContentFromWorker('channels.json')
         if content is None:
             channels = {'stable': [], 'unstable': []}
         else:
             channels = utils.json_to_ascii(json.loads(content))
         packages_list = channels['unstable']
-        packages_list.reverse()
-        for name in packages_list:
-            self.build.addStepsAfterCurrentStep([
-                steps.ShellCommand(
-                    name='build ' + name,
-                    haltOnFailure=True,
-                    command=['../docker-build'],
-                    workdir=os.path.join(self.workdir, name),
-                )
+        if not packages_list:
+            defer.returnValue(buildbot.process.results.SUCCESS)
+            return
+        cmd = yield self.makeRemoteShellCommand(command=['python3', GRAPH_SCRIPT] + packages_list,
+                                                collectStdout=True, stdioLogName='graph')
+        yield self.runCommand(cmd)
+        if cmd.didFail():
+            defer.returnValue(buildbot.process.results.FAILURE)
+            return
+        graph = utils.json_to_ascii(json.loads(cmd.stdout))
+        built = _load_state(self.state)
+        if self.getProperty('rebuild_all', False):
+            changed = packages_list
+        else:
+            changed = [name for name in packages_list if built.get(name) != graph[name]['hash']]
+        levels = _build_levels(packages_list, graph, _dirty_packages(graph, changed))
+        plan = []
+        for number, level in enumerate(levels, 1):
+            plan.append('level %d: %s\n' % (number, ' '.join(level)))
+        skipped = [name for name in packages_list if not any(name in level for level in levels)]
+        plan.append('up to date: %s\n' % (' '.join(skipped) or 'none'))
+        yield self.addCompleteLog('plan', u''.join(plan))
+        hashes = dict((name, graph[name]['hash']) for name in packages_list)
+        staging = os.path.join(STAGING, '%s-%s' % (self.getProperty('buildername'), self.getProperty('buildnumber')))
+        steps_list = []
+        for level in levels:
+            steps_list.extend([
+                ArchPackagesTriggerStep(
+                    name='build ' + ' '.join(level),
+                    schedulerNames=[self.scheduler],
+                    packages=level,
+                    hashes=hashes,
+                    pkgdest=staging,
+                ),
+                ArchRepoUpdateStep(
+                    name='update database',
+                    database=self.database,
+                    staging=staging,
+                    state=self.state,
+                ),
             ])
+        self.build.addStepsAfterCurrentStep(steps_list)
+        self.descriptionDone = ['%d packages to build in %d levels' % (sum(len(level) for level in levels), len(levels))]
         defer.returnValue(buildbot.process.results.SUCCESS)
 
 
+class ArchPackagesTriggerStep(steps.Trigger):
+    """
+    Triggers one build of each package and waits for them.
+    """
+
+    def __init__(self, packages=None, hashes=None, pkgdest=None, **kwargs):
+        self.packages = packages
+        self.hashes = hashes
+        self.pkgdest = pkgdest
+        steps.Trigger.__init__(self, waitForFinish=True, haltOnFailure=True, **kwargs)
+
+    def getSchedulersAndProperties(self):
+        return [{
+            'sched_name': sched,
+            'props_to_set': {'package': name, 'package_hash': self.hashes[name], 'pkgdest': self.pkgdest},
+            'unimportant': False}
+            for sched in self.schedulerNames for name in self.packages]
+
+
+class ArchRepoUpdateStep(buildstep.ShellMixin, steps.BuildStep):
+    """
+    Adds the packages of the staging directory to the database with
+    a single repo-add call, then records the hashes of the packages.
+
+    It also runs when a package failed, so that the other packages
+    of the level are not built again.
+    """
+
+    built_re = re.compile(r'^built (\S+) (\S+)$')
+
+    def __init__(self, database=DATABASE, staging=None, state=STATE, **kwargs):
+        self.database = database
+        self.staging = staging
+        self.state = state
+        self.setupShellMixin({'logEnviron': False})
+        steps.BuildStep.__init__(self, haltOnFailure=True, alwaysRun=True,
+                                 locks=[repo_lock.access('exclusive')], **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand(command=['bash', REPO_SCRIPT, self.database, self.staging],
+                                                collectStdout=True)
+        yield self.runCommand(cmd)
+        if cmd.didFail():
+            defer.returnValue(cmd.results())
+            return
+        hashes = {}
+        for line in cmd.stdout.splitlines():
+            match = self.built_re.match(line)
+            if match:
+                hashes[match.group(1)] = match.group(2)
+        if hashes:
+            self.build.addStepsAfterCurrentStep([
+                ArchPackageRecordStep(name='record package hashes', state=self.state, hashes=hashes),
+            ])
+        self.descriptionDone = ['%d packages added' % len(hashes)]
+        defer.returnValue(cmd.results())
+
+
+class ArchPackageRecordStep(MasterThreadStep):
+    """
+    Records the hashes of the packages that were built successfully.
+    """
+
+    def __init__(self, state=STATE, hashes=None, **kwargs):
+        self.state = state
+        self.hashes = hashes
+        MasterThreadStep.__init__(self, alwaysRun=True, locks=[state_lock.access('exclusive')], **kwargs)
+
+    def sync(self):
+        built = _load_state(self.state)
+        built.update(self.hashes)
+        tmppath = self.state + '.new'
+        with open(tmppath, 'w') as f:
+            json.dump(built, f, indent=2, sort_keys=True)
+        os.rename(tmppath, self.state)
+        for name in sorted(self.hashes):
+            self.progress('%s built from %s' % (name, self.hashes[name]))
+        return buildbot.process.results.SUCCESS
+
+
 class ArchPackagesBuildFactory(util.BuildFactory):
     """
     Build factory for ArchLinux packages.
     """
 
-    def __init__(self, triggers, *args, **kwargs):
+    def __init__(self, triggers, scheduler='archlinux-package', state=STATE, database=DATABASE, git_cache=None,
+                 *args, **kwargs):
         util.BuildFactory.__init__(self, *args, **kwargs)
+        git_cache = git_cache or GitCache()
         steps_list = [
+            GitCacheStep(name='git cache', cache=git_cache),
             steps.Git(
                 name='checkout sources',
                 codebase=util.Property('codebase'),
@@ -64,32 +281,90 @@ class ArchPackagesBuildFactory(util.BuildFactory):
                 mode='incremental',
                 submodules=True,
                 shallow=True,
+                reference=util.Property('git_reference'),
+                config=git_cache.config,
             ),
-            steps.ShellCommand(name='create database', command=['repo-add', '/repo/liri-unstable.db.tar.gz']),
-            ArchLinuxBuildStep(name='select packages')
+            steps.FileDownload(
+                name='download archgraph',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('scripts', 'archgraph.py'),
+                workerdest=GRAPH_SCRIPT,
+            ),
+            steps.FileDownload(
+                name='download archrepo',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('scripts', 'archrepo.sh'),
+                workerdest=REPO_SCRIPT,
+            ),
+            ArchLinuxBuildStep(name='select packages', scheduler=scheduler, state=state, database=database)
         ]
+        hooks = []
         for info in triggers:
             if 'packages' in info.get('tags', []):
                 url = 'https://registry.hub.docker.com/u/%(name)s/trigger/%(token)s/' % info
-                steps_list.append(
-                    steps.POST(
-                        name='trigger rebuild %(name)s' % info,
-                        url=url,
-                        headers={'Content-type': 'application/json'},
-                        data={'build': True}
-                    )
-                )
+                hooks.append((info['name'], url))
+        if hooks:
+            steps_list.append(DockerHubTriggerStep(name='trigger rebuilds', hooks=hooks))
         self.addSteps(steps_list)
 
 
+class ArchPackageBuildFactory(util.BuildFactory):
+    """
+    Build factory for a single ArchLinux package, triggered
+    by ArchPackagesBuildFactory with the "package" property.
+
+    The package is built into the "pkgdest" staging directory,
+    ArchPackagesBuildFactory adds it to the database.
+    """
+
+    def __init__(self, git_cache=None, *args, **kwargs):
+        util.BuildFactory.__init__(self, *args, **kwargs)
+        git_cache = git_cache or GitCache()
+        self.addSteps([
+            GitCacheStep(name='git cache', cache=git_cache),
+            steps.Git(
+                name='checkout sources',
+                codebase=util.Property('codebase'),
+                repourl=util.Property('repository'),
+                branch=util.Property('branch'),
+                mode='incremental',
+                submodules=True,
+                shallow=True,
+                reference=util.Property('git_reference'),
+                config=git_cache.config,
+            ),
+            steps.ShellCommand(
+                name='create staging directory',
+                haltOnFailure=True,
+                command=['mkdir', '-p', util.Property('pkgdest')],
+            ),
+            steps.ShellCommand(
+                name=util.Interpolate('build %(prop:package)s'),
+                haltOnFailure=True,
+                command=['../docker-build'],
+                env={'PKGDEST': util.Property('pkgdest')},
+                workdir=util.Interpolate(os.path.join(self.workdir, '%(prop:package)s')),
+            ),
+            steps.ShellCommand(
+                name='mark as built',
+                haltOnFailure=True,
+                command=['sh', '-c', 'echo "$1" > "$2"', 'sh', util.Property('package_hash'),
+                         util.Interpolate('%(prop:pkgdest)s/.built-%(prop:package)s')],
+            ),
+        ])
+
+
 class ArchISOBuildFactory(util.BuildFactory):
     """
     Build factory for ArchLinux ISO images.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, git_cache=None, options=None, *args, **kwargs):
         util.BuildFactory.__init__(self, *args, **kwargs)
+        git_cache = git_cache or GitCache()
+        livecd = os.path.join(self.workdir, 'livecd')
         self.addSteps([
+            GitCacheStep(name='git cache', cache=git_cache),
             steps.Git(
                 name='checkout sources',
                 codebase=util.Property('codebase'),
@@ -98,20 +373,32 @@ class ArchISOBuildFactory(util.BuildFactory):
                 mode='incremental',
                 submodules=True,
                 shallow=True,
+                reference=util.Property('git_reference'),
+                config=git_cache.config,
+            ),
+            steps.ShellCommand(
+                name='clean up output',
+                haltOnFailure=True,
+                command=['sudo', 'rm', '-rf', 'out'],
+                workdir=livecd,
             ),
             steps.ShellCommand(
                 name='build image',
                 haltOnFailure=True,
-                command=['sudo', './build.sh', '-v', '-o', '/repo/images/nightly/'],
-                workdir=os.path.join(self.workdir, 'livecd'),
+                command=['sudo', './build.sh', '-v', '-o', 'out'],
+                workdir=livecd,
+            ),
+            # The image belongs to root, it is copied rather than moved
+            ImagePublishStep(
+                name='publish image',
+                files=['out'],
+                options=options,
+                workdir=livecd,
             ),
             steps.ShellCommand(
                 name='clean up',
-                command=['sudo', 'rm', '-rf', 'work'],
-                workdir=os.path.join(self.workdir, 'livecd'),
+                alwaysRun=True,
+                command=['sudo', 'rm', '-rf', 'work', 'out'],
+                workdir=livecd,
             ),
-            steps.ShellCommand(
-                name='remove old images',
-                command=['bash', '-c', 'find /repo/images/nightly -type f -mtime +7 -exec rm {} \;'],
-            )
         ])
@@ -2,12 +2,47 @@
 # ex: set filetype=python:
 
 from buildbot.plugins import util, steps
+from twisted.internet import defer
+
+import buildbot
+
+from liribotcfg import webhooks
 
 __all__ = [
     'DockerHubBuildFactory',
+    'DockerHubTriggerStep',
 ]
 
 
+class DockerHubTriggerStep(steps.BuildStep):
+    """
+    Calls the Docker Hub build triggers in hooks, a list of
+    (name, url) pairs, concurrently.  A URL listed more than
+    once is only called once.
+    """
+
+    def __init__(self, hooks, concurrency=4, retries=3, backoff=1.0, **kwargs):
+        self.hooks = hooks
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        results = yield webhooks.post_all(
+            self.hooks, concurrency=self.concurrency, retries=self.retries, backoff=self.backoff,
+            headers={'Content-type': 'application/json'}, data={'build': True})
+        yield self.addCompleteLog('triggers', u''.join(u'%s\n' % result.describe() for result in results))
+        failed = [result for result in results if not result.ok]
+        if failed:
+            self.descriptionDone = ['%d of %d triggers failed' % (len(failed), len(results))]
+            defer.returnValue(buildbot.process.results.FAILURE)
+            return
+        self.descriptionDone = ['triggered %d rebuilds' % len(results)]
+        defer.returnValue(buildbot.process.results.SUCCESS)
+
+
 class DockerHubBuildFactory(util.BuildFactory):
     """
     Build factory that triggers a rebuild of the Docker
@@ -15,7 +50,7 @@ class DockerHubBuildFactory(util.BuildFactory):
     """
     def __init__(self, triggers, tags, *args, **kwargs):
         util.BuildFactory.__init__(self, *args, **kwargs)
-        steps_list = []
+        hooks = []
         for info in triggers:
             build = False
             available_tags = info.get('tags', [])
@@ -24,6 +59,6 @@ class DockerHubBuildFactory(util.BuildFactory):
                     build = True
             if build is True:
                 url = 'https://cloud.docker.com/api/build/v1/source/%(uuid)s/trigger/%(token)s/call/' % info
-                steps_list.append(steps.POST(name='trigger rebuild %(name)s' % info, url=url, headers={'Content-type': 'application/json'}, data={'build': True}))
-        if len(steps_list) > 0:
-            self.addSteps(steps_list)
+                hooks.append((info['name'], url))
+        if len(hooks) > 0:
+            self.addStep(DockerHubTriggerStep(name='trigger rebuilds', hooks=hooks))
@@ -2,14 +2,59 @@
 # ex: set filetype=python:
 
 from buildbot.plugins import util, steps
+from buildbot.process import buildstep, logobserver
+from buildbot import locks
+from twisted.internet import defer
 
 import buildbot
 import os
+import re
+import time
+
+from liribotcfg import publish
+from ._gitcache import GitCache, GitCacheStep
+from ._logs import LogBudgetMixin, ProgressObserver, FLATPAK_PROGRESS
+from ._provision import Provisioning, ProvisionStep
+from ._resources import WorkerResourcesStep
+from ._sync import MasterThreadStep, TreeSyncPullStep, TreeSyncPushStep
 
 __all__ = [
     'FlatpakFactory',
 ]
 
+# The exported repository holds the refs of every channel, so it is
+# kept under a single artifact store key shared by all the builders
+REPO_KEY = ('flatpak', 'repo')
+REPO_LEGACY = ['flatpak/store', 'flatpak/repo.tar']
+STATE_LEGACY = ['flatpak/store', 'flatpak/state-dir.tar']
+
+# Builds of several channels share one state directory, which starts
+# from the state of the first channel built on its own builder
+STATE_KEY = ('flatpak', 'state')
+CHANNEL_BUILDER = 'flatpak-%s-build'
+
+BUILD_LOG = 'flatpak-build-%s.log'
+PARALLEL_BUILD = """
+for channel in "$@"; do
+    ./flatpak-build --repo=repo --channel=channel-$channel.yaml --jobs=$FLATPAK_JOBS --export \\
+        --gpg-homedir=flatpak-gpg --gpg-sign="$FLATPAK_GPG_KEY" > flatpak-build-$channel.log 2>&1 &
+    echo $! > flatpak-build-$channel.pid
+done
+status=0
+for channel in "$@"; do
+    if wait $(cat flatpak-build-$channel.pid); then
+        echo "channel $channel built"
+    else
+        echo "channel $channel failed"
+        status=1
+    fi
+    rm -f flatpak-build-$channel.pid
+done
+exit $status
+"""
+
+publish_lock = locks.MasterLock('flatpak-publish')
+
 
 class FlatpakGPGStep(steps.BuildStep):
     """
@@ -38,90 +83,116 @@ class FlatpakGPGStep(steps.BuildStep):
         return buildbot.process.results.SUCCESS
 
 
+class FlatpakPublishStep(MasterThreadStep):
+    """
+    This step publishes the repository from the artifact store,
+    without downtime for the clients.
+
+    Before going live the repository gets its appstream data, the
+    static deltas of the refs this build changed, pruning to the
+    depth of each channel in prune_depth and a new summary.  The step
+    fails without flatpak and ostree on the master, and warns when the
+    summary cannot be signed, see publish.update_flatpak_repo().
+    """
+
+    def __init__(self, store=None, live=None, prune_depth=None, gpg_key=None, gpg_homedir=None, **kwargs):
+        self.store = store
+        self.live = live
+        self.prune_depth = prune_depth
+        self.gpg_key = gpg_key
+        self.gpg_homedir = gpg_homedir
+        MasterThreadStep.__init__(self, locks=[
+            store.lock(*REPO_KEY).access('counting'),
+            publish_lock.access('exclusive'),
+        ], **kwargs)
+
+    def update(self, staged, current):
+        if current is not None:
+            previous_refs = publish.read_refs(current)
+            self.progress('%d static deltas kept' % publish.carry_deltas(current, staged))
+        else:
+            previous_refs = {}
+        changed, self.summary_updated = publish.update_flatpak_repo(
+            staged, previous_refs, prune_depth=self.prune_depth,
+            gpg_key=self.gpg_key, gpg_homedir=self.gpg_homedir, progress=self.progress)
+        self.progress('%d refs changed' % len(changed))
+
+    def sync(self):
+        generation = self.store.current(*REPO_KEY)
+        self.progress('publishing %s' % generation)
+        self.summary_updated = False
+        publish.publish_repo(os.path.join(generation, 'repo'), self.live, prepare=self.update, progress=self.progress)
+        if not self.summary_updated:
+            return buildbot.process.results.WARNINGS
+        return buildbot.process.results.SUCCESS
+
+
 class FlatpakSyncStep(steps.BuildStep):
     """
-    This step archives the state directory and repository,
-    then publish the repository.
+    This step sends the changes to the state directory and repository
+    back to the master, then publish the repository.
+
+    The repository is pruned to the depth of the published one before
+    its store generation is committed, publish.publish_repo() stages
+    from it and would link the pruned commits again.
     """
 
+    def __init__(self, store=None, state_key=None, live=None, transfer=None, publish_options=None, **kwargs):
+        self.store = store
+        self.state_key = state_key
+        self.live = live
+        self.transfer = transfer
+        self.publish_options = publish_options or {}
+        steps.BuildStep.__init__(self, **kwargs)
+
     def run(self):
         self.build.addStepsAfterCurrentStep([
-            steps.ShellSequence(
-                name='archive',
-                haltOnFailure=True,
-                logEnviron=False,
-                commands=[
-                    util.ShellArg(command=['tar', 'cf', 'state-dir.tar', '.flatpak-builder'], logfile='stdio'),
-                    util.ShellArg(command=['tar', 'cf', 'repo.tar', 'repo'], logfile='stdio'),
-                ],
-            ),
-            steps.FileUpload(
-                name='upload state-dir.tar',
-                haltOnFailure=True,
-                workersrc='state-dir.tar',
-                masterdest='flatpak/state-dir.tar',
-            ),
-            steps.FileUpload(
-                name='upload repo.tar',
-                haltOnFailure=True,
-                workersrc='repo.tar',
-                masterdest='flatpak/repo.tar',
-            ),
-            steps.MasterShellCommand(
-                name='sync repo',
-                haltOnFailure=True,
-                logEnviron=False,
-                command=['./scripts/flatpak-repo.sh'],
-            ),
+            TreeSyncPushStep(name='push state', store=self.store, builder=self.state_key[0], channel=self.state_key[1],
+                             paths=['.flatpak-builder'], transfer=self.transfer),
+            TreeSyncPushStep(name='push repo', store=self.store, builder=REPO_KEY[0], channel=REPO_KEY[1], paths=['repo'],
+                             transfer=self.transfer, prepare=self.prune),
+            FlatpakPublishStep(name='publish repo', store=self.store, live=self.live, **self.publish_options),
         ])
         return buildbot.process.results.SUCCESS
 
+    def prune(self, generation, progress):
+        prune_depth = self.publish_options.get('prune_depth')
+        if prune_depth:
+            publish.prune_repo(os.path.join(generation, 'repo'), prune_depth, progress=progress)
+
 
 class FlatpakPullStep(steps.BuildStep):
     """
-    This step unpacks state directory and repository
-    from master.
-    """
-
-    def run(self):
-        def does_state_tar_exist(step):
-            return os.path.exists('flatpak/state-dir.tar')
+    This step brings state directory and repository
+    up to date with the master.
 
-        def does_repo_tar_exist(step):
-            return os.path.exists('flatpak/repo.tar')
+    Only new OSTree objects and changed files are transferred, archives
+    from older versions of this configuration are imported on first use.
+    state_key is the artifact store key of the state directory, its
+    builder defaults to the name of the builder.
+    """
 
-        def does_exist(step):
-            return does_state_tar_exist(step) and does_repo_tar_exist(step)
+    def __init__(self, store=None, state_key=None, state_legacy=None, transfer=None, **kwargs):
+        self.store = store
+        self.state_key = state_key
+        self.state_legacy = state_legacy or STATE_LEGACY
+        self.transfer = transfer
+        steps.BuildStep.__init__(self, **kwargs)
 
+    def run(self):
         self.build.addStepsAfterCurrentStep([
-            steps.FileDownload(
-                name='download state-dir.tar',
-                haltOnFailure=True,
-                doStepIf=does_state_tar_exist,
-                mastersrc='flatpak/state-dir.tar',
-                workerdest='state-dir.tar',
-            ),
-            steps.FileDownload(
-                name='download repo.tar',
-                haltOnFailure=True,
-                doStepIf=does_repo_tar_exist,
-                mastersrc='flatpak/repo.tar',
-                workerdest='repo.tar',
-            ),
-            steps.ShellSequence(
-                name='unpack archives and clean up',
-                haltOnFailure=True,
-                doStepIf=does_exist,
-                logEnviron=False,
-                commands=[
-                    util.ShellArg(command=['tar', 'xf', 'state-dir.tar', 'repo.tar'], logfile='stdio'),
-                    util.ShellArg(command=['rm', '-f', 'state-dir.tar', 'repo.tar'], logfile='stdio'),
-                ],
-            ),
+            TreeSyncPullStep(name='pull state', store=self.store, builder=self.state_key[0], channel=self.state_key[1],
+                             paths=['.flatpak-builder'], legacy=self.state_legacy, transfer=self.transfer),
+            TreeSyncPullStep(name='pull repo', store=self.store, builder=REPO_KEY[0], channel=REPO_KEY[1],
+                             paths=['repo'], legacy=REPO_LEGACY, transfer=self.transfer),
         ])
         return buildbot.process.results.SUCCESS
 
 
+def _channel_built(channel):
+    return lambda step: channel in step.getProperty('flatpak_built_channels', [])
+
+
 class FlatpakRefStep(steps.BuildStep):
     """
     This step copies .flatpakref files to the master.
@@ -155,22 +226,226 @@ class FlatpakRefStep(steps.BuildStep):
         return buildbot.process.results.SUCCESS
 
 
+class FlatpakModuleTimingObserver(logobserver.LogLineObserver):
+    """
+    Measures how long flatpak-builder spends on each module.
+    """
+
+    module_re = re.compile(r'^Building module (\S+) in ')
+    cache_re = re.compile(r'^Cache hit for (\S+), skipping build')
+
+    def __init__(self):
+        logobserver.LogLineObserver.__init__(self)
+        self.modules = []
+
+    def _finish_current(self, now):
+        if self.modules and self.modules[-1][2] is None:
+            self.modules[-1][2] = now
+
+    def outLineReceived(self, line):
+        now = time.time()
+        match = self.module_re.match(line)
+        if match:
+            self._finish_current(now)
+            self.modules.append([match.group(1), now, None])
+            return
+        match = self.cache_re.match(line)
+        if match:
+            self._finish_current(now)
+            self.modules.append([match.group(1), now, now])
+
+    def summary(self):
+        self._finish_current(time.time())
+        lines = []
+        for name, start, end in sorted(self.modules, key=lambda m: m[1] - m[2]):
+            lines.append(u'%8.1fs  %s\n' % (end - start, name))
+        return u''.join(lines)
+
+
+class FlatpakChannelObserver(logobserver.LogLineObserver):
+    """
+    Finds out which channels a parallel build completed.
+    """
+
+    channel_re = re.compile(r'^channel (\S+) built$')
+
+    def __init__(self):
+        logobserver.LogLineObserver.__init__(self)
+        self.built = []
+
+    def outLineReceived(self, line):
+        match = self.channel_re.match(line)
+        if match:
+            self.built.append(match.group(1))
+
+
+class FlatpakBuildStep(LogBudgetMixin, buildstep.ShellMixin, steps.BuildStep):
+    """
+    Builds the channels, reporting the time spent on each module.
+
+    When the channels are built in parallel, the output of each one
+    goes to the log named after it.  The channels that were built
+    are added to the "flatpak_built_channels" property, the progress
+    of each channel goes to the "flatpak_progress_<channel>" property
+    and the logs are kept within log_budget, see LogBudgetMixin.
+    """
+
+    flunkOnFailure = True
+
+    def __init__(self, channels=None, log_budget=None, **kwargs):
+        self.channels = channels or []
+        self.log_budget = log_budget
+        if len(self.channels) > 1:
+            kwargs['logfiles'] = dict((channel, BUILD_LOG % channel) for channel in self.channels)
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+        self.timings = {}
+        self.outcome = FlatpakChannelObserver()
+        if len(self.channels) > 1:
+            for channel in self.channels:
+                self.timings[channel] = FlatpakModuleTimingObserver()
+                self.addLogObserver(channel, self.timings[channel])
+                self.addLogObserver(channel, ProgressObserver('flatpak_progress_%s' % channel, FLATPAK_PROGRESS))
+            self.addLogObserver('stdio', self.outcome)
+        else:
+            self.timings[None] = FlatpakModuleTimingObserver()
+            self.addLogObserver('stdio', self.timings[None])
+            for channel in self.channels:
+                self.addLogObserver('stdio', ProgressObserver('flatpak_progress_%s' % channel, FLATPAK_PROGRESS))
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand()
+        yield self.runCommand(cmd)
+        result = cmd.results()
+        if len(self.channels) > 1:
+            built = self.outcome.built
+        elif result in (buildbot.process.results.SUCCESS, buildbot.process.results.WARNINGS):
+            built = self.channels
+        else:
+            built = []
+        built = sorted(set(self.getProperty('flatpak_built_channels', []) + built))
+        self.setProperty('flatpak_built_channels', built, self.name, runtime=True)
+        for channel, timings in sorted(self.timings.items()):
+            summary = timings.summary()
+            if summary:
+                yield self.addCompleteLog('module timings' if channel is None else 'module timings (%s)' % channel,
+                                          summary)
+        defer.returnValue(result)
+
+
+class FlatpakChannelsBuildStep(steps.BuildStep):
+    """
+    Builds several channels against the same state directory, so the
+    modules they have in common are only built once.
+
+    The channels are built at the same time when the worker has at
+    least min_jobs jobs for each of them, one after the other otherwise.
+    A channel that fails does not prevent the others from being
+    built and published.  The "flatpak_channels" property, a comma
+    separated list, restricts the build to some of the channels.
+    """
+
+    def __init__(self, channels=None, gpg_key=None, min_jobs=4, log_budget=None, **kwargs):
+        self.channels = channels
+        self.gpg_key = gpg_key
+        self.min_jobs = min_jobs
+        self.log_budget = log_budget
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        requested = self.getProperty('flatpak_channels')
+        channels = self.channels
+        if requested:
+            requested = [channel.strip() for channel in requested.split(',')]
+            channels = [channel for channel in channels if channel in requested]
+        if not channels:
+            self.descriptionDone = ['no channel to build']
+            return buildbot.process.results.FAILURE
+        jobs = int(self.getProperty('jobs', 1))
+        list_steps = []
+        if len(channels) > 1 and jobs // len(channels) >= self.min_jobs:
+            list_steps += [
+                steps.ShellCommand(
+                    name='clean up build logs',
+                    logEnviron=False,
+                    command=['rm', '-f'] + [BUILD_LOG % channel for channel in channels],
+                ),
+                FlatpakBuildStep(
+                    name='build %s' % ', '.join(channels),
+                    channels=channels,
+                    log_budget=self.log_budget,
+                    logEnviron=False,
+                    env={'FLATPAK_JOBS': str(jobs // len(channels)), 'FLATPAK_GPG_KEY': self.gpg_key},
+                    command=['sh', '-c', PARALLEL_BUILD, 'sh'] + channels,
+                ),
+            ]
+            self.descriptionDone = ['%d channels in parallel' % len(channels)]
+        else:
+            for channel in channels:
+                list_steps.append(FlatpakBuildStep(
+                    name='build %s' % channel,
+                    channels=[channel],
+                    log_budget=self.log_budget,
+                    command=['./flatpak-build', '--repo=repo', '--channel=channel-%s.yaml' % channel, '--jobs=%d' % jobs, '--export', '--gpg-homedir=flatpak-gpg', '--gpg-sign=' + self.gpg_key],
+                ))
+            self.descriptionDone = ['%d channels in sequence' % len(channels)]
+        for channel in channels:
+            list_steps.append(FlatpakRefStep(name='copy %s flatpakref files' % channel, channel=channel,
+                                             doStepIf=_channel_built(channel)))
+        self.build.addStepsAfterCurrentStep(list_steps)
+        return buildbot.process.results.SUCCESS
+
+
 class FlatpakFactory(util.BuildFactory):
     """
     Build factory for Flatpak.
+
+    channel is either a channel or a list of channels, which are
+    built by the same build after a single checkout and setup, see
+    FlatpakChannelsBuildStep.
     """
 
-    def __init__(self, channel, options, *args, **kwargs):
-        channel_filename = 'channel-%s.yaml' % channel
+    tools = ['flatpak', 'flatpak-builder', 'python3-PyYAML']
+
+    def __init__(self, channel, options, store, worker_jobs=None, provisioning=None, git_cache=None, transfer=None,
+                 logs=None, *args, **kwargs):
         util.BuildFactory.__init__(self, *args, **kwargs)
+        git_cache = git_cache or GitCache()
+        provisioning = provisioning or Provisioning()
+        provisioning.require(self.tools)
+        if isinstance(channel, list):
+            state_key = STATE_KEY
+            state_legacy = [store.current_link(CHANNEL_BUILDER % name, name) for name in channel] + STATE_LEGACY
+            build_steps = [
+                FlatpakChannelsBuildStep(
+                    name='build channels',
+                    channels=channel,
+                    gpg_key=options['gpg-key'],
+                    min_jobs=options.get('min-jobs-per-channel', 4),
+                    log_budget=logs,
+                ),
+            ]
+            sync_if = lambda step: bool(step.getProperty('flatpak_built_channels'))
+        else:
+            channel_filename = 'channel-%s.yaml' % channel
+            state_key = (None, channel)
+            state_legacy = STATE_LEGACY
+            build_steps = [
+                FlatpakBuildStep(
+                    name='build',
+                    haltOnFailure=True,
+                    channels=[channel],
+                    log_budget=logs,
+                    command=['./flatpak-build', '--repo=repo', '--channel=' + channel_filename, util.Interpolate('--jobs=%(prop:jobs)s'), '--export', '--gpg-homedir=flatpak-gpg', '--gpg-sign=' + options['gpg-key']],
+                ),
+                FlatpakRefStep(name='copy flatpakref files', channel=channel),
+            ]
+            sync_if = True
         self.addSteps([
-            steps.ShellCommand(
-                name='install tools',
-                haltOnFailure=True,
-                logEnviron=False,
-                command=['sudo', 'dnf', 'install', '-y', 'flatpak', 'flatpak-builder', 'python3-PyYAML'],
-            ),
+            ProvisionStep(name='provision worker', provisioning=provisioning, sudo=True),
             FlatpakGPGStep(name='setup gpg keys'),
+            GitCacheStep(name='git cache', cache=git_cache),
             steps.Git(
                 name='checkout sources',
                 codebase=util.Property('codebase'),
@@ -179,13 +454,21 @@ class FlatpakFactory(util.BuildFactory):
                 mode='incremental',
                 submodules=True,
                 shallow=True,
+                reference=util.Property('git_reference'),
+                config=git_cache.config,
             ),
-            FlatpakPullStep(name='pull from master'),
-            steps.ShellCommand(
-                name='build',
-                haltOnFailure=True,
-                command=['./flatpak-build', '--repo=repo', '--channel=' + channel_filename, '--jobs=1', '--export', '--gpg-homedir=flatpak-gpg', '--gpg-sign=' + options['gpg-key']],
+            FlatpakPullStep(name='pull from master', store=store, state_key=state_key, state_legacy=state_legacy,
+                            transfer=transfer),
+            WorkerResourcesStep(
+                name='detect parallelism',
+                overrides=worker_jobs,
+                memory_per_job=options.get('memory-per-job', 2048),
             ),
-            FlatpakRefStep(name='copy flatpakref files', channel=channel),
-            FlatpakSyncStep(name='sync repo'),
+        ] + build_steps + [
+            FlatpakSyncStep(name='sync repo', store=store, state_key=state_key, live=options.get('publish-dir', '/repo/flatpak/repo'),
+                            transfer=transfer, doStepIf=sync_if, publish_options={
+                                'prune_depth': options.get('prune-depth'),
+                                'gpg_key': options.get('gpg-key') or None,
+                                'gpg_homedir': options.get('gpg-homedir'),
+                            }),
         ])
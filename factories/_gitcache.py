@@ -0,0 +1,104 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+from buildbot.process import buildstep
+from buildbot.plugins import steps
+from twisted.internet import defer
+
+import buildbot
+import json
+
+from liribotcfg import utils
+
+__all__ = [
+    'GitCache',
+    'GitCacheStep',
+]
+
+SCRIPT = '.gitcache.py'
+
+# The builder directory, the checkout directory must stay empty until the clone
+WORKDIR = '.'
+
+
+class GitCache(object):
+    """
+    Mirrors of the repositories checked out by the builds, kept on a
+    volume shared by the workers of a host.
+
+    Checkouts use the mirror of their repository as a reference, and
+    the mirrors of the submodules through the superproject.  A mirror
+    is fetched at most once every max_age seconds, which should match
+    the poll interval of the repository.
+
+    Git steps use it with reference=util.Property('git_reference')
+    and config=GitCache.config, after a GitCacheStep.
+    """
+
+    # Submodules find their mirror in modules/<name> of the reference,
+    # and are cloned normally when it does not exist
+    config = {
+        'submodule.alternateLocation': 'superproject',
+        'submodule.alternateErrorStrategy': 'info',
+    }
+
+    def __init__(self, root='/build/git-cache', max_age=5*60):
+        self.root = root
+        self.max_age = max_age
+
+
+class _GitCacheUpdateStep(buildstep.ShellMixin, steps.BuildStep):
+    def __init__(self, cache=None, **kwargs):
+        self.cache = cache
+        self.setupShellMixin({'logEnviron': False,
+                              'timeout': 3600})
+        # Checkouts still work without the cache, only slower
+        steps.BuildStep.__init__(self, flunkOnFailure=False, warnOnFailure=True, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = ['python3', SCRIPT, 'update', '--root', self.cache.root, '--max-age', str(self.cache.max_age)]
+        branch = self.getProperty('branch')
+        if branch:
+            cmd += ['--branch', branch]
+        cmd.append(self.getProperty('repository'))
+        updateCmd = yield self.makeRemoteShellCommand(command=cmd, collectStdout=True)
+        yield self.runCommand(updateCmd)
+        if updateCmd.didFail():
+            defer.returnValue(updateCmd.results())
+            return
+        for line in updateCmd.stdout.splitlines():
+            if line.startswith('gitcache: '):
+                stats = json.loads(line[len('gitcache: '):])
+                self.setProperty('git_reference', stats['reference'], self.name, runtime=True)
+                self.setProperty('git_fetched_bytes', stats['fetched_bytes'], self.name, runtime=True)
+                self.setProperty('git_fetch_seconds', stats['seconds'], self.name, runtime=True)
+                if stats['updated']:
+                    self.descriptionDone = ['fetched %d KiB in %.1f s' % (stats['fetched_bytes'] // 1024, stats['seconds'])]
+                else:
+                    self.descriptionDone = ['up to date']
+        defer.returnValue(updateCmd.results())
+
+
+class GitCacheStep(steps.BuildStep):
+    """
+    Creates or refreshes the mirror of the repository of the build,
+    and sets the git_reference property to its path.
+    """
+
+    def __init__(self, cache=None, **kwargs):
+        self.cache = cache
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        self.build.addStepsAfterCurrentStep([
+            steps.FileDownload(
+                name='download gitcache',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('scripts', 'gitcache.py'),
+                workerdest=SCRIPT,
+                workdir=WORKDIR,
+            ),
+            _GitCacheUpdateStep(name='update git cache', cache=self.cache, workdir=WORKDIR),
+        ])
+        return buildbot.process.results.SUCCESS
@@ -2,6 +2,7 @@
 # ex: set filetype=python:
 
 from buildbot.plugins import util, steps
+from buildbot.process import buildstep
 from buildbot.steps import master, worker
 from buildbot.process.properties import Interpolate
 
@@ -10,13 +11,18 @@ from twisted.internet import defer
 import buildbot
 import datetime
 
+from liribotcfg import utils
+from ._gitcache import GitCache, GitCacheStep
+from ._logs import LogBudgetMixin, ProgressObserver, LIVECD_PROGRESS
+from ._pkgcache import PackageCache, PackageCacheStartStep, PackageCacheFinishStep
+from ._provision import Provisioning, ProvisionStep
+
 __all__ = [
     'ImageBuildFactory',
+    'ImagePublishStep',
 ]
 
-
-def IsCacheDisabled(step):
-    return not step.build.getProperty('cache', True)
+SCRIPT = '.imagepub.py'
 
 
 class ImagePropertiesStep(steps.BuildStep):
@@ -38,29 +44,101 @@ class ImagePropertiesStep(steps.BuildStep):
         return buildbot.process.results.SUCCESS
 
 
+class ImageBuildStep(LogBudgetMixin, buildstep.ShellMixin, steps.BuildStep):
+    """
+    Runs livecd-creator, with its progress in the image_progress
+    property and its logs kept within log_budget.
+    """
+
+    flunkOnFailure = True
+
+    def __init__(self, log_budget=None, **kwargs):
+        self.log_budget = log_budget
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+        self.addLogObserver('stdio', ProgressObserver('image_progress', LIVECD_PROGRESS))
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand()
+        yield self.runCommand(cmd)
+        defer.returnValue(cmd.results())
+
+
+class ImagePublishStep(steps.BuildStep):
+    """
+    Publishes images to the nightly directory, computing their digests
+    and compressed variants in the same pass, and removes the images
+    older than the number of days to keep according to the index of
+    the directory.
+
+    options has the "nightly-dir", "keep-days", "digests" and
+    "compress" entries of the "images" section of config.json.
+    """
+
+    def __init__(self, files=None, checksum=None, move=False, options=None, **kwargs):
+        self.files = files
+        self.checksum = checksum
+        self.move = move
+        self.options = options or {}
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def command(self):
+        cmd = ['python3', SCRIPT, 'publish', '--dest', self.options.get('nightly-dir', '/repo/images/nightly'),
+               '--keep-days', str(self.options.get('keep-days', 7))]
+        for digest in self.options.get('digests', ['sha256']):
+            cmd += ['--digest', digest]
+        for fmt in self.options.get('compress', []):
+            cmd += ['--compress', fmt]
+        if self.checksum:
+            cmd += ['--checksum-file', self.checksum]
+        if self.move:
+            cmd.append('--move')
+        return cmd + self.files
+
+    def run(self):
+        self.build.addStepsAfterCurrentStep([
+            steps.FileDownload(
+                name='download imagepub',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('scripts', 'imagepub.py'),
+                workerdest=SCRIPT,
+                workdir=self.workdir,
+            ),
+            steps.ShellCommand(
+                name='publish images',
+                haltOnFailure=True,
+                logEnviron=False,
+                timeout=60*60,
+                command=self.command(),
+                workdir=self.workdir,
+            ),
+        ])
+        return buildbot.process.results.SUCCESS
+
+
 class ImageBuildFactory(util.BuildFactory):
     """
     Build factory for ISO images.
     """
 
-    def __init__(self, *args, **kwargs):
+    tools = ['git', 'spin-kickstarts', 'pykickstart', 'livecd-tools']
+
+    def __init__(self, cache=None, provisioning=None, git_cache=None, options=None, logs=None, *args, **kwargs):
         util.BuildFactory.__init__(self, *args, **kwargs)
 
+        cache = cache or PackageCache()
+        git_cache = git_cache or GitCache()
+        provisioning = provisioning or Provisioning()
+        provisioning.require(self.tools)
+
         title = 'Liri OS'
         releasever = '30'
 
         self.addSteps([
             ImagePropertiesStep(name='set properties'),
-            steps.ShellCommand(
-                name='update container',
-                haltOnFailure=True,
-                command=['dnf', 'update', '-y'],
-            ),
-            steps.ShellCommand(
-                name='install tools',
-                haltOnFailure=True,
-                command=['dnf', 'install', '-y', 'git', 'spin-kickstarts', 'pykickstart', 'livecd-tools'],
-            ),
+            ProvisionStep(name='provision worker', provisioning=provisioning),
+            GitCacheStep(name='git cache', cache=git_cache),
             steps.Git(
                 name='checkout sources',
                 codebase=util.Property('codebase'),
@@ -69,39 +147,33 @@ class ImageBuildFactory(util.BuildFactory):
                 mode='incremental',
                 submodules=True,
                 shallow=True,
+                reference=util.Property('git_reference'),
+                config=git_cache.config,
             ),
             steps.ShellCommand(
                 name='ksflatten',
                 haltOnFailure=True,
                 command=['ksflatten', Interpolate('--config=%(prop:product)s-livecd.ks'), '-o', 'livecd.ks'],
             ),
-            steps.RemoveDirectory(
-                name='clean cache',
-                dir='/build/cache',
-                doStepIf=IsCacheDisabled,
-            ),
-            steps.ShellCommand(
+            PackageCacheStartStep(name='prepare package cache', cache=cache),
+            ImageBuildStep(
                 name='build image',
                 haltOnFailure=True,
                 timeout=60*60,
+                log_budget=logs,
                 command=[
                     'livecd-creator', '--releasever=' + releasever,
                     '--config=livecd.ks', Interpolate('--fslabel=%(prop:imgname)s'),
                     '--title', title, Interpolate('--product=%(prop:product)s'),
-                    '--cache=/build/cache'
+                    '--cache=' + cache.path('livecd')
                 ],
             ),
-            steps.ShellCommand(
-                name='checksum',
-                haltOnFailure=True,
-                command=['bash', '-c', Interpolate('sha256sum -b --tag %(prop:isofilename)s > /repo/images/nightly/%(prop:checksumfilename)s')],
+            PackageCacheFinishStep(name='package cache statistics', cache=cache),
+            ImagePublishStep(
+                name='publish image',
+                files=[Interpolate('%(prop:isofilename)s')],
+                checksum=Interpolate('%(prop:checksumfilename)s'),
+                move=True,
+                options=options,
             ),
-            steps.ShellCommand(
-                name='move file',
-                command=['mv', Interpolate('%(prop:isofilename)s'), '/repo/images/nightly/'],
-            ),
-            steps.ShellCommand(
-                name='remove old images',
-                command=['bash', '-c', 'find /repo/images/nightly -type f -mtime +7 -exec rm {} \;'],
-            )
         ])
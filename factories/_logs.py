@@ -0,0 +1,320 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+from buildbot.process import logobserver
+from buildbot.util import lineboundaries
+from buildbot.util import subscription
+from twisted.internet import defer
+from twisted.python import log as twlog
+
+import collections
+import gzip
+import itertools
+import os
+import re
+import time
+
+from liribotcfg import treesync
+
+__all__ = [
+    'LogBudgetMixin',
+    'ProgressObserver',
+    'FLATPAK_PROGRESS',
+    'LIVECD_PROGRESS',
+    'RPM_OSTREE_PROGRESS',
+]
+
+# Lines kept along with the lines around them when the budget is exhausted
+ERROR_RE = re.compile(r'(?i)\b(error|errors|failed|failure|fatal|traceback|exception|cannot|no such file)\b')
+
+
+def _safe_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+class _BudgetedLog(object):
+    """
+    Stream log that stores the head of the log it wraps, the lines
+    around errors and its tail within their byte budgets.  Every line
+    goes to the archive and to the subscribers of this log.
+    """
+
+    def __init__(self, log, options, archive=None):
+        self.log = log
+        self.type = log.type
+        self.head = options.get('head', 256 * 1024)
+        self.tail = options.get('tail', 512 * 1024)
+        self.context = options.get('context', 512 * 1024)
+        self.context_lines = options.get('context-lines', 20)
+        self.archive = archive
+        self.finished = False
+        self.subscriptions = subscription.SubscriptionPoint('%r budgeted log' % log.getName())
+        self.finders = {}
+        self.stored = 0
+        self.total = 0
+        self.head_done = False
+        self.skipped = 0
+        # Lines since the last stored line, with their stream: those
+        # still in the tail buffer, and how many were dropped from it
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self.after = 0
+
+    def getName(self):
+        return self.log.getName()
+
+    def subscribe(self, callback):
+        return self.subscriptions.subscribe(callback)
+
+    def isFinished(self):
+        return self.finished
+
+    def waitUntilFinished(self):
+        return self.log.waitUntilFinished()
+
+    def _finder(self, stream):
+        if stream not in self.finders:
+            self.finders[stream] = lineboundaries.LineBoundaryFinder(lambda lines: self._lines(stream, lines))
+        return self.finders[stream]
+
+    def addStdout(self, text):
+        return self._finder('o').append(text)
+
+    def addStderr(self, text):
+        return self._finder('e').append(text)
+
+    def addHeader(self, text):
+        return self._finder('h').append(text)
+
+    def _marker(self, lines, size):
+        return 'h', u'[... %d lines (%s) not stored, see the full log ...]\n' % (lines, treesync.format_size(size))
+
+    def _take_pending(self, count):
+        """
+        Returns the last count pending lines, with a marker for the
+        lines before them that are not stored.
+        """
+        kept = []
+        while self.pending and len(kept) < count:
+            kept.insert(0, self.pending.pop())
+        skipped = self.dropped_lines + len(self.pending)
+        skipped_bytes = self.dropped_bytes + sum(len(line) for stream, line in self.pending)
+        self.pending.clear()
+        self.pending_bytes = 0
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        if skipped:
+            self.skipped += skipped
+            kept.insert(0, self._marker(skipped, skipped_bytes))
+        return kept
+
+    def _filter(self, stream, lines):
+        out = []
+        for line in lines.splitlines(True):
+            size = len(line)
+            self.total += size
+            if self.archive is not None:
+                self.archive.write(line.encode('utf-8'))
+            if not self.head_done:
+                if self.stored + size <= self.head:
+                    out.append((stream, line))
+                    self.stored += size
+                    continue
+                self.head_done = True
+            if self.context > 0 and ERROR_RE.search(line):
+                kept = self._take_pending(self.context_lines) + [(stream, line)]
+                out.extend(kept)
+                self.context -= sum(len(l) for s, l in kept)
+                self.after = self.context_lines
+                continue
+            if self.after > 0 and self.context > 0:
+                out.append((stream, line))
+                self.context -= size
+                self.after -= 1
+                continue
+            self.pending.append((stream, line))
+            self.pending_bytes += size
+            while self.pending_bytes > self.tail and self.pending:
+                dropped = self.pending.popleft()[1]
+                self.pending_bytes -= len(dropped)
+                self.dropped_lines += 1
+                self.dropped_bytes += len(dropped)
+        return out
+
+    def _store(self, lines):
+        add = {'o': self.log.addStdout, 'e': self.log.addStderr, 'h': self.log.addHeader}
+        return defer.gatherResults([add[stream](u''.join(line for s, line in group))
+                                    for stream, group in itertools.groupby(lines, lambda entry: entry[0])])
+
+    def _lines(self, stream, lines):
+        if isinstance(lines, bytes):
+            lines = lines.decode('utf-8', 'replace')
+        self.subscriptions.deliver(stream, lines)
+        return self._store(self._filter(stream, lines))
+
+    @defer.inlineCallbacks
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        # Let the partial lines through the budget before the tail is stored
+        for finder in self.finders.values():
+            yield finder.flush()
+        rest = self._take_pending(len(self.pending))
+        if self.skipped:
+            rest.append(('h', u'[log of %s, kept the head, the tail and the lines around errors]\n' %
+                         treesync.format_size(self.total)))
+        yield self._store(rest)
+        if self.archive is not None:
+            try:
+                self.archive.close()
+            except (IOError, OSError) as e:
+                twlog.err(e, 'while closing the full log of %s' % self.getName())
+            self.archive = None
+        yield self.log.finish()
+        self.subscriptions.deliver(None, None)
+
+
+class LogBudgetMixin(object):
+    """
+    Mixin for steps whose tools write large logs, such as
+    flatpak-builder, livecd-creator and rpm-ostree.
+
+    Each stream log of the step stores at most "head" bytes of its
+    start, "tail" bytes of its end and "context" bytes of the lines
+    around errors ("context-lines" of them before and after) in the
+    database.  The log observers still see every line.  The full log
+    is written compressed to "archive-dir" on the master, where the
+    logs older than "keep-days" are removed, and linked from the step
+    when "url" is the address that directory is served at.
+
+    log_budget is the "logs" section of config.json, None disables
+    the budget.  It must be set before adding log observers.
+    """
+
+    log_budget = None
+    budgeted_logs = ()
+    budgeted_observers = ()
+
+    def _archive(self, name):
+        directory = self.log_budget.get('archive-dir')
+        if not directory:
+            return None, None
+        builder = _safe_name(self.getProperty('buildername', 'unknown'))
+        filename = '%s-%s-%s.log.gz' % (self.getProperty('buildnumber', 0), _safe_name(self.name), _safe_name(name))
+        path = os.path.join(directory, builder)
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            limit = time.time() - self.log_budget.get('keep-days', 14) * 24 * 60 * 60
+            for old in os.listdir(path):
+                if os.path.getmtime(os.path.join(path, old)) < limit:
+                    os.unlink(os.path.join(path, old))
+            archive = gzip.open(os.path.join(path, filename), 'wb', compresslevel=1)
+        except (IOError, OSError) as e:
+            twlog.err(e, 'while creating the full log in %s' % path)
+            return None, None
+        return archive, '%s/%s' % (builder, filename)
+
+    def addLogObserver(self, logname, observer):
+        if self.log_budget is None:
+            return super(LogBudgetMixin, self).addLogObserver(logname, observer)
+        # Connected by addLog(), the budgeted log gives them every line
+        observer.setStep(self)
+        self.budgeted_observers += ((logname, observer),)
+
+    @defer.inlineCallbacks
+    def addLog(self, name, type='s', logEncoding=None):
+        log = yield super(LogBudgetMixin, self).addLog(name, type, logEncoding)
+        if self.log_budget is None:
+            defer.returnValue(log)
+            return
+        if log.type == 's':
+            archive, relpath = self._archive(name)
+            log = _BudgetedLog(log, self.log_budget, archive)
+            self.budgeted_logs += (log,)
+            if relpath and self.log_budget.get('url'):
+                yield self.addURL('full %s log' % name, '%s/%s' % (self.log_budget['url'].rstrip('/'), relpath))
+        for logname, observer in self.budgeted_observers:
+            if logname == name:
+                observer.setLog(log)
+        defer.returnValue(log)
+
+    @defer.inlineCallbacks
+    def finishUnfinishedLogs(self):
+        # The budgeted logs store their tail before the logs they wrap finish
+        results = yield defer.DeferredList([log.finish() for log in self.budgeted_logs if not log.finished],
+                                           consumeErrors=True)
+        ok = yield super(LogBudgetMixin, self).finishUnfinishedLogs()
+        for success, result in results:
+            if not success:
+                twlog.err(result, 'while finishing a budgeted log')
+                ok = False
+        defer.returnValue(ok)
+
+
+class ProgressObserver(logobserver.LogLineObserver):
+    """
+    Extracts the progress of a tool from its output into the dictionary
+    property named property.  patterns is a list of (regex, function)
+    pairs, the function returns the entries to update from a match.
+    """
+
+    def __init__(self, property, patterns):
+        logobserver.LogLineObserver.__init__(self)
+        self.property = property
+        self.patterns = patterns
+        self.progress = {}
+
+    def outLineReceived(self, line):
+        for regex, handler in self.patterns:
+            match = regex.search(line)
+            if match:
+                update = handler(match, self.progress)
+                if any(self.progress.get(key) != value for key, value in update.items()):
+                    self.progress.update(update)
+                    self.step.setProperty(self.property, dict(self.progress), self.step.name, runtime=True)
+                return
+
+    errLineReceived = outLineReceived
+
+
+def _phase(name):
+    return lambda match, progress: {'phase': name}
+
+
+def _counted_phase(match, progress):
+    return {'phase': match.group('phase').strip().lower(),
+            'done': int(match.group('done')), 'total': int(match.group('total'))}
+
+
+FLATPAK_PROGRESS = [
+    (re.compile(r'^Downloading sources'), _phase('downloading sources')),
+    (re.compile(r'^Building module (\S+) in '),
+     lambda match, progress: {'phase': 'building', 'module': match.group(1),
+                              'modules': progress.get('modules', 0) + 1}),
+    (re.compile(r'^Cache hit for (\S+), skipping build'),
+     lambda match, progress: {'module': match.group(1), 'modules': progress.get('modules', 0) + 1,
+                              'cached': progress.get('cached', 0) + 1}),
+    (re.compile(r'^Exporting '), _phase('exporting')),
+]
+
+RPM_OSTREE_PROGRESS = [
+    (re.compile(r'^Installing (\d+) packages'), lambda match, progress: {'packages': int(match.group(1))}),
+    (re.compile(r'^Will download: (\d+) packages? \(([^)]+)\)'),
+     lambda match, progress: {'download_packages': int(match.group(1)), 'download_size': match.group(2)}),
+    (re.compile(r'^(?P<phase>Downloading|Importing|Checking out|Relabeling|Writing)[^(]*\((?P<done>\d+)/(?P<total>\d+)\)'),
+     _counted_phase),
+    (re.compile(r'^Committing'), _phase('committing')),
+]
+
+LIVECD_PROGRESS = [
+    (re.compile(r'^Total download size: (.+)$'), lambda match, progress: {'download_size': match.group(1).strip()}),
+    (re.compile(r'^\((?P<done>\d+)/(?P<total>\d+)\): '),
+     lambda match, progress: {'phase': 'downloading', 'done': int(match.group('done')),
+                              'total': int(match.group('total'))}),
+    (re.compile(r'^\s*(?P<phase>Installing|Upgrading|Running scriptlet|Verifying)\s*:.*\s(?P<done>\d+)/(?P<total>\d+)\s*$'),
+     _counted_phase),
+]
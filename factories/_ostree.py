@@ -3,28 +3,160 @@
 
 from buildbot.process import remotecommand, buildstep
 from buildbot.plugins import util, steps
+from buildbot.steps.worker import CompositeStepMixin
 from buildbot import locks
 from twisted.internet import defer
 
 import buildbot
+import hashlib
+import json
 import os
+import re
+
+from liribotcfg import utils
+from ._gitcache import GitCache, GitCacheStep
+from ._logs import LogBudgetMixin, ProgressObserver, RPM_OSTREE_PROGRESS
+from ._pkgcache import PackageCache, PackageCacheStartStep, PackageCacheFinishStep
+from ._provision import Provisioning, ProvisionStep
+from ._sync import TreeSyncBaselineStep, TreeSyncPullStep, TreeSyncPushStep
 
 __all__ = [
     'OSTreeFactory',
+    'OSTreeMatrix',
+    'OSTreeMatrixFactory',
+    'OSTreeSummaryFactory',
 ]
 
+# Archive-mode repository served by the master to the workers, it holds
+# the refs of every tree and is kept under one artifact store key per channel
+REPO_BUILDER = 'ostree'
+REPO_PATH = 'export-repo'
+
+# Commit metadata key holding the fingerprint of the compose inputs
+FINGERPRINT_KEY = 'liri.fingerprint'
+
+
+def IsNotNoop(step):
+    return not step.build.getProperty('ostree_noop', False)
 
-class OSTreeBuildStep(buildstep.ShellMixin, steps.BuildStep):
+
+class OSTreeRefStep(steps.BuildStep, CompositeStepMixin):
     """
-    Creates the OSTree repo if needed.
+    Reads the ref from the treefile and sets the ostree_ref property,
+    ${basearch} in the ref is replaced by arch.
     """
-    def __init__(self, treefile=None, **kwargs):
+
+    def __init__(self, treefile=None, arch=None, **kwargs):
         self.treefile = treefile
+        self.arch = arch
+        steps.BuildStep.__init__(self, haltOnFailure=True, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        content = yield self.getFileContentFromWorker(self.treefile, abandonOnFailure=True)
+        treefile = utils.json_to_ascii(json.loads(content))
+        ref = treefile['ref']
+        if self.arch:
+            ref = ref.replace('${basearch}', self.arch)
+        self.setProperty('ostree_ref', ref, self.name, runtime=True)
+        self.descriptionDone = [ref]
+        defer.returnValue(buildbot.process.results.SUCCESS)
+
+
+class OSTreeBuildStep(LogBudgetMixin, buildstep.ShellMixin, steps.BuildStep, CompositeStepMixin):
+    """
+    Creates the OSTree repo if needed, then composes the tree unless
+    its inputs did not change since the last commit.
+
+    The fingerprint of the inputs covers the treefile and every file
+    it references, the packages resolved by a dry run and the metadata
+    of the repositories they come from.  It is stored in the commit
+    metadata and exposed as the ostree_fingerprint property, while the
+    ostree_noop property tells whether the compose was skipped.
+
+    The progress of the compose goes to the ostree_progress property,
+    and the logs are kept within log_budget, see LogBudgetMixin.
+    """
+
+    package_re = re.compile(r'^\s+\S+-[^-\s]+-[^-\s]+\.\S+( \(\S+\))?\s*$')
+
+    def __init__(self, treefile=None, cachedir='../cache', log_budget=None, **kwargs):
+        self.treefile = treefile
+        self.cachedir = cachedir
+        self.log_budget = log_budget
         self.setupShellMixin({'logEnviron': False,
                               'timeout': 3600,
                               'usePTY': True})
         steps.BuildStep.__init__(self, haltOnFailure=True, **kwargs)
         self.title = 'Create OS tree'
+        self.addLogObserver('stdio', ProgressObserver('ostree_progress', RPM_OSTREE_PROGRESS))
+
+    @defer.inlineCallbacks
+    def _treefile_inputs(self, filename, seen):
+        """
+        Returns the names and contents of the treefile and of
+        the files it references, recursively.
+        """
+        if filename in seen:
+            defer.returnValue([])
+            return
+        seen.add(filename)
+        content = yield self.getFileContentFromWorker(filename, abandonOnFailure=True)
+        inputs = [(filename, content)]
+        treefile = json.loads(content)
+        references = treefile.get('include', [])
+        if not isinstance(references, list):
+            references = [references]
+        dirname = os.path.dirname(filename)
+        for name in references:
+            more = yield self._treefile_inputs(os.path.join(dirname, name), seen)
+            inputs.extend(more)
+        files = []
+        if 'postprocess-script' in treefile:
+            files.append(treefile['postprocess-script'])
+        files.extend(src for src, dst in treefile.get('add-files', []))
+        for key in ('check-passwd', 'check-groups'):
+            if treefile.get(key, {}).get('type') == 'file':
+                files.append(treefile[key]['filename'])
+        for name in files:
+            path = os.path.join(dirname, name)
+            data = yield self.getFileContentFromWorker(path, abandonOnFailure=True)
+            inputs.append((path, data))
+        defer.returnValue(inputs)
+
+    @defer.inlineCallbacks
+    def fingerprint(self):
+        """
+        Returns the fingerprint of the compose inputs, or None
+        when the packages cannot be resolved.
+        """
+        h = hashlib.sha256()
+        inputs = yield self._treefile_inputs(self.treefile, set())
+        for name, content in sorted(inputs):
+            h.update(name.encode('utf-8') + b'\0')
+            h.update(content.encode('utf-8') if not isinstance(content, bytes) else content)
+        cmd = ['sudo', 'rpm-ostree', 'compose', 'tree', '--dry-run', '--repo=build-repo', '--cachedir=' + self.cachedir, self.treefile]
+        dryRunCmd = yield self.makeRemoteShellCommand(command=cmd, collectStdout=True, stdioLogName='dry run')
+        yield self.runCommand(dryRunCmd)
+        if dryRunCmd.didFail():
+            defer.returnValue(None)
+            return
+        for line in dryRunCmd.stdout.splitlines():
+            # Resolved packages, and the repositories with their metadata timestamps
+            if self.package_re.match(line) or 'rpm-md repo' in line:
+                h.update(line.strip().encode('utf-8') + b'\n')
+        defer.returnValue(h.hexdigest())
+
+    @defer.inlineCallbacks
+    def last_fingerprint(self):
+        ref = self.getProperty('ostree_ref')
+        cmd = ['ostree', 'show', '--repo=build-repo', '--print-metadata-key=' + FINGERPRINT_KEY, ref]
+        showCmd = yield self.makeRemoteShellCommand(command=cmd, collectStdout=True, stdioLogName='last fingerprint')
+        yield self.runCommand(showCmd)
+        if showCmd.didFail():
+            defer.returnValue(None)
+            return
+        defer.returnValue(showCmd.stdout.strip().strip("'"))
 
     @defer.inlineCallbacks
     def run(self):
@@ -35,34 +167,187 @@ class OSTreeBuildStep(buildstep.ShellMixin, steps.BuildStep):
         if initCmd.didFail():
             defer.returnValue(buildbot.process.results.FAILURE)
             return
-        # Make tree
-        mkdirCmd = yield self.makeRemoteShellCommand(command=['mkdir', '-p', '../cache'])
+        mkdirCmd = yield self.makeRemoteShellCommand(command=['sudo', 'mkdir', '-p', self.cachedir])
         yield self.runCommand(mkdirCmd)
-        cmd = ['sudo', 'rpm-ostree', 'compose', 'tree', '--repo=build-repo', '--cachedir=../cache', self.treefile]
+        # Skip the compose when nothing changed
+        fingerprint = yield self.fingerprint()
+        last = yield self.last_fingerprint()
+        noop = fingerprint is not None and fingerprint == last
+        self.setProperty('ostree_fingerprint', fingerprint, self.name, runtime=True)
+        self.setProperty('ostree_noop', noop, self.name, runtime=True)
+        if noop:
+            self.descriptionDone = ['no-op, inputs unchanged']
+            defer.returnValue(buildbot.process.results.SKIPPED)
+            return
+        # Make tree
+        cmd = ['sudo', 'rpm-ostree', 'compose', 'tree', '--repo=build-repo', '--cachedir=' + self.cachedir]
+        if fingerprint is not None:
+            cmd.append('--add-metadata-string=%s=%s' % (FINGERPRINT_KEY, fingerprint))
+        cmd.append(self.treefile)
         makeCmd = yield self.makeRemoteShellCommand(command=cmd)
         yield self.runCommand(makeCmd)
         defer.returnValue(makeCmd.results())
 
 
+class OSTreeMatrix(object):
+    """
+    Channels, trees and architectures to build, from a list of
+    entries with a "channel", a list of "treenames" and a list of
+    "archs", each entry standing for all their combinations.
+
+    The builds of a channel are triggered together by the matrix
+    builder of the channel, which then triggers the update of the
+    summary of the repository once they are all done.
+    """
+
+    def __init__(self, entries=None):
+        entries = entries or [{'channel': 'unstable', 'treenames': ['desktop'], 'archs': ['x86_64']}]
+        self.builds = []
+        for entry in entries:
+            for treename in entry.get('treenames', ['desktop']):
+                for arch in entry.get('archs', ['x86_64']):
+                    build = (entry['channel'], treename, arch)
+                    if build not in self.builds:
+                        self.builds.append(build)
+
+    def channels(self):
+        channels = []
+        for channel, treename, arch in self.builds:
+            if channel not in channels:
+                channels.append(channel)
+        return channels
+
+    def builder_names(self, channel):
+        return [self.builder_name(*build) for build in self.builds if build[0] == channel]
+
+    def builder_name(self, channel, treename, arch):
+        return 'ostree-%s-%s-%s-build' % (channel, treename, arch)
+
+    def matrix_builder_name(self, channel):
+        return 'ostree-%s-matrix' % channel
+
+    def scheduler_name(self, channel):
+        return 'ostree-%s-matrix' % channel
+
+    def summary_builder_name(self, channel):
+        return 'ostree-%s-summary' % channel
+
+    def summary_scheduler_name(self, channel):
+        return 'ostree-%s-summary' % channel
+
+
+class OSTreeMatrixFactory(util.BuildFactory):
+    """
+    Build factory triggering the builds of a channel of the matrix
+    and, once they are done, also when some of them failed, the
+    update of the summary of its repository.
+    """
+
+    def __init__(self, scheduler=None, summary_scheduler=None, *args, **kwargs):
+        util.BuildFactory.__init__(self, *args, **kwargs)
+        self.addSteps([
+            steps.Trigger(
+                name='build trees',
+                schedulerNames=[scheduler],
+                waitForFinish=True,
+                updateSourceStamp=True,
+                haltOnFailure=False,
+                flunkOnFailure=True,
+                copy_properties=['buildname'],
+            ),
+            steps.Trigger(
+                name='update summary',
+                schedulerNames=[summary_scheduler],
+                waitForFinish=True,
+                alwaysRun=True,
+                flunkOnFailure=True,
+            ),
+        ])
+
+
+def HasRepo(step):
+    return step.build.getProperty('ostree_repo', False)
+
+
+class OSTreeSummaryFactory(util.BuildFactory):
+    """
+    Build factory updating the summary of the repository of a channel,
+    once for the refs pushed by all the builds of the matrix.
+
+    The master has no ostree, so the worker keeps a copy of the
+    repository, brings it up to date with what the builds pushed,
+    and pushes back the new summary.
+    """
+
+    tools = ['ostree']
+
+    def __init__(self, channel=None, store=None, provisioning=None, transfer=None, *args, **kwargs):
+        util.BuildFactory.__init__(self, *args, **kwargs)
+        provisioning = provisioning or Provisioning()
+        provisioning.require(self.tools)
+        self.addSteps([
+            ProvisionStep(name='provision worker', provisioning=provisioning, sudo=True),
+            TreeSyncPullStep(name='pull repo', store=store, builder=REPO_BUILDER, channel=channel,
+                             paths=[REPO_PATH], transfer=transfer),
+            # Nothing to do before the first build of the channel
+            steps.SetPropertyFromCommand(
+                name='check repo',
+                command=['test', '-d', REPO_PATH + '/objects'],
+                extract_fn=lambda rc, stdout, stderr: {'ostree_repo': rc == 0},
+                flunkOnFailure=False,
+                logEnviron=False,
+            ),
+            steps.ShellCommand(
+                name='update summary',
+                haltOnFailure=True,
+                logEnviron=False,
+                doStepIf=HasRepo,
+                command=['ostree', 'summary', '--repo=' + REPO_PATH, '--update'],
+            ),
+            TreeSyncPushStep(name='push summary', store=store, builder=REPO_BUILDER, channel=channel,
+                             paths=[REPO_PATH], transfer=transfer, doStepIf=HasRepo),
+        ])
+
+
 class OSTreeFactory(util.BuildFactory):
     """
     Build factory for rpm-ostree OS trees.
+
+    The tree is composed on a worker of its architecture and its commit
+    pushed to the repository of the channel, shared by the trees and
+    architectures of the channel.  Without summary, the summary is left
+    to OSTreeSummaryFactory.
     """
-    def __init__(self, channel=None, treename=None, arch=None, *args, **kwargs):
+
+    tools = ['git', 'rpm-ostree']
+
+    def __init__(self, channel=None, treename=None, arch=None, store=None, repo_url=None, static_deltas=False,
+                 cache=None, provisioning=None, git_cache=None, transfer=None, logs=None, summary=True,
+                 *args, **kwargs):
         self.channel = channel
         self.treename = treename
         self.arch = arch
         util.BuildFactory.__init__(self, *args, **kwargs)
+        cache = cache or PackageCache()
+        git_cache = git_cache or GitCache()
+        provisioning = provisioning or Provisioning()
+        provisioning.require(self.tools)
+        treefile = 'lirios-{}-{}.json'.format(self.channel, self.treename)
+        repo_url = '%s/%s/%s/' % (repo_url.rstrip('/'), REPO_BUILDER, self.channel)
+        export_commands = [
+            util.ShellArg(command=['ostree', 'pull-local', '--repo=' + REPO_PATH, 'build-repo', util.Property('ostree_ref')], logfile='stdio', haltOnFailure=True),
+        ]
+        if static_deltas:
+            export_commands.append(
+                util.ShellArg(command=['ostree', 'static-delta', 'generate', '--repo=' + REPO_PATH, util.Property('ostree_ref')], logfile='stdio', haltOnFailure=True),
+            )
+        if summary:
+            export_commands.append(
+                util.ShellArg(command=['ostree', 'summary', '--repo=' + REPO_PATH, '--update'], logfile='stdio', haltOnFailure=True),
+            )
         self.addSteps([
-            steps.ShellSequence(
-                name='install tools',
-                haltOnFailure=True,
-                logEnviron=False,
-                commands=[
-                    util.ShellArg(command=['sudo', 'dnf', 'update', '-y'], logfile='stdio'),
-                    util.ShellArg(command=['sudo', 'dnf', 'install', '-y', 'git', 'rpm-ostree'], logfile='stdio'),
-                ],
-            ),
+            ProvisionStep(name='provision worker', provisioning=provisioning, sudo=True),
+            GitCacheStep(name='git cache', cache=git_cache),
             steps.Git(
                 name='checkout sources',
                 codebase=util.Property('codebase'),
@@ -71,36 +356,36 @@ class OSTreeFactory(util.BuildFactory):
                 mode='incremental',
                 submodules=True,
                 shallow=True,
+                reference=util.Property('git_reference'),
+                config=git_cache.config,
             ),
-            steps.FileDownload(
-                name='download build-repo.tar',
-                haltOnFailure=False,
-                mastersrc='/srv/ci/buildbot/data/ostree/build-repo.tar',
-                workerdest='build-repo.tar'
-            ),
-            steps.ShellCommand(
-                name='expand build-repo.tar',
-                haltOnFailure=False,
-                logEnviron=False,
-                command=['tar', 'xf', 'build-repo.tar'],
-            ),
-            OSTreeBuildStep(name='create OS tree', treefile='lirios-{}-{}.json'.format(self.channel, self.treename)),
-            steps.ShellCommand(
-                name='archive build-repo',
-                haltOnFailure=True,
+            OSTreeRefStep(name='read treefile', treefile=treefile, arch=self.arch),
+            steps.ShellSequence(
+                name='pull build repo',
                 logEnviron=False,
-                command=['tar', 'cf', 'build-repo.tar', 'build-repo'],
-            ),
-            steps.FileUpload(
-                name='upload build-repo.tar',
                 haltOnFailure=True,
-                workersrc='build-repo.tar',
-                masterdest='/srv/ci/buildbot/data/ostree/build-repo.tar',
+                commands=[
+                    util.ShellArg(command=['ostree', 'init', '--repo=' + REPO_PATH, '--mode=archive'], logfile='stdio', haltOnFailure=True),
+                    util.ShellArg(command=['ostree', 'init', '--repo=build-repo', '--mode=bare-user'], logfile='stdio', haltOnFailure=True),
+                    util.ShellArg(command=['ostree', 'remote', 'delete', '--repo=' + REPO_PATH, '--if-exists', 'master'], logfile='stdio'),
+                    util.ShellArg(command=['ostree', 'remote', 'add', '--repo=' + REPO_PATH, '--no-gpg-verify', 'master', repo_url], logfile='stdio', haltOnFailure=True),
+                    # Fails on the first build, when the master has no commit yet
+                    util.ShellArg(command=['ostree', 'pull', '--repo=' + REPO_PATH, '--mirror', '--depth=0', 'master', util.Property('ostree_ref')], logfile='stdio', warnOnFailure=True, flunkOnFailure=False),
+                    util.ShellArg(command=['sudo', 'ostree', 'pull-local', '--repo=build-repo', REPO_PATH, util.Property('ostree_ref')], logfile='stdio', warnOnFailure=True, flunkOnFailure=False),
+                ],
             ),
-            steps.ShellCommand(
-                name='remove build-repo',
-                haltOnFailure=False,
+            TreeSyncBaselineStep(name='record build repo baseline', builder=REPO_BUILDER, channel=self.channel, paths=[REPO_PATH]),
+            # rpm-ostree runs as root, and so does the cache maintenance
+            PackageCacheStartStep(name='prepare package cache', cache=cache, sudo=True),
+            OSTreeBuildStep(name='create OS tree', treefile=treefile, cachedir=cache.path('rpm-ostree'), log_budget=logs),
+            PackageCacheFinishStep(name='package cache statistics', cache=cache, sudo=True),
+            steps.ShellSequence(
+                name='export commit',
                 logEnviron=False,
-                command=['rm', '-rf', 'build-repo', 'build-repo.tar'],
+                haltOnFailure=True,
+                doStepIf=IsNotNoop,
+                commands=export_commands,
             ),
+            TreeSyncPushStep(name='push build repo', store=store, builder=REPO_BUILDER, channel=self.channel,
+                             paths=[REPO_PATH], transfer=transfer, doStepIf=IsNotNoop),
         ])
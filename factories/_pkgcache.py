@@ -0,0 +1,112 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+from buildbot.process import buildstep
+from buildbot.plugins import steps
+from twisted.internet import defer
+
+import buildbot
+import json
+import os
+
+from liribotcfg import utils
+
+__all__ = [
+    'PackageCache',
+    'PackageCacheStartStep',
+    'PackageCacheFinishStep',
+]
+
+SCRIPT = '.pkgcache.py'
+STAMP = '.pkgcache-stamp'
+
+
+class PackageCache(object):
+    """
+    Package cache shared by the builds of a worker, each tool gets
+    its own directory under the root and identical packages are
+    hard linked across them.
+    """
+
+    def __init__(self, root='/build/cache', max_size=None):
+        self.root = root
+        self.max_size = max_size
+
+    def path(self, tool):
+        return os.path.join(self.root, tool)
+
+    def command(self, action, sudo=False):
+        """
+        Returns the command running the maintenance script, with
+        sudo when the cache is written by privileged tools.
+        """
+        cmd = ['python3', SCRIPT, action, '--root', self.root, '--stamp', STAMP]
+        if self.max_size:
+            cmd += ['--max-size', str(self.max_size)]
+        return (['sudo'] if sudo else []) + cmd
+
+
+def _cache_mode(step):
+    # Older builds used a boolean, False meaning a wipe
+    mode = step.getProperty('cache', 'keep')
+    if mode is True:
+        return 'keep'
+    if mode is False:
+        return 'clear'
+    return mode
+
+
+class PackageCacheStartStep(steps.BuildStep):
+    """
+    Prepares the package cache before a build, pruning or clearing
+    it when requested with the "cache" property.
+    """
+
+    def __init__(self, cache=None, sudo=False, **kwargs):
+        self.cache = cache
+        self.sudo = sudo
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        mode = _cache_mode(self)
+        self.build.addStepsAfterCurrentStep([
+            steps.FileDownload(
+                name='download pkgcache',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('scripts', 'pkgcache.py'),
+                workerdest=SCRIPT,
+            ),
+            steps.ShellCommand(
+                name='%s package cache' % mode,
+                haltOnFailure=True,
+                logEnviron=False,
+                command=self.cache.command('start', sudo=self.sudo) + ['--mode', mode],
+            ),
+        ])
+        return buildbot.process.results.SUCCESS
+
+
+class PackageCacheFinishStep(buildstep.ShellMixin, steps.BuildStep):
+    """
+    Reports the cache hits and misses of the build, deduplicates
+    the packages and evicts the least recently used ones.
+    """
+
+    def __init__(self, cache=None, sudo=False, **kwargs):
+        self.cache = cache
+        self.sudo = sudo
+        self.setupShellMixin({'logEnviron': False})
+        steps.BuildStep.__init__(self, alwaysRun=True, flunkOnFailure=False, warnOnFailure=True, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand(command=self.cache.command('finish', sudo=self.sudo),
+                                                collectStdout=True)
+        yield self.runCommand(cmd)
+        for line in cmd.stdout.splitlines():
+            if line.startswith('pkgcache: '):
+                stats = json.loads(line[len('pkgcache: '):])
+                for name, value in stats.items():
+                    self.setProperty('cache_' + name, value, self.name, runtime=True)
+                self.descriptionDone = ['%(hits)d hits, %(misses)d misses' % stats]
+        defer.returnValue(cmd.results())
@@ -0,0 +1,95 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+from buildbot.process import buildstep
+from buildbot.plugins import steps
+from twisted.internet import defer
+
+import buildbot
+
+from liribotcfg import utils
+
+__all__ = [
+    'Provisioning',
+    'ProvisionStep',
+]
+
+SCRIPT = '.provision.py'
+
+
+class Provisioning(object):
+    """
+    Tools required by the factories that share a set of workers.
+
+    Factories register the packages they need when they are created,
+    the provisioning step installs all of them in a single transaction
+    so that the first build on a worker provisions it for the others.
+    """
+
+    def __init__(self, manifest='/var/lib/liri-buildbot/provision.json', max_age=24*60*60):
+        self.manifest = manifest
+        self.max_age = max_age
+        self.requirements = set()
+
+    def require(self, packages):
+        self.requirements.update(packages)
+
+    @property
+    def packages(self):
+        return sorted(self.requirements)
+
+
+class _ProvisionCommandStep(buildstep.ShellMixin, steps.BuildStep):
+    def __init__(self, provisioning=None, sudo=False, **kwargs):
+        self.provisioning = provisioning
+        self.sudo = sudo
+        self.setupShellMixin({'logEnviron': False,
+                              'timeout': 3600})
+        steps.BuildStep.__init__(self, haltOnFailure=True, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = ['python3', SCRIPT, '--manifest', self.provisioning.manifest,
+               '--max-age', str(self.provisioning.max_age)]
+        if self.getProperty('reprovision', False):
+            cmd.append('--force')
+        cmd += self.provisioning.packages
+        if self.sudo:
+            cmd.insert(0, 'sudo')
+        provisionCmd = yield self.makeRemoteShellCommand(command=cmd, collectStdout=True)
+        yield self.runCommand(provisionCmd)
+        if 'provision: up to date' in provisionCmd.stdout:
+            self.descriptionDone = ['up to date']
+        elif not provisionCmd.didFail():
+            self.descriptionDone = ['%d packages provisioned' % len(self.provisioning.packages)]
+        defer.returnValue(provisionCmd.results())
+
+
+class ProvisionStep(steps.BuildStep):
+    """
+    Updates the worker and installs the required tools, unless
+    the worker was already provisioned with them.
+
+    Set the "reprovision" property to force the transaction.
+    """
+
+    def __init__(self, provisioning=None, sudo=False, **kwargs):
+        self.provisioning = provisioning
+        self.sudo = sudo
+        steps.BuildStep.__init__(self, haltOnFailure=True, **kwargs)
+
+    def run(self):
+        self.build.addStepsAfterCurrentStep([
+            steps.FileDownload(
+                name='download provision',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('scripts', 'provision.py'),
+                workerdest=SCRIPT,
+            ),
+            _ProvisionCommandStep(
+                name='install tools',
+                provisioning=self.provisioning,
+                sudo=self.sudo,
+            ),
+        ])
+        return buildbot.process.results.SUCCESS
@@ -0,0 +1,54 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+from buildbot.process import buildstep
+from buildbot.plugins import steps
+from twisted.internet import defer
+
+import buildbot
+
+__all__ = [
+    'WorkerResourcesStep',
+]
+
+
+class WorkerResourcesStep(buildstep.ShellMixin, steps.BuildStep):
+    """
+    Finds out how many cores and how much memory the worker has,
+    and sets the number of parallel build jobs accordingly.
+
+    The "jobs" property is set to the smallest between the number of
+    cores and the number of jobs that fit in memory, unless the worker
+    has a "jobs" entry in config.json.
+    """
+
+    def __init__(self, overrides=None, memory_per_job=2048, **kwargs):
+        self.overrides = overrides or {}
+        self.memory_per_job = memory_per_job
+        self.setupShellMixin({'logEnviron': False})
+        steps.BuildStep.__init__(self, haltOnFailure=True, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand(command=['sh', '-c', 'nproc && grep MemTotal /proc/meminfo'],
+                                                collectStdout=True)
+        yield self.runCommand(cmd)
+        if cmd.didFail():
+            defer.returnValue(buildbot.process.results.FAILURE)
+            return
+        lines = cmd.stdout.splitlines()
+        cpus = int(lines[0].strip())
+        memory = int(lines[1].split()[1]) // 1024
+        workername = self.getProperty('workername')
+        if workername in self.overrides:
+            jobs = int(self.overrides[workername])
+            reason = 'set in config.json for %s' % workername
+        else:
+            jobs = max(1, min(cpus, memory // self.memory_per_job))
+            reason = '%d cores, %d MiB of memory, %d MiB per job' % (cpus, memory, self.memory_per_job)
+        self.setProperty('cpus', cpus, self.name, runtime=True)
+        self.setProperty('memory', memory, self.name, runtime=True)
+        self.setProperty('jobs', jobs, self.name, runtime=True)
+        yield self.addCompleteLog('parallelism', u'%d parallel jobs (%s)\n' % (jobs, reason))
+        self.descriptionDone = ['%d jobs' % jobs]
+        defer.returnValue(buildbot.process.results.SUCCESS)
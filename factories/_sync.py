@@ -0,0 +1,756 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+from buildbot.plugins import util, steps
+from buildbot.process import remotecommand
+from buildbot.worker.protocols import base
+from future.utils import with_metaclass
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+import abc
+import buildbot
+import os
+import time
+
+from liribotcfg import artifacts
+from liribotcfg import treesync
+from liribotcfg import utils
+
+__all__ = [
+    'TreeSyncTransfer',
+    'TreeSyncPullStep',
+    'TreeSyncPushStep',
+    'TreeSyncBaselineStep',
+]
+
+SCRIPT = '.treesync.py'
+FIFO = '.treesync-delta.fifo'
+STATUS = '.treesync-stream.status'
+STORE_MANIFEST = artifacts.MANIFEST
+
+
+class TreeSyncTransfer(object):
+    """
+    How deltas travel between the master and the workers.
+
+    Deltas are streamed through the worker connection in chunks of
+    chunk_size bytes, compressed with zstd at the given level (0 does
+    not compress), and applied as they arrive.  When the workers see
+    the artifact store at shared_path, such as on a Docker volume
+    shared with the master, they read and write the store generations
+    there directly instead.
+
+    At most max_transfers deltas are streamed at a time, the others
+    wait for their turn.  They run in a thread pool of their own rather
+    than in the reactor one, that the master needs for its database.
+    """
+
+    def __init__(self, chunk_size=256*1024, compression=3, shared_path=None, max_transfers=4):
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.shared_path = shared_path
+        self.max_transfers = max_transfers
+        self.slots = _transfer_slots(max_transfers)
+
+    def worker_path(self, store, path):
+        """
+        Returns the path of a store generation on the workers.
+        """
+        return os.path.join(self.shared_path, os.path.relpath(os.path.realpath(path), os.path.realpath(store.basedir)))
+
+
+class _TransferSlots(object):
+    """
+    Thread pool and turns of the streamed transfers.  A transfer holds
+    a thread to pack or apply its delta and one for the chunk being
+    sent or received, the pool has both for each transfer running so
+    that chunks never wait for a thread held by another transfer.
+    """
+
+    def __init__(self, max_transfers):
+        self.semaphore = defer.DeferredSemaphore(max_transfers)
+        self.pool = threadpool.ThreadPool(0, 2 * max_transfers, name='treesync-transfers')
+
+    def acquire(self):
+        return self.semaphore.acquire()
+
+    def release(self):
+        self.semaphore.release()
+
+    def run(self, func, *args, **kwargs):
+        if not self.pool.started:
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        return threads.deferToThreadPool(reactor, self.pool, func, *args, **kwargs)
+
+
+# Shared by the configurations loaded by a reconfig
+_slots = {}
+
+
+def _transfer_slots(max_transfers):
+    if max_transfers not in _slots:
+        _slots[max_transfers] = _TransferSlots(max_transfers)
+    return _slots[max_transfers]
+
+
+def _base_manifest(builder, channel):
+    """
+    Returns the name of the worker file holding the manifest
+    of the last generation pulled or pushed for a key.
+    """
+    return '.treesync-%s-%s.json' % (builder, channel or 'default')
+
+
+def _store_manifest(generation, paths, progress=None):
+    """
+    Returns the manifest of a store generation, the cached
+    manifest is used to avoid hashing unchanged files.
+    """
+    manifest_path = os.path.join(generation, STORE_MANIFEST)
+    previous = treesync.load_manifest(manifest_path)
+    manifest = treesync.build_manifest(generation, paths, previous, progress=progress)
+    treesync.save_manifest(manifest, manifest_path)
+    return manifest
+
+
+class MasterThreadStep(with_metaclass(abc.ABCMeta, steps.BuildStep)):
+    """
+    Base class for the steps that run blocking file system
+    code on the master, in a thread.  Subclasses implement sync().
+    """
+
+    def __init__(self, **kwargs):
+        steps.BuildStep.__init__(self, haltOnFailure=True, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        self.stdio = yield self.addLog('stdio')
+        self.messages = []
+        self.sync_properties = {}
+        try:
+            result = yield threads.deferToThread(self.sync)
+        except Exception as e:
+            self.messages.append('error: %s' % e)
+            result = buildbot.process.results.FAILURE
+        yield self.stdio.addStdout(u''.join(m + '\n' for m in self.messages))
+        yield self.stdio.finish()
+        for name, value in self.sync_properties.items():
+            self.setProperty(name, value, self.name, runtime=True)
+        defer.returnValue(result)
+
+    def progress(self, message):
+        # Called from a thread, the log is written when the step ends
+        self.messages.append(message)
+
+    @abc.abstractmethod
+    def sync(self):
+        """
+        Does the work of the step in a thread and returns its result,
+        an exception fails the step.  progress() records the messages
+        of the log and the build properties to set go to
+        self.sync_properties, both are applied when it returns.
+        """
+
+
+def _worker_args(step, command, path, args):
+    if step.workerVersionIsOlderThan(command, '3.0'):
+        args['slavesrc' if command == 'uploadFile' else 'slavedest'] = path
+    else:
+        args['workersrc' if command == 'uploadFile' else 'workerdest'] = path
+    return args
+
+
+class _DeltaWriter(base.FileWriterImpl):
+    """
+    Receives a delta uploaded by a worker and applies it to a
+    store generation in a thread, while it arrives.
+    """
+
+    def __init__(self, slots, generation, compressed, progress):
+        rfd, wfd = os.pipe()
+        self.slots = slots
+        self.pipe = os.fdopen(wfd, 'wb')
+        self.compressed = 0
+        self.result = slots.run(self._apply, os.fdopen(rfd, 'rb'), generation, compressed, progress)
+
+    def _apply(self, source, generation, compressed, progress):
+        with source:
+            try:
+                if compressed:
+                    process = treesync.decompress_stream(source)
+                    delta = treesync.CountingFile(process.stdout)
+                    try:
+                        extracted, deleted, _ = treesync.apply_delta(delta, generation, progress=progress)
+                    finally:
+                        process.stdout.close()
+                    if process.wait() != 0:
+                        raise IOError('zstd exited with status %d' % process.returncode)
+                else:
+                    delta = treesync.CountingFile(source)
+                    extracted, deleted, _ = treesync.apply_delta(delta, generation, progress=progress)
+            finally:
+                # Unblocks the writes still to come if applying failed
+                while source.read(1024 * 1024):
+                    pass
+        return extracted, deleted, delta.count
+
+    def remote_write(self, data):
+        self.compressed += len(data)
+        return self.slots.run(self.pipe.write, data)
+
+    def remote_utime(self, accessed_modified):
+        pass
+
+    def remote_close(self):
+        self.pipe.close()
+
+    def cancel(self):
+        if not self.pipe.closed:
+            self.pipe.close()
+
+
+class _DeltaReader(base.FileReaderImpl):
+    """
+    Sends a delta written in a thread to a worker, while it is written.
+    """
+
+    def __init__(self, slots, write, compression):
+        rfd, wfd = os.pipe()
+        self.slots = slots
+        self.pipe = os.fdopen(rfd, 'rb')
+        self.compressed = 0
+        self.result = slots.run(self._write, os.fdopen(wfd, 'wb'), write, compression)
+
+    def _write(self, sink, write, compression):
+        with sink:
+            if compression:
+                process = treesync.compress_stream(sink, compression)
+                delta = treesync.CountingFile(process.stdin)
+                try:
+                    write(delta)
+                finally:
+                    process.stdin.close()
+                if process.wait() != 0:
+                    raise IOError('zstd exited with status %d' % process.returncode)
+            else:
+                delta = treesync.CountingFile(sink)
+                write(delta)
+        return delta.count
+
+    def _read(self, length):
+        data = self.pipe.read(length)
+        self.compressed += len(data)
+        return data
+
+    def remote_read(self, maxLength):
+        return self.slots.run(self._read, maxLength)
+
+    def remote_close(self):
+        self.pipe.close()
+
+
+class _TreeSyncDeltaStep(MasterThreadStep):
+    """
+    Computes what a worker needs to catch up with the current store
+    generation, the delta itself is streamed by _TreeSyncSendStep.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, paths=None, legacy=None,
+                 worker_manifest=None, plan=None, **kwargs):
+        self.store = store
+        self.builder = builder
+        self.channel = channel
+        self.paths = paths
+        self.legacy = legacy or []
+        self.worker_manifest = worker_manifest
+        self.plan = plan
+        MasterThreadStep.__init__(self, locks=[store.lock(builder, channel).access('counting')], **kwargs)
+
+    def sync(self):
+        source = self.store.import_legacy(self.builder, self.channel, self.legacy, self.paths)
+        if source:
+            self.progress('imported %s' % source)
+        target = treesync.load_manifest(self.worker_manifest)
+        os.unlink(self.worker_manifest)
+        generation = self.store.current(self.builder, self.channel)
+        if generation is None:
+            # Nothing on the master yet: leave the worker alone, its next push sends everything
+            self.progress('no generation on the master yet')
+            self.plan.update(root='.', changed=[], deleted=[], manifest={})
+            return buildbot.process.results.SUCCESS
+        self.progress('pulling %s' % generation)
+        source = _store_manifest(generation, self.paths, progress=self.progress)
+        if not target:
+            self.progress('no usable baseline on the worker, sending everything')
+        changed, deleted, stats = treesync.diff_manifests(source, target)
+        self.progress(treesync.describe_stats(stats))
+        self.plan.update(root=generation, changed=changed, deleted=deleted,
+                         manifest=treesync.merge_manifests(source, target))
+        self.sync_properties['treesync_saved_bytes'] = stats['saved_bytes']
+        return buildbot.process.results.SUCCESS
+
+
+class _TreeSyncSendStep(steps.BuildStep):
+    """
+    Streams the delta planned by _TreeSyncDeltaStep to the worker,
+    where it is applied in the background.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, plan=None, transfer=None, **kwargs):
+        self.plan = plan
+        self.transfer = transfer
+        steps.BuildStep.__init__(self, haltOnFailure=True,
+                                 locks=[store.lock(builder, channel).access('counting')], **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield self.transfer.slots.acquire()
+        try:
+            result = yield self._send()
+        finally:
+            self.transfer.slots.release()
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _send(self):
+        plan = self.plan
+        reader = _DeltaReader(
+            self.transfer.slots,
+            lambda f: treesync.write_delta(f, plan['root'], plan['changed'], plan['deleted'], manifest=plan['manifest']),
+            self.transfer.compression)
+        started = time.time()
+        cmd = remotecommand.RemoteCommand('downloadFile', _worker_args(self, 'downloadFile', FIFO, {
+            'maxsize': None,
+            'reader': reader,
+            'blocksize': self.transfer.chunk_size,
+            'workdir': self.workdir,
+            'mode': None,
+        }))
+        yield self.runCommand(cmd)
+        reader.remote_close()
+        try:
+            raw = yield reader.result
+        except Exception as e:
+            yield self.addCompleteLog('transfer', u'error: %s\n' % e)
+            defer.returnValue(buildbot.process.results.FAILURE)
+            return
+        if cmd.didFail():
+            defer.returnValue(buildbot.process.results.FAILURE)
+            return
+        self.transferred = ('download', reader.compressed)
+        message = treesync.describe_transfer(raw, reader.compressed if self.transfer.compression else None,
+                                             time.time() - started)
+        yield self.addCompleteLog('transfer', u'%s\n' % message)
+        self.descriptionDone = [message.split(',')[0]]
+        defer.returnValue(buildbot.process.results.SUCCESS)
+
+
+class _TreeSyncReceiveStep(steps.BuildStep):
+    """
+    Receives the delta packed in the background on the worker and
+    applies it to a new store generation while it arrives.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, paths=None, transfer=None, prepare=None, **kwargs):
+        self.store = store
+        self.builder = builder
+        self.channel = channel
+        self.paths = paths
+        self.transfer = transfer
+        self.prepare = prepare
+        steps.BuildStep.__init__(self, haltOnFailure=True,
+                                 locks=[store.lock(builder, channel).access('exclusive')], **kwargs)
+
+    def _commit(self, generation, messages):
+        if self.prepare:
+            self.prepare(generation, messages.append)
+        _store_manifest(generation, self.paths, progress=messages.append)
+        self.store.commit(self.builder, self.channel, generation)
+        messages.append('committed %s' % generation)
+        self.store.evict(self.builder, self.channel, progress=messages.append)
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield self.transfer.slots.acquire()
+        try:
+            result = yield self._receive()
+        finally:
+            self.transfer.slots.release()
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _receive(self):
+        messages = []
+        generation = yield threads.deferToThread(self.store.begin, self.builder, self.channel)
+        writer = _DeltaWriter(self.transfer.slots, generation, self.transfer.compression > 0, messages.append)
+        started = time.time()
+        cmd = remotecommand.RemoteCommand('uploadFile', _worker_args(self, 'uploadFile', FIFO, {
+            'writer': writer,
+            'maxsize': None,
+            'blocksize': self.transfer.chunk_size,
+            'workdir': self.workdir,
+            'keepstamp': False,
+        }))
+        result = buildbot.process.results.FAILURE
+        try:
+            yield self.runCommand(cmd)
+            writer.cancel()
+            extracted, deleted, raw = yield writer.result
+            self.transferred = ('upload', writer.compressed)
+            if not cmd.didFail():
+                messages.append('applied: %d entries extracted, %d deleted' % (extracted, deleted))
+                messages.append(treesync.describe_transfer(
+                    raw, writer.compressed if self.transfer.compression else None, time.time() - started))
+                yield threads.deferToThread(self._commit, generation, messages)
+                result = buildbot.process.results.SUCCESS
+        except Exception as e:
+            messages.append('error: %s' % e)
+        if result != buildbot.process.results.SUCCESS:
+            yield threads.deferToThread(self.store.discard, generation)
+        yield self.addCompleteLog('transfer', u''.join(m + '\n' for m in messages))
+        defer.returnValue(result)
+
+
+class _TreeSyncSourceStep(MasterThreadStep):
+    """
+    Prepares a pull from a store shared with the worker: the worker
+    reads the current generation and its manifest directly.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, paths=None, legacy=None, transfer=None, **kwargs):
+        self.store = store
+        self.builder = builder
+        self.channel = channel
+        self.paths = paths
+        self.legacy = legacy or []
+        self.transfer = transfer
+        MasterThreadStep.__init__(self, locks=[store.lock(builder, channel).access('counting')], **kwargs)
+
+    def sync(self):
+        source = self.store.import_legacy(self.builder, self.channel, self.legacy, self.paths)
+        if source:
+            self.progress('imported %s' % source)
+        generation = self.store.current(self.builder, self.channel)
+        if generation is None:
+            self.progress('no generation on the master yet')
+            self.sync_properties['treesync_source'] = ''
+            return buildbot.process.results.SUCCESS
+        _store_manifest(generation, self.paths, progress=self.progress)
+        self.progress('pulling %s' % generation)
+        self.sync_properties['treesync_source'] = self.transfer.worker_path(self.store, generation)
+        return buildbot.process.results.SUCCESS
+
+
+class _TreeSyncBeginStep(MasterThreadStep):
+    """
+    Creates the store generation a worker sharing the store pushes to.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, transfer=None, **kwargs):
+        self.store = store
+        self.builder = builder
+        self.channel = channel
+        self.transfer = transfer
+        MasterThreadStep.__init__(self, locks=[store.lock(builder, channel).access('exclusive')], **kwargs)
+
+    def sync(self):
+        generation = self.store.begin(self.builder, self.channel)
+        self.progress('writing %s' % generation)
+        self.sync_properties['treesync_generation'] = generation
+        self.sync_properties['treesync_target'] = self.transfer.worker_path(self.store, generation)
+        return buildbot.process.results.SUCCESS
+
+
+class _TreeSyncCommitStep(MasterThreadStep):
+    """
+    Commits the generation written by a worker sharing the store,
+    or discards it when the worker failed to write it.  Like the
+    streaming transfer, only the result of the copy step copy_name
+    matters, not the result of the build: a failure elsewhere in the
+    build does not discard what was written.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, paths=None, copy_name=None, prepare=None, **kwargs):
+        self.store = store
+        self.builder = builder
+        self.channel = channel
+        self.paths = paths
+        self.copy_name = copy_name
+        self.prepare = prepare
+        MasterThreadStep.__init__(self, alwaysRun=True,
+                                  locks=[store.lock(builder, channel).access('exclusive')], **kwargs)
+
+    def _written(self):
+        # The copy step runs right before this one, unless the build
+        # stopped before it; its name has a suffix if it is not unique
+        executed = self.build.executedSteps
+        index = executed.index(self)
+        if index == 0:
+            return False
+        copy = executed[index - 1]
+        return copy.name.startswith(self.copy_name) and \
+            copy.results in (buildbot.process.results.SUCCESS, buildbot.process.results.WARNINGS)
+
+    def sync(self):
+        generation = self.getProperty('treesync_generation')
+        if not generation:
+            self.progress('no generation to commit')
+            return buildbot.process.results.FAILURE
+        # Another push in the same build sets it again
+        self.sync_properties['treesync_generation'] = ''
+        if not self._written():
+            self.store.discard(generation)
+            self.progress('discarded %s' % generation)
+            return buildbot.process.results.FAILURE
+        if self.prepare:
+            try:
+                self.prepare(generation, self.progress)
+            except Exception:
+                self.store.discard(generation)
+                self.progress('discarded %s' % generation)
+                raise
+        _store_manifest(generation, self.paths, progress=self.progress)
+        self.store.commit(self.builder, self.channel, generation)
+        self.progress('committed %s' % generation)
+        self.store.evict(self.builder, self.channel, progress=self.progress)
+        return buildbot.process.results.SUCCESS
+
+
+def _wait_step(label):
+    return steps.ShellCommand(
+        name='finish transfer of %s' % label,
+        haltOnFailure=True,
+        alwaysRun=True,
+        logEnviron=False,
+        command=['python3', SCRIPT, 'wait', '--status', STATUS, '--fifo', FIFO],
+    )
+
+
+class TreeSyncPullStep(steps.BuildStep):
+    """
+    This step brings the given paths on the worker up to date with
+    the current generation of an artifact store key, transferring only
+    what changed.  The key defaults to the name of the builder.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, paths=None, legacy=None, transfer=None, **kwargs):
+        self.store = store
+        self.builder = builder
+        self.channel = channel
+        self.paths = paths
+        self.legacy = legacy
+        self.transfer = transfer or TreeSyncTransfer()
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        builder = self.builder or self.getProperty('buildername')
+        label = ', '.join(self.paths)
+        base_manifest = _base_manifest(builder, self.channel)
+        worker_manifest = base_manifest + '.new'
+        list_steps = [
+            steps.FileDownload(
+                name='download treesync',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('treesync.py'),
+                workerdest=SCRIPT,
+            ),
+            steps.ShellCommand(
+                name='scan %s' % label,
+                haltOnFailure=True,
+                logEnviron=False,
+                command=['python3', SCRIPT, 'manifest', '--previous', base_manifest, '--output', worker_manifest] + self.paths,
+            ),
+        ]
+        if self.transfer.shared_path:
+            list_steps += [
+                _TreeSyncSourceStep(
+                    name='prepare pull of %s' % label,
+                    store=self.store,
+                    builder=builder,
+                    channel=self.channel,
+                    paths=self.paths,
+                    legacy=self.legacy,
+                    transfer=self.transfer,
+                ),
+                steps.ShellCommand(
+                    name='copy changes to %s' % label,
+                    haltOnFailure=True,
+                    logEnviron=False,
+                    locks=[self.store.lock(builder, self.channel).access('counting')],
+                    doStepIf=lambda step: bool(step.getProperty('treesync_source')),
+                    command=['python3', SCRIPT, '--root', util.Property('treesync_source'), 'pack',
+                             '--source-manifest', util.Interpolate('%(prop:treesync_source)s/' + STORE_MANIFEST),
+                             '--base', worker_manifest,
+                             '--target', '.', '--target-manifest', base_manifest] + self.paths,
+                ),
+            ]
+        else:
+            plan = {}
+            master_manifest = os.path.join(self.store.basedir, '.incoming', '%s-%s-%s-%s-worker.json' % (
+                self.getProperty('buildername'), self.getProperty('buildnumber'), builder, self.channel))
+            list_steps += [
+                steps.FileUpload(
+                    name='upload manifest of %s' % label,
+                    haltOnFailure=True,
+                    workersrc=worker_manifest,
+                    masterdest=master_manifest,
+                ),
+                _TreeSyncDeltaStep(
+                    name='compute delta of %s' % label,
+                    store=self.store,
+                    builder=builder,
+                    channel=self.channel,
+                    paths=self.paths,
+                    legacy=self.legacy,
+                    worker_manifest=master_manifest,
+                    plan=plan,
+                ),
+                steps.ShellCommand(
+                    name='prepare transfer of %s' % label,
+                    haltOnFailure=True,
+                    logEnviron=False,
+                    command=['python3', SCRIPT, 'apply', '--input', FIFO, '--background', STATUS,
+                             '--manifest-output', base_manifest] +
+                            (['--decompress'] if self.transfer.compression else []),
+                ),
+                _TreeSyncSendStep(
+                    name='send delta of %s' % label,
+                    store=self.store,
+                    builder=builder,
+                    channel=self.channel,
+                    plan=plan,
+                    transfer=self.transfer,
+                ),
+                _wait_step(label),
+            ]
+        list_steps.append(steps.ShellCommand(
+            name='clean up scan of %s' % label,
+            logEnviron=False,
+            command=['rm', '-f', worker_manifest],
+        ))
+        self.build.addStepsAfterCurrentStep(list_steps)
+        return buildbot.process.results.SUCCESS
+
+
+class TreeSyncPushStep(steps.BuildStep):
+    """
+    This step sends the changes made to the given paths on the worker
+    since the last pull to a new generation of an artifact store key.
+    The key defaults to the name of the builder.
+
+    prepare is called in a thread with the new generation and a
+    function to report progress, before the generation is committed.
+    What it removes is removed on the worker by its next pull.
+    """
+
+    def __init__(self, store=None, builder=None, channel=None, paths=None, transfer=None, prepare=None, **kwargs):
+        self.store = store
+        self.builder = builder
+        self.channel = channel
+        self.paths = paths
+        self.transfer = transfer or TreeSyncTransfer()
+        self.prepare = prepare
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        builder = self.builder or self.getProperty('buildername')
+        label = ', '.join(self.paths)
+        base_manifest = _base_manifest(builder, self.channel)
+        pack = ['python3', SCRIPT, 'pack', '--base', base_manifest, '--manifest-output', base_manifest + '.new']
+        list_steps = [
+            steps.FileDownload(
+                name='download treesync',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('treesync.py'),
+                workerdest=SCRIPT,
+            ),
+        ]
+        if self.transfer.shared_path:
+            list_steps += [
+                _TreeSyncBeginStep(
+                    name='prepare push of %s' % label,
+                    store=self.store,
+                    builder=builder,
+                    channel=self.channel,
+                    transfer=self.transfer,
+                ),
+                steps.ShellCommand(
+                    name='copy changes to %s' % label,
+                    haltOnFailure=True,
+                    logEnviron=False,
+                    locks=[self.store.lock(builder, self.channel).access('exclusive')],
+                    command=pack + ['--target', util.Property('treesync_target')] + self.paths,
+                ),
+                _TreeSyncCommitStep(
+                    name='commit push of %s' % label,
+                    store=self.store,
+                    builder=builder,
+                    channel=self.channel,
+                    paths=self.paths,
+                    copy_name='copy changes to %s' % label,
+                    prepare=self.prepare,
+                ),
+            ]
+        else:
+            list_steps += [
+                steps.ShellCommand(
+                    name='pack changes to %s' % label,
+                    haltOnFailure=True,
+                    logEnviron=False,
+                    command=pack + ['--output', FIFO, '--background', STATUS,
+                                    '--compress', str(self.transfer.compression)] + self.paths,
+                ),
+                _TreeSyncReceiveStep(
+                    name='receive delta of %s' % label,
+                    store=self.store,
+                    builder=builder,
+                    channel=self.channel,
+                    paths=self.paths,
+                    transfer=self.transfer,
+                    prepare=self.prepare,
+                ),
+                _wait_step(label),
+            ]
+        list_steps.append(steps.ShellCommand(
+            name='update baseline of %s' % label,
+            haltOnFailure=True,
+            logEnviron=False,
+            command=['mv', base_manifest + '.new', base_manifest],
+        ))
+        self.build.addStepsAfterCurrentStep(list_steps)
+        return buildbot.process.results.SUCCESS
+
+
+class TreeSyncBaselineStep(steps.BuildStep):
+    """
+    This step records the given paths on the worker as the baseline
+    of the next push, for trees brought up to date by other means
+    than a pull, such as "ostree pull".
+    """
+
+    def __init__(self, builder=None, channel=None, paths=None, **kwargs):
+        self.builder = builder
+        self.channel = channel
+        self.paths = paths
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        builder = self.builder or self.getProperty('buildername')
+        base_manifest = _base_manifest(builder, self.channel)
+        self.build.addStepsAfterCurrentStep([
+            steps.FileDownload(
+                name='download treesync',
+                haltOnFailure=True,
+                mastersrc=utils.config_path('treesync.py'),
+                workerdest=SCRIPT,
+            ),
+            steps.ShellCommand(
+                name='scan %s' % ', '.join(self.paths),
+                haltOnFailure=True,
+                logEnviron=False,
+                command=['python3', SCRIPT, 'manifest', '--previous', base_manifest, '--output', base_manifest] + self.paths,
+            ),
+        ])
+        return buildbot.process.results.SUCCESS
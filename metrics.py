@@ -0,0 +1,318 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Metrics of the build pipeline.
+
+MetricsService follows the builds and steps through the message queue
+and records, for each builder and step, how long requests waited for a
+worker, how long the steps took, how many bytes the transfer steps
+moved between the master and the workers, and which workers ran the
+builds.  Durations go into histograms with fixed buckets and the number
+of series is capped, so memory use is bounded whatever the uptime.
+
+The metrics are served in the Prometheus text format at /metrics,
+along with the "stats" dictionaries of the scheduling helpers (cache
+affinity, local worker pool, warm Docker workers).
+"""
+
+import os
+
+from buildbot import config
+from buildbot.process.results import Results
+from buildbot.steps import transfer
+from buildbot.util import service
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.web import resource, server
+
+__all__ = [
+    'Histogram',
+    'MetricsService',
+]
+
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 2*60, 5*60, 10*60, 20*60, 30*60, 60*60, 2*60*60, 4*60*60)
+
+
+def _result_name(results):
+    if results is None:
+        return 'unknown'
+    return Results[results]
+
+
+def _escape(value):
+    value = u'%s' % value if value is not None else u''
+    return value.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return u''
+    return u'{%s}' % u','.join(u'%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _number(value):
+    if value == float('inf'):
+        return u'+Inf'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return u'%s' % value
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed buckets.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def lines(self, name, labelnames, labelvalues):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield u'%s_bucket%s %d' % (name, _labels(labelnames + ('le',), labelvalues + (_number(bound),)),
+                                       cumulative)
+        yield u'%s_sum%s %s' % (name, _labels(labelnames, labelvalues), _number(self.sum))
+        yield u'%s_count%s %d' % (name, _labels(labelnames, labelvalues), self.count)
+
+
+class _Family(object):
+    """
+    Series of a metric by label values, at most max_series of them.
+    """
+
+    def __init__(self, name, kind, doc, labelnames, max_series, factory=None):
+        self.name = name
+        self.kind = kind
+        self.doc = doc
+        self.labelnames = labelnames
+        self.max_series = max_series
+        self.factory = factory
+        self.series = {}
+        self.dropped = 0
+
+    def _get(self, labelvalues, default):
+        if labelvalues not in self.series:
+            if len(self.series) >= self.max_series:
+                self.dropped += 1
+                return None
+            self.series[labelvalues] = default()
+        return self.series[labelvalues]
+
+    def observe(self, labelvalues, value):
+        histogram = self._get(labelvalues, self.factory)
+        if histogram is not None:
+            histogram.observe(value)
+
+    def inc(self, labelvalues, value=1):
+        if self._get(labelvalues, lambda: 0) is not None:
+            self.series[labelvalues] += value
+
+    def lines(self):
+        yield u'# HELP %s %s' % (self.name, self.doc)
+        yield u'# TYPE %s %s' % (self.name, self.kind)
+        for labelvalues in sorted(self.series):
+            value = self.series[labelvalues]
+            if self.kind == 'histogram':
+                for line in value.lines(self.name, self.labelnames, labelvalues):
+                    yield line
+            else:
+                yield u'%s%s %s' % (self.name, _labels(self.labelnames, labelvalues), _number(value))
+
+
+def _transferred(step):
+    """
+    Returns the direction and the number of bytes a step moved
+    between the master and the worker, or None.
+    """
+    try:
+        if isinstance(step, transfer.FileDownload):
+            return 'download', os.path.getsize(step.mastersrc)
+        if isinstance(step, transfer.FileUpload):
+            return 'upload', os.path.getsize(step.masterdest)
+    except (OSError, TypeError):
+        return None
+    # Steps with their own transfer protocol, such as the tree syncs
+    return getattr(step, 'transferred', None)
+
+
+class _MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, service):
+        resource.Resource.__init__(self)
+        self.service = service
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.service.render().encode('utf-8')
+
+
+class MetricsService(service.BuildbotService):
+    """
+    Records build and step metrics and serves them over HTTP.
+
+    sources maps names to objects with a "stats" dictionary, whose
+    numeric values are exported as the liri_stats gauge.  Steps that
+    move data with their own protocol can set their "transferred"
+    attribute to a (direction, bytes) tuple.
+    """
+
+    name = 'metrics'
+    listening = None
+
+    def checkConfig(self, port=8011, interface='', sources=None, max_series=2000, buckets=DURATION_BUCKETS):
+        if max_series < 1:
+            config.error('MetricsService max_series must be at least 1')
+
+    @defer.inlineCallbacks
+    def reconfigService(self, port=8011, interface='', sources=None, max_series=2000, buckets=DURATION_BUCKETS):
+        self.sources = sources or {}
+        if getattr(self, 'families', None) is None or self.max_series != max_series or self.buckets != buckets:
+            self._create_families(max_series, buckets)
+        if getattr(self, 'names', None) is None:
+            self.names = {}
+        if self.listening is not None:
+            yield self.listening.stopListening()
+        root = resource.Resource()
+        root.putChild(b'metrics', _MetricsResource(self))
+        self.listening = reactor.listenTCP(port, server.Site(root), interface=interface)
+
+    def _create_families(self, max_series, buckets):
+        self.max_series = max_series
+        self.buckets = buckets
+        histogram = lambda: Histogram(buckets)
+        self.families = dict((family.name, family) for family in [
+            _Family('buildbot_build_queue_seconds', 'histogram',
+                    'Time from the submission of a build request to the start of its build.',
+                    ('builder',), max_series, histogram),
+            _Family('buildbot_build_duration_seconds', 'histogram', 'Duration of the builds.',
+                    ('builder',), max_series, histogram),
+            _Family('buildbot_builds_total', 'counter', 'Finished builds by worker and result.',
+                    ('builder', 'worker', 'result'), max_series),
+            _Family('buildbot_step_duration_seconds', 'histogram', 'Duration of the steps.',
+                    ('builder', 'step'), max_series, histogram),
+            _Family('buildbot_step_results_total', 'counter', 'Finished steps by result.',
+                    ('builder', 'step', 'result'), max_series),
+            _Family('buildbot_step_transfer_bytes_total', 'counter',
+                    'Bytes moved between the master and the workers by the transfer steps.',
+                    ('builder', 'step', 'direction'), max_series),
+        ])
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        startConsuming = self.master.mq.startConsuming
+        self.consumers = [
+            (yield startConsuming(self.buildStarted, ('builds', None, 'new'))),
+            (yield startConsuming(self.buildFinished, ('builds', None, 'finished'))),
+            (yield startConsuming(self.stepFinished, ('steps', None, 'finished'))),
+        ]
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        for consumer in getattr(self, 'consumers', []):
+            yield consumer.stopConsuming()
+        self.consumers = []
+        if self.listening is not None:
+            yield self.listening.stopListening()
+            self.listening = None
+        yield service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def _name(self, kind, id):
+        """
+        Returns the name of a builder or worker, they are kept
+        since the same few of them come up in every event.
+        """
+        if id is None:
+            defer.returnValue(None)
+            return
+        if (kind, id) not in self.names:
+            entity = yield self.master.data.get((kind, id))
+            if entity is None:
+                defer.returnValue(None)
+                return
+            self.names[(kind, id)] = entity['name']
+        defer.returnValue(self.names[(kind, id)])
+
+    @defer.inlineCallbacks
+    def buildStarted(self, key, build):
+        try:
+            builder = yield self._name('builders', build['builderid'])
+            request = yield self.master.data.get(('buildrequests', build['buildrequestid']))
+            if request and request.get('submitted_at') and build.get('started_at'):
+                waited = (build['started_at'] - request['submitted_at']).total_seconds()
+                self.families['buildbot_build_queue_seconds'].observe((builder,), max(waited, 0))
+        except Exception as e:
+            log.err(e, 'while recording the queue time of build %s' % build.get('buildid'))
+
+    @defer.inlineCallbacks
+    def buildFinished(self, key, build):
+        try:
+            builder = yield self._name('builders', build['builderid'])
+            worker = yield self._name('workers', build['workerid'])
+            result = _result_name(build.get('results'))
+            self.families['buildbot_builds_total'].inc((builder, worker, result))
+            if build.get('started_at') and build.get('complete_at'):
+                self.families['buildbot_build_duration_seconds'].observe(
+                    (builder,), (build['complete_at'] - build['started_at']).total_seconds())
+        except Exception as e:
+            log.err(e, 'while recording build %s' % build.get('buildid'))
+
+    def _running_step(self, builder, stepid):
+        buildbot_builder = self.master.botmaster.builders.get(builder)
+        if buildbot_builder is None:
+            return None
+        for build in buildbot_builder.building:
+            for step in build.executedSteps:
+                if step.stepid == stepid:
+                    return step
+        return None
+
+    @defer.inlineCallbacks
+    def stepFinished(self, key, step):
+        try:
+            build = yield self.master.data.get(('builds', step['buildid']))
+            builder = yield self._name('builders', build['builderid'])
+            name = step['name']
+            self.families['buildbot_step_results_total'].inc((builder, name, _result_name(step.get('results'))))
+            if step.get('started_at') and step.get('complete_at'):
+                self.families['buildbot_step_duration_seconds'].observe(
+                    (builder, name), (step['complete_at'] - step['started_at']).total_seconds())
+            moved = _transferred(self._running_step(builder, step['stepid']))
+            if moved is not None:
+                direction, size = moved
+                self.families['buildbot_step_transfer_bytes_total'].inc((builder, name, direction), size)
+        except Exception as e:
+            log.err(e, 'while recording step %s' % step.get('stepid'))
+
+    def render(self):
+        lines = []
+        for name in sorted(self.families):
+            lines.extend(self.families[name].lines())
+        lines.append(u'# HELP liri_stats Statistics of the scheduling helpers.')
+        lines.append(u'# TYPE liri_stats gauge')
+        for source in sorted(self.sources):
+            # Workers only have statistics once they are configured
+            stats = getattr(self.sources[source], 'stats', None) or {}
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(u'liri_stats%s %s' % (_labels(('source', 'key'), (source, key)), _number(value)))
+        dropped = sum(family.dropped for family in self.families.values())
+        lines.append(u'# HELP liri_metrics_dropped_total Observations dropped because of the series limit.')
+        lines.append(u'# TYPE liri_metrics_dropped_total counter')
+        lines.append(u'liri_metrics_dropped_total %d' % dropped)
+        return u'\n'.join(lines) + u'\n'
@@ -0,0 +1,232 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Build notifications posted to a Slack webhook.
+
+The nightly builds finish close together, so instead of one message per
+build SlackDigestReporter queues the finished builds and, after a short
+coalescing window, posts a single digest for all of them.  Messages are
+spaced by a minimum interval and retried with backoff; those that still
+fail, and the builds pushed out of the bounded queue, are written to a
+dead-letter log so that nothing is lost silently.
+
+scripts/webhookecho.py is a local stand-in for the webhook, to try the
+reporter against an endpoint that is slow or fails.
+"""
+
+import calendar
+import collections
+import json
+import time
+
+from buildbot import config
+from buildbot.process.results import SUCCESS, WARNINGS
+from buildbot.reporters import utils
+from buildbot.util import asyncSleep, service
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from liribotcfg import webhooks
+
+__all__ = [
+    'SlackDigestReporter',
+    'format_build',
+    'format_digest',
+]
+
+
+def _property(build, name):
+    """
+    Returns the value of a build property, or None when it is
+    missing or empty.
+    """
+    value = (build.get('properties') or {}).get(name)
+    if not value:
+        return None
+    return value[0] or None
+
+
+def format_build(build):
+    """
+    Returns the Slack attachment describing a finished build.
+    """
+    if _property(build, 'ostree_noop'):
+        status, color = 'No changes', 'good'
+    elif build.get('results') == SUCCESS:
+        status, color = 'Success', 'good'
+    elif build.get('results') == WARNINGS:
+        status, color = 'Warnings', 'warning'
+    else:
+        status, color = 'Failure', 'danger'
+    project = _property(build, 'project') or _property(build, 'buildername') or \
+        (build.get('builder') or {}).get('name') or 'build %s' % build.get('buildid')
+    message = u'New build for {project}\nStatus: *{status}*\nBuild details: {url}'.format(
+        project=project, status=status, url=build.get('url') or '')
+    fields = []
+    for title, name in (('Repository', 'repository'), ('Branch', 'branch')):
+        value = _property(build, name)
+        if value:
+            fields.append(dict(title=title, value=value, short=True))
+    return dict(
+        fallback=message,
+        text=message,
+        color=color,
+        mrkdwn_in=['text', 'title', 'fallback'],
+        fields=fields,
+    )
+
+
+def format_digest(attachments):
+    """
+    Returns the Slack message for the attachments of one or more builds.
+    """
+    if len(attachments) == 1:
+        text = ' '
+    else:
+        failed = len([a for a in attachments if a['color'] == 'danger'])
+        text = '%d builds finished' % len(attachments)
+        if failed:
+            text += ', %d failed' % failed
+    return dict(text=text, attachments=attachments)
+
+
+class SlackDigestReporter(service.BuildbotService):
+    """
+    Posts the finished builds to a Slack webhook in digests.
+
+    Builds are collected for window seconds after the first one
+    finishes, then posted max_builds per message, at most one message
+    every min_interval seconds.  At most max_queue builds wait at any
+    time, older ones go to the dead-letter log at dead_letter.  The
+    "stats" dictionary has the queue depth and the delivery latency,
+    from the end of a build to the delivery of its message.
+    """
+
+    name = 'SlackDigestReporter'
+    secrets = ['url']
+
+    def checkConfig(self, url, builders=None, window=60, max_builds=20, max_queue=200, min_interval=1.0,
+                    retries=3, backoff=2.0, timeout=30, dead_letter='slack-dead-letter.log'):
+        if not url:
+            config.error('SlackDigestReporter needs a webhook URL')
+        if max_builds < 1 or max_queue < 1:
+            config.error('SlackDigestReporter max_builds and max_queue must be at least 1')
+
+    @defer.inlineCallbacks
+    def reconfigService(self, url, builders=None, window=60, max_builds=20, max_queue=200, min_interval=1.0,
+                        retries=3, backoff=2.0, timeout=30, dead_letter='slack-dead-letter.log'):
+        yield service.BuildbotService.reconfigService(self)
+        self.url = url
+        self.builders = builders
+        self.window = window
+        self.max_builds = max_builds
+        self.min_interval = min_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.dead_letter = dead_letter
+        if getattr(self, 'queue', None) is None:
+            self.queue = collections.deque()
+            self.timer = None
+            self.sending = False
+            self.next_post = 0
+            self.stats = {
+                'queue_depth': 0,
+                'queued_builds': 0,
+                'delivered_builds': 0,
+                'delivered_messages': 0,
+                'failed_messages': 0,
+                'dead_letter_builds': 0,
+                'last_latency_seconds': 0,
+                'max_latency_seconds': 0,
+            }
+        self.max_queue = max_queue
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        self.consumer = yield self.master.mq.startConsuming(self.buildFinished, ('builds', None, 'finished'))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if getattr(self, 'consumer', None) is not None:
+            yield self.consumer.stopConsuming()
+            self.consumer = None
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        # What is left would be lost with the master
+        if self.queue:
+            self._dead_letter(list(self.queue), 'master stopped')
+            self.queue.clear()
+            self.stats['queue_depth'] = 0
+        yield service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def buildFinished(self, key, build):
+        try:
+            yield utils.getDetailsForBuild(self.master, build, wantProperties=True)
+            if self.builders is not None and build['builder']['name'] not in self.builders:
+                return
+            self._enqueue(build.get('complete_at'), format_build(build))
+        except Exception as e:
+            log.err(e, 'while queueing the notification of build %s' % build.get('buildid'))
+
+    def _enqueue(self, complete_at, attachment):
+        finished = time.time()
+        if complete_at is not None:
+            finished = min(calendar.timegm(complete_at.utctimetuple()), finished)
+        if len(self.queue) >= self.max_queue:
+            self._dead_letter([self.queue.popleft()], 'queue full')
+        self.queue.append((finished, attachment))
+        self.stats['queued_builds'] += 1
+        self.stats['queue_depth'] = len(self.queue)
+        if not self.sending and self.timer is None:
+            self.timer = reactor.callLater(self.window, self._flush)
+
+    def _dead_letter(self, entries, reason):
+        self.stats['dead_letter_builds'] += len(entries)
+        log.msg('SlackDigestReporter: %d notifications not delivered (%s)' % (len(entries), reason))
+        try:
+            with open(self.dead_letter, 'a') as f:
+                f.write(json.dumps({
+                    'time': time.time(),
+                    'reason': reason,
+                    'message': format_digest([attachment for finished, attachment in entries]),
+                }) + '\n')
+        except (IOError, OSError) as e:
+            log.err(e, 'while writing the dead-letter log %s' % self.dead_letter)
+
+    @defer.inlineCallbacks
+    def _flush(self):
+        self.timer = None
+        self.sending = True
+        try:
+            while self.queue:
+                entries = [self.queue.popleft() for i in range(min(self.max_builds, len(self.queue)))]
+                self.stats['queue_depth'] = len(self.queue)
+                wait = self.next_post - time.time()
+                if wait > 0:
+                    yield asyncSleep(wait)
+                try:
+                    result = yield webhooks.post(
+                        self.url, names=['slack'], retries=self.retries, backoff=self.backoff,
+                        timeout=self.timeout, json=format_digest([attachment for finished, attachment in entries]))
+                except Exception as e:
+                    log.err(e, 'while posting the build notifications')
+                    result = None
+                self.next_post = time.time() + self.min_interval
+                if result is None or not result.ok:
+                    self.stats['failed_messages'] += 1
+                    self._dead_letter(entries, result.describe() if result else 'internal error')
+                    continue
+                delivered = time.time()
+                latency = max(delivered - min(finished for finished, attachment in entries), 0)
+                self.stats['delivered_messages'] += 1
+                self.stats['delivered_builds'] += len(entries)
+                self.stats['last_latency_seconds'] = latency
+                self.stats['max_latency_seconds'] = max(self.stats['max_latency_seconds'], latency)
+        finally:
+            self.sending = False
+            self.stats['queue_depth'] = len(self.queue)
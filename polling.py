@@ -0,0 +1,184 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Batched polling of the git repositories.
+
+Each repository keeps its GitPoller, which fetches and creates the
+changes, but with a long fallback interval.  BatchedGitPoller fetches
+the polled branches of all the repositories with a single "git fetch
+--multiple" into a bare repository of its own, and only wakes up the
+pollers of the repositories whose branches moved.
+
+GitHubPushHandler wakes up the poller of a repository as soon as
+GitHub sends a push event, instead of creating the changes itself.
+"""
+
+import os
+import re
+
+from buildbot import config
+from buildbot.changes import base
+from buildbot.www.hooks.github import GitHubEventHandler
+from twisted.internet import defer, utils
+from twisted.python import log
+
+__all__ = [
+    'BatchedGitPoller',
+    'GitHubPushHandler',
+]
+
+
+def normalize_url(url):
+    """
+    Returns a form of the repository URL that is the same for
+    the clone and web URLs of a GitHub repository.
+    """
+    url = re.sub(r'^[a-z+]+://', '', url.strip().lower())
+    url = re.sub(r'^[^@/]+@', '', url).replace(':', '/')
+    return re.sub(r'(\.git)?/*$', '', url)
+
+
+def _branches(poller):
+    if isinstance(poller.branches, list):
+        return poller.branches
+    return [poller.branch or 'master']
+
+
+def remote_name(url):
+    """
+    Returns the name of the remote of url in the batched repository.
+    """
+    # Never an option of git fetch
+    return re.sub(r'[^a-z0-9_.-]+', '-', normalize_url(url)).strip('-.')
+
+
+class BatchedGitPoller(base.ReconfigurablePollingChangeSource):
+    """
+    Polls the repositories of the named GitPollers together.
+    """
+
+    name = 'batched-git-poller'
+
+    def checkConfig(self, pollerNames, pollInterval=5*60, pollAtLaunch=True, concurrency=4,
+                    workdir='gitpoller/batched'):
+        base.ReconfigurablePollingChangeSource.checkConfig(self, name=self.name, pollInterval=pollInterval,
+                                                           pollAtLaunch=pollAtLaunch)
+        if not pollerNames:
+            config.error('BatchedGitPoller needs at least one GitPoller')
+        if concurrency < 1:
+            config.error('BatchedGitPoller concurrency must be at least 1')
+
+    @defer.inlineCallbacks
+    def reconfigService(self, pollerNames, pollInterval=5*60, pollAtLaunch=True, concurrency=4,
+                        workdir='gitpoller/batched'):
+        self.pollerNames = pollerNames
+        self.concurrency = concurrency
+        self.workdir = workdir
+        yield base.ReconfigurablePollingChangeSource.reconfigService(self, name=self.name,
+                                                                     pollInterval=pollInterval,
+                                                                     pollAtLaunch=pollAtLaunch)
+
+    def describe(self):
+        return 'BatchedGitPoller watching %d repositories' % len(self.pollerNames)
+
+    def pollers(self):
+        services = self.master.change_svc.namedServices
+        return [services[name] for name in self.pollerNames if name in services]
+
+    @defer.inlineCallbacks
+    def git(self, args, path=None):
+        """
+        Runs git, returns its output, its error output and its exit code.
+        """
+        out, err, code = yield utils.getProcessOutputAndValue('git', args, env=os.environ, path=path)
+        defer.returnValue((out.decode('utf-8', 'replace'), err.decode('utf-8', 'replace'), code))
+
+    @defer.inlineCallbacks
+    def remote_revisions(self, pollers):
+        """
+        Fetches the branches of the pollers, returns the revision of
+        each branch by remote name.  The remotes that cannot be
+        fetched are missing.
+        """
+        path = self.workdir
+        if not os.path.isabs(path):
+            path = os.path.join(self.master.basedir, path)
+        if not os.path.exists(os.path.join(path, 'HEAD')):
+            out, err, code = yield self.git(['init', '--bare', path])
+            if code != 0:
+                raise EnvironmentError('git init %s failed: %s' % (path, err))
+        # The remotes only exist on the command line of the fetch
+        args = []
+        names = []
+        for poller in pollers:
+            name = remote_name(poller.repourl)
+            if name in names:
+                continue
+            names.append(name)
+            args += ['-c', 'remote.%s.url=%s' % (name, poller.repourl)]
+            for branch in _branches(poller):
+                args += ['-c', 'remote.%s.fetch=+refs/heads/%s:refs/batched/%s/%s' % (name, branch, name, branch)]
+        out, err, code = yield self.git(args + ['fetch', '--multiple', '--no-tags', '--quiet',
+                                                '--jobs=%d' % self.concurrency] + names, path=path)
+        failed = set(re.findall(r"could not fetch '([^']+)'", err))
+        if code != 0:
+            log.msg('batchedgitpoller: fetch failed for %s: %s' % (', '.join(sorted(failed)) or 'all', err.strip()))
+            if not failed:
+                failed = set(names)
+        out, err, code = yield self.git(['for-each-ref', '--format=%(objectname) %(refname)', 'refs/batched/'],
+                                        path=path)
+        if code != 0:
+            raise EnvironmentError('git for-each-ref failed: %s' % err)
+        revisions = dict((name, {}) for name in names if name not in failed)
+        for line in out.splitlines():
+            sha, _, ref = line.partition(' ')
+            name, _, branch = ref[len('refs/batched/'):].partition('/')
+            if name in revisions:
+                revisions[name][branch] = sha
+        defer.returnValue(revisions)
+
+    @defer.inlineCallbacks
+    def poll(self):
+        pollers = self.pollers()
+        try:
+            revisions = yield self.remote_revisions(pollers)
+        except Exception as e:
+            log.err(e, 'while fetching the polled repositories')
+            return
+        for poller in pollers:
+            branches = revisions.get(remote_name(poller.repourl), {})
+            moved = [branch for branch, sha in branches.items()
+                     if branch in _branches(poller) and poller.lastRev.get(branch) != sha]
+            if moved:
+                log.msg('batchedgitpoller: %s moved in %s' % (', '.join(sorted(moved)), poller.repourl))
+                poller.force()
+
+    def notify(self, url):
+        """
+        Polls the repository at url now, returns whether
+        it is one of the polled repositories.
+        """
+        found = False
+        for poller in self.pollers():
+            if normalize_url(poller.repourl) == normalize_url(url):
+                log.msg('batchedgitpoller: push notification for %s' % poller.repourl)
+                poller.force()
+                found = True
+        return found
+
+
+class GitHubPushHandler(GitHubEventHandler):
+    """
+    GitHub webhook handler that polls the pushed repository
+    right away, the poller then creates the changes.
+    """
+
+    def handle_push(self, payload, event):
+        repository = payload['repository']
+        poller = self.master.change_svc.namedServices.get(BatchedGitPoller.name)
+        if poller is None:
+            log.msg('githubpushhandler: no batched poller, ignoring push to %s' % repository['html_url'])
+        elif not poller.notify(repository['clone_url']):
+            log.msg('githubpushhandler: %s is not polled' % repository['html_url'])
+        return [], 'git'
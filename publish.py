@@ -0,0 +1,343 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Zero-downtime publishing of OSTree repositories.
+
+The published path is a symbolic link to a generation directory next
+to it.  A new generation is staged by hard linking the objects that
+the live generation already has, then the link is replaced with a
+single rename, so clients always see a complete repository.  The
+generation that would be removed after the swap is staged again,
+keeping the objects it shares with the new one, so that only the
+objects published since then are linked.
+
+Flatpak repositories are brought up to date in the staged generation,
+before the swap: appstream data, static deltas for the refs that
+changed, pruning of old commits, then the summary.  The repository
+they are staged from must be pruned to the same depth, see
+prune_repo(): the objects it still has are linked again when a
+retired generation is staged.
+"""
+
+import errno
+import os
+import shutil
+import subprocess
+import time
+
+from liribotcfg import treesync
+
+__all__ = [
+    'carry_deltas',
+    'prune_repo',
+    'publish_repo',
+    'read_refs',
+    'update_flatpak_repo',
+]
+
+
+def _generation_prefix(live):
+    return os.path.basename(live) + '-'
+
+
+def _generations(live):
+    """
+    Returns the generations of live, oldest first: they are numbered
+    in sequence, whatever the clock says.
+    """
+    parent = os.path.dirname(live)
+    prefix = _generation_prefix(live)
+    names = [name for name in os.listdir(parent) if name.startswith(prefix) and name[len(prefix):].isdigit()]
+    paths = [os.path.join(parent, name) for name in sorted(names, key=lambda name: int(name[len(prefix):]))]
+    return [path for path in paths if os.path.isdir(path) and not os.path.islink(path)]
+
+
+def _next_generation(live):
+    generations = _generations(live)
+    number = int(os.path.basename(generations[-1])[len(_generation_prefix(live)):]) + 1 if generations else 1
+    return os.path.join(os.path.dirname(live), _generation_prefix(live) + '%08d' % number)
+
+
+def _link_or_copy(src, dst, stats):
+    try:
+        os.link(src, dst)
+        stats['linked'] += 1
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+        stats['copied'] += 1
+        stats['copied_bytes'] += os.path.getsize(dst)
+
+
+def _objects(repo):
+    """
+    Returns the relative paths of the objects of a repository.
+    """
+    objects = set()
+    top = os.path.join(repo, 'objects')
+    if not os.path.isdir(top):
+        return objects
+    for prefix in os.listdir(top):
+        if os.path.isdir(os.path.join(top, prefix)):
+            objects.update('objects/%s/%s' % (prefix, name) for name in os.listdir(os.path.join(top, prefix)))
+    return objects
+
+
+def _stage_object(source, current, staged, relpath, stats):
+    srcpath = os.path.join(source, relpath)
+    dstpath = os.path.join(staged, relpath)
+    if not os.path.isdir(os.path.dirname(dstpath)):
+        os.makedirs(os.path.dirname(dstpath))
+    # Objects never change once written, share them with the live generation
+    livepath = os.path.join(current, relpath) if current else None
+    if livepath and os.path.isfile(livepath) and os.path.getsize(livepath) == os.path.getsize(srcpath):
+        os.link(livepath, dstpath)
+        stats['reused'] += 1
+    else:
+        _link_or_copy(srcpath, dstpath, stats)
+
+
+def _stage(source, current, staged, progress=None):
+    """
+    Stages source in staged, which may be an older generation.  Its
+    objects that source still has are kept, the others are removed,
+    everything else is replaced.
+    """
+    stats = {'kept': 0, 'removed': 0, 'linked': 0, 'reused': 0, 'copied': 0, 'copied_bytes': 0}
+    if not os.path.isdir(staged):
+        os.makedirs(staged)
+    # Refs, config and summary are small and may be rewritten in place, the
+    # static deltas are carried from the live generation
+    for name in os.listdir(staged):
+        if name != 'objects':
+            path = os.path.join(staged, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+    wanted = _objects(source)
+    have = _objects(staged)
+    for relpath in have - wanted:
+        os.unlink(os.path.join(staged, relpath))
+        stats['removed'] += 1
+    stats['kept'] = len(have & wanted)
+    for relpath in sorted(wanted - have):
+        _stage_object(source, current, staged, relpath, stats)
+    for dirpath, dirnames, filenames in os.walk(source):
+        reldir = os.path.relpath(dirpath, source)
+        if reldir == '.' and 'objects' in dirnames:
+            dirnames.remove('objects')
+        stagedir = os.path.normpath(os.path.join(staged, reldir))
+        if not os.path.isdir(stagedir):
+            os.makedirs(stagedir)
+        for name in dirnames + filenames:
+            srcpath = os.path.join(dirpath, name)
+            dstpath = os.path.join(stagedir, name)
+            if os.path.islink(srcpath):
+                os.symlink(os.readlink(srcpath), dstpath)
+            elif not os.path.isdir(srcpath):
+                shutil.copy2(srcpath, dstpath)
+                stats['copied'] += 1
+                stats['copied_bytes'] += os.path.getsize(dstpath)
+    return stats
+
+
+def _swap(live, staged, progress=None):
+    """
+    Points live to staged, replacing the link atomically.
+    """
+    if os.path.isdir(live) and not os.path.islink(live):
+        # Repository published before generations were introduced
+        legacy = os.path.join(os.path.dirname(live), _generation_prefix(live) + '0')
+        if progress:
+            progress('moving %s to %s' % (live, legacy))
+        os.rename(live, legacy)
+    tmplink = live + '.new'
+    if os.path.lexists(tmplink):
+        os.unlink(tmplink)
+    os.symlink(os.path.basename(staged), tmplink)
+    os.rename(tmplink, live)
+
+
+def read_refs(repo):
+    """
+    Returns the commit of each branch of an OSTree repository.
+    """
+    refs = {}
+    heads = os.path.join(repo, 'refs', 'heads')
+    for dirpath, dirnames, filenames in os.walk(heads):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, 'r') as f:
+                refs[os.path.relpath(path, heads).replace(os.sep, '/')] = f.read().strip()
+    return refs
+
+
+class _Phase(object):
+    """
+    Reports how long a part of the repository update takes.
+    """
+
+    def __init__(self, name, progress):
+        self.name = name
+        self.progress = progress
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.progress:
+            self.progress('%s: %.1f s%s' % (self.name, time.time() - self.started,
+                                            ' (failed)' if exc_type else ''))
+
+
+def _run(command, progress=None):
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT, universal_newlines=True)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise OSError(e.errno, '%s is not installed on the master' % command[0])
+    if progress:
+        for line in output.splitlines():
+            progress('  ' + line)
+
+
+def _channel(ref):
+    # Flatpak refs are app/<id>/<arch>/<branch>, the branch is the channel
+    parts = ref.split('/')
+    return parts[3] if len(parts) == 4 else None
+
+
+def carry_deltas(current, staged):
+    """
+    Links the static deltas of the live generation into the staged
+    one, the artifact store does not have them.
+    """
+    linked = 0
+    for subdir in ('deltas', 'delta-indexes'):
+        source = os.path.join(current, subdir)
+        for dirpath, dirnames, filenames in os.walk(source):
+            stagedir = os.path.join(staged, subdir, os.path.relpath(dirpath, source))
+            if not os.path.isdir(stagedir):
+                os.makedirs(stagedir)
+            for name in filenames:
+                dstpath = os.path.join(stagedir, name)
+                if not os.path.lexists(dstpath):
+                    # Deltas never change once generated
+                    os.link(os.path.join(dirpath, name), dstpath)
+                    linked += 1
+    return linked
+
+
+def prune_repo(repo, prune_depth, progress=None):
+    """
+    Prunes the commits of each Flatpak ref beyond the depth of its
+    channel in prune_depth, the refs themselves are not changed.
+    """
+    with _Phase('prune', progress):
+        for ref in sorted(read_refs(repo)):
+            depth = prune_depth.get(_channel(ref))
+            if depth is None:
+                continue
+            _run(['ostree', 'prune', '--repo=' + repo, '--refs-only', '--depth=%d' % depth,
+                  '--only-branch=' + ref], progress)
+
+
+def update_flatpak_repo(repo, previous_refs, prune_depth=None, gpg_key=None, gpg_homedir=None, progress=None):
+    """
+    Updates the appstream data, the static deltas of the refs that
+    changed since previous_refs, prunes the commits beyond the depth
+    of their channel in prune_depth, and updates the summary.
+
+    The summary is signed with the key the builds use, when it cannot
+    be signed only the static deltas are updated: the appstream data
+    and pruning change the refs, which the old summary would not list.
+    Returns the refs that changed and whether the summary was updated.
+    """
+    sign = []
+    if gpg_key:
+        if gpg_homedir:
+            sign = ['--gpg-sign=' + gpg_key, '--gpg-homedir=' + gpg_homedir]
+        else:
+            if progress:
+                progress('appstream, pruning and summary skipped: no GPG home directory to sign it on the master')
+            sign = None
+    if sign is not None:
+        with _Phase('appstream', progress):
+            _run(['flatpak', 'build-update-repo', '--no-update-summary', repo], progress)
+    refs = read_refs(repo)
+    changed = sorted(ref for ref, commit in refs.items() if previous_refs.get(ref) != commit)
+    with _Phase('static deltas for %d changed refs' % len(changed), progress):
+        for ref in changed:
+            command = ['ostree', 'static-delta', 'generate', '--repo=' + repo, '--to=' + refs[ref]]
+            if ref in previous_refs:
+                # From the commit the clients have, which may not be the parent
+                command.append('--from=' + previous_refs[ref])
+            if progress:
+                progress('delta for %s' % ref)
+            try:
+                _run(command, progress)
+            except subprocess.CalledProcessError as e:
+                # The previous commit may have been pruned, fall back on the parent
+                if ref not in previous_refs:
+                    raise
+                if progress:
+                    progress('  %s' % e.output.strip())
+                _run(command[:-1], progress)
+    if prune_depth and sign is not None:
+        prune_repo(repo, prune_depth, progress=progress)
+    if sign is None:
+        return changed, False
+    with _Phase('summary', progress):
+        _run(['flatpak', 'build-update-repo', '--no-update-appstream'] + sign + [repo], progress)
+    return changed, True
+
+
+def publish_repo(source, live, keep=1, prepare=None, progress=None):
+    """
+    Publishes the repository in source at live.
+
+    Besides the new generation, the last keep generations are kept so
+    that clients in the middle of a pull can complete it.  prepare is
+    called with the staged generation and the live one, if any, before
+    the staged generation goes live.
+    Returns the publishing statistics.
+    """
+    parent = os.path.dirname(live)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    current = os.path.realpath(live) if os.path.isdir(live) else None
+    staged = _next_generation(live)
+    old = [path for path in _generations(live) if os.path.realpath(path) != current]
+    if os.path.islink(live) and old and len(old) >= keep:
+        # Removed after the swap anyway
+        if progress:
+            progress('staging %s again as %s' % (old[0], staged))
+        os.rename(old[0], staged)
+    elif progress:
+        progress('staging %s' % staged)
+    try:
+        stats = _stage(source, current, staged, progress=progress)
+        if progress:
+            progress(('%(kept)d objects kept, %(removed)d removed, %(reused)d reused from the live generation, '
+                      '%(linked)d linked and %(copied)d files copied') % stats +
+                     ' (%s)' % treesync.format_size(stats['copied_bytes']))
+        if prepare:
+            prepare(staged, current)
+    except Exception:
+        shutil.rmtree(staged, ignore_errors=True)
+        raise
+    _swap(live, staged, progress=progress)
+    if progress:
+        progress('%s now points to %s' % (live, os.path.basename(staged)))
+    live_target = os.path.realpath(live)
+    old = [path for path in _generations(live) if os.path.realpath(path) != live_target]
+    for path in old[:max(len(old) - keep, 0)]:
+        if progress:
+            progress('removing %s' % path)
+        shutil.rmtree(path, ignore_errors=True)
+    return stats
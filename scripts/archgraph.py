@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+#
+# Prints the dependency graph of Arch Linux packages as JSON.
+#
+# For each package directory it reports the package names it builds
+# (including provides), its dependencies without version constraints
+# and the hash of the directory in the HEAD commit, which changes
+# whenever a file of the package changes.
+#
+# Usage:
+#   archgraph.py DIRECTORY...
+#
+
+import json
+import re
+import subprocess
+import sys
+
+FIELDS = ['pkgname', 'provides', 'depends', 'makedepends', 'checkdepends']
+
+SCRIPT = '''
+source PKGBUILD >/dev/null 2>&1 || exit 1
+for field in %s; do
+    eval "values=(\\"\\${$field[@]}\\")"
+    echo "$field ${values[*]}"
+done
+''' % ' '.join(FIELDS)
+
+
+def strip_version(name):
+    return re.split(r'[<>=:]', name, 1)[0]
+
+
+def package_info(directory):
+    output = subprocess.check_output(['bash', '-c', SCRIPT], cwd=directory, universal_newlines=True)
+    info = dict((field, []) for field in FIELDS)
+    for line in output.splitlines():
+        field, _, values = line.partition(' ')
+        info[field] = [strip_version(value) for value in values.split()]
+    tree = subprocess.check_output(['git', 'rev-parse', 'HEAD:' + directory], universal_newlines=True)
+    return {
+        'names': sorted(set(info['pkgname'] + info['provides'])),
+        'depends': sorted(set(info['depends'] + info['makedepends'] + info['checkdepends'])),
+        'hash': tree.strip(),
+    }
+
+
+def main():
+    graph = {}
+    for directory in sys.argv[1:]:
+        graph[directory] = package_info(directory)
+    print(json.dumps(graph, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+#!/bin/bash
+#
+# Adds the packages built into a staging directory to the repository
+# with a single repo-add call, which also writes the files database
+# and removes the package files superseded by the new versions.
+#
+# Package builds leave a .built-<package> file with the hash of their
+# sources next to the packages, once the packages are in the database
+# they are printed as "built <package> <hash>".
+#
+# Usage:
+#   archrepo.sh DATABASE STAGING
+#
+
+set -e
+shopt -s nullglob
+
+database=$1
+staging=$2
+repodir=$(dirname "$database")
+
+if [ ! -d "$staging" ]; then
+    echo "Nothing to add"
+    exit 0
+fi
+
+packages=()
+for path in "$staging"/*.pkg.tar.*; do
+    case "$path" in
+        *.sig) ;;
+        *) packages+=("$repodir/$(basename "$path")") ;;
+    esac
+done
+
+if [ ${#packages[@]} -gt 0 ]; then
+    # Signatures included
+    mv -f "$staging"/*.pkg.tar.* "$repodir"/
+    repo-add -R "$database" "${packages[@]}"
+else
+    echo "Nothing to add"
+fi
+
+for path in "$staging"/.built-*; do
+    echo "built ${path##*/.built-} $(cat "$path")"
+done
+rm -rf "$staging"
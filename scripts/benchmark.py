@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+#
+# Offline benchmark of this configuration: loads master.cfg against
+# generated config.json files of increasing size, without starting a
+# master, and reports the time taken by the first load and by the
+# following ones (a reconfig), the peak memory, and the number of
+# workers, schedulers, builders and steps produced.  The dynamic steps
+# of the factories are expanded against canned worker responses, so
+# the steps a build would really run are counted too.
+#
+# Each size is measured in --repeat processes of its own, which reload
+# the configuration --repeat times, and the lowest times are kept.
+#
+# The counts do not depend on the machine: with --counts, counts that
+# differ from the stored ones fail the run.  Times and memory are only
+# compared with a reference run made on the same machine: with
+# --reference, ratios to the reference above 1 + tolerance fail the
+# run.  --update stores the counts and the reference instead.
+#
+# It needs the Python environment of the master (buildbot and its
+# dependencies).  benchmark-counts.json holds the counts of the default
+# sizes and is checked by the tests, the reference stays on the machine
+# it was measured on.
+#
+# Usage:
+#   benchmark.py [--sizes 1,10,50] [--repeat 3] [--counts FILE] [--reference FILE] [--update] [--tolerance 0.25]
+#   benchmark.py --counts scripts/benchmark-counts.json --reference ~/.cache/liribotcfg-benchmark.json
+#
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_DEPTH = 5
+COUNTS = ('workers', 'schedulers', 'builders', 'services', 'steps', 'not_expanded')
+TIMINGS = ('load_seconds', 'reconfig_seconds', 'maxrss_kib')
+
+
+def log(message):
+    print(message)
+    sys.stdout.flush()
+
+
+def generate_config(size):
+    """
+    Returns a config.json with size Docker workers of each class,
+    size Docker Hub triggers and size Arch Linux packages.
+    """
+    docker_workers = {}
+    for klass in ('fedora', 'archlinux'):
+        docker_workers['%s-bench' % klass] = {
+            'image': 'liridev/%s:latest' % klass,
+            'class': klass,
+            'instances': size,
+            'volumes': ['/srv/cache/%(worker_name)s:/build/cache'],
+            'digest-ttl': 600,
+        }
+    return {
+        'buildbot-port': 8010,
+        'buildbot-uri': 'http://localhost:8010/',
+        'num-master-workers': 4,
+        'admin-username': 'admin',
+        'admin-password': 'benchmark',
+        'workers': dict(('worker%d' % i, {'password': 'benchmark', 'max-builds': 2}) for i in range(size)),
+        'docker-workers': docker_workers,
+        'warm-containers': {'fedora': 1},
+        'docker-hub-triggers': [
+            {'name': 'image%d' % i, 'uuid': 'uuid%d' % i, 'token': 'token%d' % i, 'tags': ['automatic']}
+            for i in range(size)
+        ],
+        'artifacts': {'path': 'artifacts'},
+        'metrics': {'port': 8011},
+        'flatpak': {'gpg-key': 'BENCHMARK'},
+    }
+
+
+def worker_responses(size):
+    """
+    Returns the canned responses of the worker: file contents by path
+    and command outputs by script.
+    """
+    packages = ['package%d' % i for i in range(size)]
+    graph = {}
+    for i, name in enumerate(packages):
+        # Each package depends on the two before it
+        graph[name] = {'names': [name], 'depends': packages[max(i - 2, 0):i], 'hash': 'hash%d' % i}
+    return {
+        'channels.json': json.dumps({'stable': [], 'unstable': packages}),
+        '.archgraph.py': json.dumps(graph),
+    }
+
+
+class _Command(object):
+    """
+    Remote command answered from the canned responses.
+    """
+
+    def __init__(self, command, responses):
+        self.command = command
+        script = command[1] if len(command) > 1 else command[0]
+        self.stdout = responses.get(script, '')
+        self.rc = 0
+
+    def didFail(self):
+        return False
+
+    def results(self):
+        return 0
+
+
+def _is_dynamic(step):
+    """
+    Returns whether the run method of a step comes from this
+    configuration, which is where steps are added dynamically.
+    """
+    for klass in type(step).__mro__:
+        if 'run' in vars(klass):
+            return klass.__module__.split('.')[0] == 'liribotcfg'
+    return False
+
+
+def _expand(step, build_class, builder, responses):
+    """
+    Runs a step against a fake build and returns the steps it adds,
+    or None when the step cannot run offline.
+    """
+    from twisted.internet import defer
+
+    build = build_class(builder)
+    step.build = build
+    step.addCompleteLog = lambda name, text: defer.succeed(None)
+    step.getFileContentFromWorker = lambda path, **kwargs: defer.succeed(responses.get(path))
+    step.makeRemoteShellCommand = lambda command=None, **kwargs: defer.succeed(_Command(command, responses))
+    step.runCommand = lambda cmd: defer.succeed(cmd)
+    step.workerVersionIsOlderThan = lambda command, version: False
+    result = []
+    d = defer.maybeDeferred(step.run)
+    d.addBoth(result.append)
+    if not result or isinstance(result[0], Exception) or hasattr(result[0], 'getErrorMessage'):
+        return None
+    return build.added
+
+
+def _count_steps(steps, build_class, builder, responses, skip, depth=0):
+    """
+    Returns the number of steps, expanding the dynamic ones, and the
+    names of the classes that could not be expanded.
+    """
+    from buildbot import interfaces
+
+    count = 0
+    opaque = set()
+    for factory in steps:
+        step = interfaces.IBuildStepFactory(factory).buildStep()
+        count += 1
+        if depth >= MAX_DEPTH:
+            continue
+        if not _is_dynamic(step):
+            continue
+        added = None if isinstance(step, skip) else _expand(step, build_class, builder, responses)
+        if added is None:
+            opaque.add(step.__class__.__name__)
+            continue
+        added_count, added_opaque = _count_steps(added, build_class, builder, responses, skip, depth + 1)
+        count += added_count
+        opaque |= added_opaque
+    return count, opaque
+
+
+def measure(size, repeat):
+    """
+    Loads master.cfg for a size in this process and returns the results.
+    """
+    basedir = tempfile.mkdtemp(prefix='liribotcfg-benchmark-')
+    try:
+        os.symlink(ROOT, os.path.join(basedir, 'liribotcfg'))
+        os.symlink(os.path.join(ROOT, 'master.cfg'), os.path.join(basedir, 'master.cfg'))
+        with open(os.path.join(basedir, 'config.json'), 'w') as f:
+            json.dump(generate_config(size), f)
+        os.chdir(basedir)
+        sys.path.insert(0, basedir)
+
+        from buildbot import config as bbconfig
+        from buildbot.process import properties
+
+        loader = bbconfig.FileLoader(basedir, 'master.cfg')
+        started = time.time()
+        cfg = loader.loadConfig()
+        load_seconds = time.time() - started
+        reconfig_seconds = []
+        for i in range(repeat):
+            started = time.time()
+            cfg = loader.loadConfig()
+            reconfig_seconds.append(time.time() - started)
+
+        from liribotcfg.factories._docker import DockerHubTriggerStep
+        from liribotcfg.factories._sync import MasterThreadStep, _TreeSyncReceiveStep, _TreeSyncSendStep
+
+        class FakeBuild(properties.Properties):
+            def __init__(self, builder):
+                properties.Properties.__init__(self)
+                for name, value in (('buildername', builder), ('buildnumber', 1), ('workername', 'bench'),
+                                    ('jobs', 8), ('cpus', 8), ('memory', 16384)):
+                    self.setProperty(name, value, 'benchmark', runtime=True)
+                self.added = []
+
+            def addStepsAfterCurrentStep(self, step_factories):
+                self.added.extend(step_factories)
+
+        responses = worker_responses(size)
+        steps = {}
+        opaque = set()
+        for name, factory_steps in [(b.name, b.factory.steps) for b in cfg.builders]:
+            # These touch the master file system, stream deltas or call webhooks
+            count, names = _count_steps(factory_steps, FakeBuild, name, responses,
+                                        (MasterThreadStep, _TreeSyncReceiveStep, _TreeSyncSendStep,
+                                         DockerHubTriggerStep))
+            steps[name] = {'static': len(factory_steps), 'expanded': count}
+            opaque |= names
+        return {
+            'load_seconds': load_seconds,
+            'reconfig_seconds': min(reconfig_seconds) if reconfig_seconds else load_seconds,
+            'maxrss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'workers': len(cfg.workers),
+            'schedulers': len(cfg.schedulers),
+            'builders': len(cfg.builders),
+            'services': len(cfg.services),
+            'steps': steps,
+            'not_expanded': sorted(opaque),
+        }
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(basedir, ignore_errors=True)
+
+
+def counts(result):
+    """
+    Returns the part of result that does not depend on the machine.
+    """
+    return dict((key, result[key]) for key in COUNTS)
+
+
+def compare_counts(size, current, stored):
+    """
+    Returns the counts of current that differ from the stored ones.
+    """
+    failures = []
+    for key in COUNTS:
+        if current[key] != stored.get(key):
+            failures.append('size %s: %s changed from %s to %s' % (size, key, stored.get(key), current[key]))
+    return failures
+
+
+def ratios(current, reference):
+    """
+    Returns the times and memory of current relative to the reference.
+    """
+    return dict((key, current[key] / float(reference[key])) for key in TIMINGS if reference.get(key))
+
+
+def compare_timings(size, current, reference, tolerance):
+    """
+    Returns the times and memory of current above the reference.
+    """
+    failures = []
+    for key, ratio in sorted(ratios(current, reference).items()):
+        if ratio > 1 + tolerance:
+            failures.append('size %s: %s is %.2f times the reference (%s against %s)' % (
+                size, key, ratio, current[key], reference[key]))
+    return failures
+
+
+def report(size, result, reference=None):
+    log('size %d: load %.2f s, reconfig %.2f s, peak memory %.1f MiB' % (
+        size, result['load_seconds'], result['reconfig_seconds'], result['maxrss_kib'] / 1024.0))
+    if reference:
+        log('  to the reference: ' + ', '.join('%s x%.2f' % (key, ratio)
+                                              for key, ratio in sorted(ratios(result, reference).items())))
+    log('  %(workers)d workers, %(schedulers)d schedulers, %(builders)d builders, %(services)d services' % result)
+    for builder, counts in sorted(result['steps'].items()):
+        log('  %-40s %3d steps, %3d expanded' % (builder, counts['static'], counts['expanded']))
+    if result['not_expanded']:
+        log('  not expanded offline: %s' % ', '.join(result['not_expanded']))
+
+
+def run(sizes, repeat):
+    """
+    Measures each size in repeat processes of its own, returns the
+    results by size with the lowest times and memory.
+    """
+    results = {}
+    for size in sizes:
+        for i in range(max(repeat, 1)):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', str(size),
+                                              '--repeat', str(repeat)], universal_newlines=True)
+            result = json.loads(output.splitlines()[-1])
+            if str(size) in results:
+                for key in TIMINGS:
+                    result[key] = min(result[key], results[str(size)][key])
+            results[str(size)] = result
+    return results
+
+
+def load(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def store(path, results):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    log('stored the results in %s' % path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of master.cfg')
+    parser.add_argument('--sizes', default='1,10,50')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--counts', help='counts of steps, schedulers and workers, kept in git')
+    parser.add_argument('--reference', help='times and memory of a reference run on this machine')
+    parser.add_argument('--update', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(measure(args.child, args.repeat)))
+        return 0
+
+    results = run([int(size) for size in args.sizes.split(',')], args.repeat)
+    stored_counts = load(args.counts) or {}
+    reference = load(args.reference) or {}
+    for size, result in sorted(results.items(), key=lambda item: int(item[0])):
+        report(int(size), result, None if args.update else reference.get(size))
+
+    if args.update:
+        if args.counts:
+            stored_counts.update((size, counts(result)) for size, result in results.items())
+            store(args.counts, stored_counts)
+        if args.reference:
+            reference.update((size, dict((key, result[key]) for key in TIMINGS)) for size, result in results.items())
+            store(args.reference, reference)
+        return 0
+    failures = []
+    for size, result in sorted(results.items()):
+        if args.counts and size in stored_counts:
+            failures += compare_counts(size, result, stored_counts[size])
+        if args.reference and size in reference:
+            failures += compare_timings(size, result, reference[size], args.tolerance)
+    missing = [path for path, stored in ((args.counts, stored_counts), (args.reference, reference))
+               if path and not stored]
+    for path in missing:
+        log('nothing stored in %s, store the results with --update' % path)
+    for failure in failures:
+        log('REGRESSION: ' + failure)
+    return 1 if failures or missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#
+# Prints the steps that take the most time over the last builds, from
+# the state database of the master, along with the time the build
+# requests waited for a worker.
+#
+# Usage:
+#   bottlenecks.py [--db sqlite:///state.sqlite] [--builds N] [--top N] [--builder NAME]...
+#
+
+import argparse
+import sqlite3
+import sys
+
+
+def log(message):
+    print(message)
+    sys.stdout.flush()
+
+
+def format_duration(seconds):
+    if seconds >= 60 * 60:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%.1fs' % seconds
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def db_path(url):
+    if url.startswith('sqlite:///'):
+        return url[len('sqlite:///'):]
+    if '://' in url:
+        raise SystemExit('only sqlite databases are supported, not %s' % url)
+    return url
+
+
+def last_builds(db, count, builders):
+    """
+    Returns the last count complete builds of each builder as
+    (id, builder, worker, duration, waited) tuples.
+    """
+    query = '''
+        SELECT builds.id, builders.name, workers.name,
+               builds.complete_at - builds.started_at,
+               builds.started_at - buildrequests.submitted_at
+        FROM builds
+        JOIN builders ON builders.id = builds.builderid
+        LEFT JOIN workers ON workers.id = builds.workerid
+        LEFT JOIN buildrequests ON buildrequests.id = builds.buildrequestid
+        WHERE builds.complete_at IS NOT NULL
+        ORDER BY builds.id DESC
+    '''
+    seen = {}
+    builds = []
+    for row in db.execute(query):
+        builder = row[1]
+        if builders and builder not in builders:
+            continue
+        if seen.get(builder, 0) >= count:
+            continue
+        seen[builder] = seen.get(builder, 0) + 1
+        builds.append(row)
+    return builds
+
+
+def step_times(db, buildids):
+    """
+    Returns the duration of the steps of the builds by (build, step name).
+    """
+    times = {}
+    for start in range(0, len(buildids), 500):
+        chunk = buildids[start:start + 500]
+        query = '''
+            SELECT buildid, name, complete_at - started_at FROM steps
+            WHERE buildid IN (%s) AND started_at IS NOT NULL AND complete_at IS NOT NULL
+        ''' % ','.join('?' * len(chunk))
+        for buildid, name, seconds in db.execute(query, chunk):
+            times.setdefault((buildid, name), 0)
+            times[(buildid, name)] += seconds
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Top bottleneck steps over the last builds')
+    parser.add_argument('--db', default='sqlite:///state.sqlite')
+    parser.add_argument('--builds', type=int, default=20, help='number of builds per builder')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--builder', action='append', default=[])
+    args = parser.parse_args()
+
+    db = sqlite3.connect(db_path(args.db))
+    builds = last_builds(db, args.builds, set(args.builder))
+    if not builds:
+        log('no complete builds')
+        return 1
+    by_id = dict((row[0], row) for row in builds)
+    times = step_times(db, list(by_id))
+
+    # Steps added dynamically share names across builds, group them by builder and name
+    steps = {}
+    for (buildid, name), seconds in times.items():
+        steps.setdefault((by_id[buildid][1], name), []).append(seconds)
+    build_time = {}
+    for row in builds:
+        build_time[row[1]] = build_time.get(row[1], 0) + (row[3] or 0)
+
+    log('%d builds of %d builders' % (len(builds), len(build_time)))
+    log('')
+    log('%-32s %-40s %6s %9s %9s %9s %6s' % ('builder', 'step', 'runs', 'total', 'mean', 'p90', 'share'))
+    ranked = sorted(steps.items(), key=lambda item: sum(item[1]), reverse=True)
+    for (builder, name), durations in ranked[:args.top]:
+        total = sum(durations)
+        share = total * 100.0 / build_time[builder] if build_time[builder] else 0
+        log('%-32s %-40s %6d %9s %9s %9s %5.1f%%' % (
+            builder[:32], name[:40], len(durations), format_duration(total),
+            format_duration(total / len(durations)), format_duration(percentile(durations, 0.9)), share))
+
+    log('')
+    log('%-32s %6s %9s %9s %9s  %s' % ('builder', 'builds', 'wait', 'p90 wait', 'duration', 'workers'))
+    for builder in sorted(build_time):
+        rows = [row for row in builds if row[1] == builder]
+        waits = [max(row[4] or 0, 0) for row in rows]
+        workers = {}
+        for row in rows:
+            workers[row[2]] = workers.get(row[2], 0) + 1
+        log('%-32s %6d %9s %9s %9s  %s' % (
+            builder[:32], len(rows), format_duration(sum(waits) / len(waits)),
+            format_duration(percentile(waits, 0.9)), format_duration(build_time[builder] / len(rows)),
+            ', '.join('%s (%d)' % (worker, n) for worker, n in sorted(workers.items(), key=lambda w: -w[1]))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
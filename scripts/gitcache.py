@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+# Keeps mirrors of git repositories on a worker, used as reference
+# repositories by the checkouts so that they only fetch new objects.
+#
+# Submodules are mirrored inside the mirror of their superproject, as
+# modules/<name>, which is where git looks for them when cloning with
+# submodule.alternateLocation=superproject.
+#
+# Usage:
+#   gitcache.py update --root DIR [--max-age SECONDS] [--branch BRANCH] URL
+#
+
+import argparse
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+STAMP = 'gitcache-stamp'
+
+
+def log(message):
+    print(message)
+    sys.stdout.flush()
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
+def mirror_name(url):
+    name = re.sub(r'^[a-z+]+://', '', url)
+    name = re.sub(r'\.git$', '', name.rstrip('/'))
+    return re.sub(r'[^A-Za-z0-9._-]+', '-', name).strip('-') + '.git'
+
+
+def git(path, *args, **kwargs):
+    return subprocess.check_output(['git', '--git-dir=' + path] + list(args),
+                                   universal_newlines=True, **kwargs)
+
+
+def objects_size(path):
+    sizes = {}
+    for line in git(path, 'count-objects', '-v').splitlines():
+        key, _, value = line.partition(': ')
+        sizes[key] = value
+    return (int(sizes.get('size', 0)) + int(sizes.get('size-pack', 0))) * 1024
+
+
+def resolve_url(url, base):
+    # Relative submodule URLs are relative to the superproject
+    if not url.startswith('../') and not url.startswith('./'):
+        return url
+    base = base.rstrip('/')
+    for part in url.split('/'):
+        if part == '..':
+            base = base.rsplit('/', 1)[0]
+        elif part != '.':
+            base += '/' + part
+    return base
+
+
+def submodules(path, revision):
+    """
+    Returns the names and URLs of the submodules of a revision.
+    """
+    try:
+        output = git(path, 'config', '--blob', revision + ':.gitmodules',
+                     '--get-regexp', r'^submodule\..*\.url$', stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return []
+    result = []
+    for line in output.splitlines():
+        key, _, url = line.partition(' ')
+        result.append((key[len('submodule.'):-len('.url')], url))
+    return result
+
+
+def update(path, url, max_age, revision, stats):
+    """
+    Creates or refreshes the mirror of url in path, then the
+    mirrors of its submodules.
+    """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        stamp = os.path.join(path, STAMP)
+        started = time.time()
+        if not os.path.isdir(path):
+            subprocess.check_call(['git', 'clone', '--mirror', '--quiet', url, path])
+            # Checkouts borrow objects that may become unreachable here
+            git(path, 'config', 'gc.pruneExpire', 'never')
+            before = 0
+        elif os.path.exists(stamp) and started - os.path.getmtime(stamp) < max_age:
+            stats['fresh'] += 1
+            before = None
+        else:
+            before = objects_size(path)
+            git(path, 'remote', 'set-url', 'origin', url)
+            subprocess.check_call(['git', '--git-dir=' + path, 'fetch', '--prune', '--quiet', 'origin'])
+        if before is not None:
+            fetched = objects_size(path) - before
+            elapsed = time.time() - started
+            stats['updated'] += 1
+            stats['fetched_bytes'] += max(fetched, 0)
+            stats['seconds'] += elapsed
+            log('%s: fetched %s in %.1f seconds' % (url, format_size(max(fetched, 0)), elapsed))
+            with open(stamp, 'w') as f:
+                f.write('%f\n' % started)
+            # Detaches itself and runs in the background when needed
+            subprocess.call(['git', '--git-dir=' + path, 'gc', '--auto', '--quiet'])
+        else:
+            log('%s: fresh' % url)
+    for name, suburl in submodules(path, revision):
+        update(os.path.join(path, 'modules', name), resolve_url(suburl, url), max_age, 'HEAD', stats)
+
+
+def cmd_update(args):
+    path = os.path.join(os.path.abspath(args.root), mirror_name(args.url))
+    stats = {'updated': 0, 'fresh': 0, 'fetched_bytes': 0, 'seconds': 0.0}
+    update(path, args.url, args.max_age, args.branch, stats)
+    stats['reference'] = path
+    stats['seconds'] = round(stats['seconds'], 1)
+    log('gitcache: ' + json.dumps(stats, sort_keys=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker git cache')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('update')
+    p.add_argument('--root', required=True)
+    p.add_argument('--max-age', type=int, default=5 * 60)
+    p.add_argument('--branch', default='HEAD')
+    p.add_argument('url')
+    p.set_defaults(func=cmd_update)
+    args = parser.parse_args()
+    if not getattr(args, 'func', None):
+        parser.error('a command is required')
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+# Publishes images to the nightly directory: each image is read once,
+# computing its digests and feeding the compressors while it is copied
+# (or before it is renamed, on the same file system).  The directory
+# has an index of the published files, index.json, which is the listing
+# served to the users and which drives the removal of old images, so
+# the directory is never scanned.
+#
+# Usage:
+#   imagepub.py publish --dest DIR [--checksum-file NAME] [--digest ALGO]... [--compress FORMAT]...
+#                       [--keep-days DAYS] [--move] FILE|DIR...
+#   imagepub.py prune --dest DIR [--keep-days DAYS]
+#   imagepub.py list --dest DIR
+#
+
+import argparse
+import calendar
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+INDEX = 'index.json'
+LOCK = '.imagepub.lock'
+CHUNK_SIZE = 1024 * 1024
+
+# Format: command writing the compressed input to stdout, suffix
+COMPRESSORS = {
+    'gzip': (['gzip', '-c'], '.gz'),
+    'xz': (['xz', '-T0', '-c'], '.xz'),
+    'zstd': (['zstd', '-T0', '-q', '-c'], '.zst'),
+}
+
+
+def log(message):
+    print(message)
+    sys.stdout.flush()
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
+def lock(dest):
+    f = open(os.path.join(dest, LOCK), 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def entry_time(entry):
+    return calendar.timegm(time.strptime(entry['date'], '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def load_index(dest):
+    """
+    Returns the entries of the index by name, the first time the
+    files already in the directory are added without digests.
+    """
+    try:
+        with open(os.path.join(dest, INDEX)) as f:
+            return dict((entry['name'], entry) for entry in json.load(f)['files'])
+    except (IOError, OSError):
+        pass
+    entries = {}
+    for name in os.listdir(dest):
+        path = os.path.join(dest, name)
+        if name in (INDEX, LOCK) or name.startswith('.') or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        entries[name] = {
+            'name': name,
+            'size': st.st_size,
+            'digests': {},
+            'date': datetime.datetime.utcfromtimestamp(st.st_mtime).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+    log('indexed %d files already published' % len(entries))
+    return entries
+
+
+def save_index(dest, entries):
+    files = sorted(entries.values(), key=lambda entry: (entry['date'], entry['name']), reverse=True)
+    tmppath = os.path.join(dest, '.%s.tmp' % INDEX)
+    with open(tmppath, 'w') as f:
+        json.dump({'version': 1, 'updated': now(), 'files': files}, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.chmod(tmppath, 0o644)
+    os.rename(tmppath, os.path.join(dest, INDEX))
+
+
+class _Output(object):
+    """
+    Destination of the data read from the image: a plain copy, or a
+    compressor whose output is hashed while it is written.
+    """
+
+    def __init__(self, path, command=None, digests=()):
+        self.path = path
+        self.tmppath = os.path.join(os.path.dirname(path), '.%s.partial' % os.path.basename(path))
+        self.file = open(self.tmppath, 'wb')
+        self.hashes = dict((name, hashlib.new(name)) for name in digests)
+        self.size = 0
+        self.process = None
+        self.thread = None
+        if command:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.thread = threading.Thread(target=self._drain)
+            self.thread.start()
+
+    def _drain(self):
+        for chunk in iter(lambda: self.process.stdout.read(CHUNK_SIZE), b''):
+            self._store(chunk)
+
+    def _store(self, chunk):
+        for h in self.hashes.values():
+            h.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def write(self, chunk):
+        if self.process:
+            self.process.stdin.write(chunk)
+        else:
+            self._store(chunk)
+
+    def close(self):
+        if self.process:
+            self.process.stdin.close()
+            self.thread.join()
+            if self.process.wait() != 0:
+                self.abort()
+                raise RuntimeError('%s failed' % ' '.join(self.process.args))
+        self.file.close()
+        os.rename(self.tmppath, self.path)
+
+    def abort(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+        self.file.close()
+        if os.path.exists(self.tmppath):
+            os.unlink(self.tmppath)
+
+
+def publish_file(source, dest, digests, compress, move):
+    """
+    Publishes source in dest along with its compressed variants.
+    Returns the index entries of the published files.
+    """
+    name = os.path.basename(source)
+    path = os.path.join(dest, name)
+    hashes = dict((algo, hashlib.new(algo)) for algo in digests)
+    # On the same file system the image is renamed, it only needs to be read
+    rename = move and os.stat(source).st_dev == os.stat(dest).st_dev
+    outputs = []
+    try:
+        if not rename:
+            outputs.append(_Output(path))
+        for fmt in compress:
+            command, suffix = COMPRESSORS[fmt]
+            outputs.append(_Output(path + suffix, command, digests))
+        started = time.time()
+        size = 0
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                for h in hashes.values():
+                    h.update(chunk)
+                for output in outputs:
+                    output.write(chunk)
+                size += len(chunk)
+        for output in outputs:
+            output.close()
+    except BaseException:
+        for output in outputs:
+            output.abort()
+        raise
+    if rename:
+        os.rename(source, path)
+    elif move:
+        os.unlink(source)
+    os.chmod(path, 0o644)
+    seconds = max(time.time() - started, 0.001)
+    log('%s: %s in %.1f s (%s/s)' % (name, format_size(size), seconds, format_size(size / seconds)))
+    date = now()
+    entries = [{
+        'name': name,
+        'size': size,
+        'digests': dict((algo, h.hexdigest()) for algo, h in hashes.items()),
+        'date': date,
+    }]
+    for output in outputs:
+        if output.process:
+            os.chmod(output.path, 0o644)
+            log('%s: %s (%.0f%%)' % (os.path.basename(output.path), format_size(output.size),
+                                     output.size * 100.0 / max(size, 1)))
+            entries.append({
+                'name': os.path.basename(output.path),
+                'size': output.size,
+                'digests': dict((algo, h.hexdigest()) for algo, h in output.hashes.items()),
+                'date': date,
+                'source': name,
+            })
+    return entries
+
+
+def write_checksums(dest, name, entries):
+    """
+    Writes the checksum file in the format of sha256sum --tag.
+    """
+    lines = []
+    for entry in entries:
+        for algo, digest in sorted(entry['digests'].items()):
+            lines.append('%s (%s) = %s\n' % (algo.upper(), entry['name'], digest))
+    path = os.path.join(dest, name)
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    os.chmod(path, 0o644)
+    return {
+        'name': name,
+        'size': os.path.getsize(path),
+        'digests': {},
+        'date': now(),
+    }
+
+
+def prune(dest, entries, keep_days):
+    """
+    Removes the files published more than keep_days ago.
+    """
+    limit = time.time() - keep_days * 24 * 60 * 60
+    removed = 0
+    freed = 0
+    for name, entry in sorted(entries.items()):
+        if entry_time(entry) >= limit:
+            continue
+        try:
+            os.unlink(os.path.join(dest, name))
+        except OSError:
+            pass
+        del entries[name]
+        removed += 1
+        freed += entry['size']
+    log('removed %d files older than %d days (%s)' % (removed, keep_days, format_size(freed)))
+    return removed, freed
+
+
+def sources(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def cmd_publish(args):
+    if not os.path.isdir(args.dest):
+        os.makedirs(args.dest)
+    digests = args.digest or ['sha256']
+    published = []
+    for source in sources(args.files):
+        published += publish_file(source, args.dest, digests, args.compress or [], args.move)
+    if not published:
+        log('nothing to publish')
+        return 1
+    with lock(args.dest):
+        entries = load_index(args.dest)
+        if args.checksum_file:
+            published.append(write_checksums(args.dest, args.checksum_file, published))
+        for entry in published:
+            entries[entry['name']] = entry
+        if args.keep_days:
+            prune(args.dest, entries, args.keep_days)
+        save_index(args.dest, entries)
+    log('imagepub: ' + json.dumps({'published': len(published), 'files': len(entries)}))
+    return 0
+
+
+def cmd_prune(args):
+    with lock(args.dest):
+        entries = load_index(args.dest)
+        prune(args.dest, entries, args.keep_days)
+        save_index(args.dest, entries)
+    return 0
+
+
+def cmd_list(args):
+    entries = load_index(args.dest)
+    for entry in sorted(entries.values(), key=lambda entry: entry['date'], reverse=True):
+        log('%s  %10s  %s' % (entry['date'], format_size(entry['size']), entry['name']))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nightly image publishing')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('publish')
+    p.add_argument('--dest', required=True)
+    p.add_argument('--checksum-file')
+    p.add_argument('--digest', action='append', choices=sorted(hashlib.algorithms_guaranteed))
+    p.add_argument('--compress', action='append', choices=sorted(COMPRESSORS))
+    p.add_argument('--keep-days', type=int, default=0)
+    p.add_argument('--move', action='store_true')
+    p.add_argument('files', nargs='+')
+    p.set_defaults(func=cmd_publish)
+    p = subparsers.add_parser('prune')
+    p.add_argument('--dest', required=True)
+    p.add_argument('--keep-days', type=int, default=7)
+    p.set_defaults(func=cmd_prune)
+    p = subparsers.add_parser('list')
+    p.add_argument('--dest', required=True)
+    p.set_defaults(func=cmd_list)
+    args = parser.parse_args()
+    if not getattr(args, 'func', None):
+        parser.error('a command is required')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Maintains the package cache shared by the image and OSTree builds
+# on a worker: hit/miss statistics, deduplication of identical RPMs
+# across the caches and LRU eviction down to a size limit.
+#
+# Usage:
+#   pkgcache.py start --root DIR --stamp FILE [--mode keep|prune|clear] [--max-size BYTES]
+#   pkgcache.py finish --root DIR --stamp FILE [--max-size BYTES]
+#
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+# Files accessed more recently than this may belong to a running build
+GRACE_PERIOD = 60 * 60
+
+
+def log(message):
+    print(message)
+    sys.stdout.flush()
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
+def is_ostree_repo(path):
+    return os.path.isfile(os.path.join(path, 'config')) and os.path.isdir(os.path.join(path, 'objects'))
+
+
+def walk_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        # rpm-ostree imports the packages into a repository, it is handled as a whole
+        dirnames[:] = [name for name in dirnames if not is_ostree_repo(os.path.join(dirpath, name))]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path) and not name.startswith('.pkgcache'):
+                yield path, os.lstat(path)
+
+
+def walk_repos(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if is_ostree_repo(path):
+                dirnames.remove(name)
+                yield path
+
+
+def last_access(st):
+    # With relatime the access time may lag behind, never before the modification
+    return max(st.st_atime, st.st_mtime)
+
+
+def file_digest(path, st):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    # Reading is not a use of the package, keep the eviction order
+    os.utime(path, (st.st_atime, st.st_mtime))
+    return h.hexdigest()
+
+
+def lock(root):
+    f = open(os.path.join(root, '.pkgcache.lock'), 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def deduplicate(root):
+    """
+    Replaces identical RPMs found in several caches with hard links.
+    Returns the number of bytes saved.
+    """
+    candidates = {}
+    for path, st in walk_files(root):
+        if path.endswith('.rpm'):
+            candidates.setdefault((os.path.basename(path), st.st_size), []).append((path, st))
+    saved = 0
+    for (name, size), entries in candidates.items():
+        inodes = set((st.st_dev, st.st_ino) for path, st in entries)
+        if len(inodes) < 2:
+            continue
+        keep_path, keep_st = entries[0]
+        keep_digest = file_digest(keep_path, keep_st)
+        for path, st in entries[1:]:
+            if (st.st_dev, st.st_ino) == (keep_st.st_dev, keep_st.st_ino) or st.st_dev != keep_st.st_dev:
+                continue
+            if file_digest(path, st) != keep_digest:
+                continue
+            tmppath = path + '.pkgcache-link'
+            os.link(keep_path, tmppath)
+            os.rename(tmppath, path)
+            saved += size
+    return saved
+
+
+def evict(root, max_size):
+    """
+    Removes the least recently used packages until the cache fits in
+    max_size, OSTree repositories are removed as a whole.  Returns the
+    number of evicted files and bytes and the remaining size.
+    """
+    seen = set()
+    entries = []
+    total = 0
+    for path, st in walk_files(root):
+        inode = (st.st_dev, st.st_ino)
+        # Hard links free space only when every link is gone
+        size = st.st_size if inode not in seen else 0
+        seen.add(inode)
+        total += size
+        if path.endswith('.rpm'):
+            entries.append((last_access(st), path, size, 1))
+    for path in walk_repos(root):
+        size = 0
+        count = 0
+        used = 0
+        for filepath, st in walk_files(path):
+            size += st.st_size
+            count += 1
+            used = max(used, st.st_mtime)
+        total += size
+        entries.append((used, path, size, count))
+    entries.sort()
+    evicted_files = 0
+    evicted_bytes = 0
+    now = time.time()
+    for atime, path, size, count in entries:
+        if total <= max_size or now - atime < GRACE_PERIOD:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        total -= size
+        evicted_files += count
+        evicted_bytes += size
+    return evicted_files, evicted_bytes, total
+
+
+def cmd_start(args):
+    if not os.path.isdir(args.root):
+        os.makedirs(args.root)
+    if args.mode == 'clear':
+        with lock(args.root):
+            for name in os.listdir(args.root):
+                if not name.startswith('.pkgcache'):
+                    path = os.path.join(args.root, name)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.unlink(path)
+        log('cache cleared')
+    elif args.mode == 'prune' and args.max_size:
+        with lock(args.root):
+            # Prune down to half of the limit, making room for the build
+            files, size, total = evict(args.root, args.max_size // 2)
+        log('pruned %d files (%s), %s left' % (files, format_size(size), format_size(total)))
+    with open(args.stamp, 'w') as f:
+        f.write('%f\n' % time.time())
+
+
+def cmd_finish(args):
+    try:
+        with open(args.stamp) as f:
+            started = float(f.read().strip())
+    except (IOError, OSError, ValueError):
+        started = time.time()
+    hits = misses = 0
+    for path, st in walk_files(args.root):
+        if not path.endswith('.rpm'):
+            continue
+        if st.st_mtime >= started:
+            misses += 1
+        elif last_access(st) >= started:
+            hits += 1
+    with lock(args.root):
+        saved = deduplicate(args.root)
+        if args.max_size:
+            evicted_files, evicted_bytes, total = evict(args.root, args.max_size)
+        else:
+            evicted_files, evicted_bytes, total = evict(args.root, float('inf'))
+    stats = {
+        'hits': hits,
+        'misses': misses,
+        'deduplicated_bytes': saved,
+        'evicted_files': evicted_files,
+        'evicted_bytes': evicted_bytes,
+        'size': total,
+    }
+    log('%d hits, %d misses, %s deduplicated, %d files evicted (%s), cache size %s' % (
+        hits, misses, format_size(saved), evicted_files, format_size(evicted_bytes), format_size(total)))
+    log('pkgcache: ' + json.dumps(stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker package cache')
+    subparsers = parser.add_subparsers(dest='command')
+    for name, func in (('start', cmd_start), ('finish', cmd_finish)):
+        p = subparsers.add_parser(name)
+        p.add_argument('--root', required=True)
+        p.add_argument('--stamp', required=True)
+        p.add_argument('--max-size', type=int, default=0)
+        if name == 'start':
+            p.add_argument('--mode', choices=['keep', 'prune', 'clear'], default='keep')
+        p.set_defaults(func=func)
+    args = parser.parse_args()
+    if not getattr(args, 'func', None):
+        parser.error('a command is required')
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
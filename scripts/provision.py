@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# Installs the tools needed by the builds on a Fedora worker, with a
+# single dnf transaction that also updates the system.
+#
+# The installed versions and the repository metadata timestamp are
+# recorded in a manifest, the transaction is skipped while the manifest
+# is current: every package is installed at the recorded version, the
+# metadata did not change and the manifest is younger than --max-age.
+#
+# Usage:
+#   provision.py --manifest FILE [--max-age SECONDS] [--force] PACKAGE...
+#
+
+import argparse
+import fcntl
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+METADATA_GLOB = '/var/cache/dnf/*/repodata/repomd.xml'
+
+
+def log(message):
+    print(message)
+    sys.stdout.flush()
+
+
+def installed_versions(packages):
+    """
+    Returns the installed version of each package, None when
+    the package is not installed.
+    """
+    cmd = ['rpm', '-q', '--qf', '%{NAME} %{EPOCH}:%{VERSION}-%{RELEASE}.%{ARCH}\n'] + packages
+    output = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    versions = dict((package, None) for package in packages)
+    for line in output.splitlines():
+        # Packages that are not installed print "package ... is not installed"
+        name, version = line.split(' ', 1)
+        if name in versions and not version.endswith('is not installed'):
+            # Multilib packages are installed more than once
+            versions[name] = ' '.join(filter(None, [versions[name], version]))
+    return versions
+
+
+def metadata_timestamp():
+    timestamps = [os.path.getmtime(path) for path in glob.glob(METADATA_GLOB)]
+    return max(timestamps) if timestamps else 0
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    dirname = os.path.dirname(path) or '.'
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.provision-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmppath, path)
+
+
+def stale_reason(manifest, packages, max_age):
+    """
+    Returns why the manifest is not current, or None.
+    """
+    if not manifest:
+        return 'no manifest'
+    if time.time() - manifest.get('time', 0) > max_age:
+        return 'manifest older than %d seconds' % max_age
+    if metadata_timestamp() != manifest.get('metadata'):
+        return 'repository metadata changed'
+    recorded = manifest.get('packages', {})
+    missing = [package for package in packages if package not in recorded]
+    if missing:
+        return 'new packages requested: ' + ' '.join(missing)
+    versions = installed_versions(packages)
+    changed = [package for package in packages if versions[package] != recorded[package]]
+    if changed:
+        return 'packages changed since the manifest: ' + ' '.join(changed)
+    return None
+
+
+def transaction(packages):
+    """
+    Updates the system and installs the packages in one transaction.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.dnf') as script:
+        script.write('upgrade\n')
+        script.write('install %s\n' % ' '.join(packages))
+        script.write('run\n')
+        script.flush()
+        return subprocess.call(['dnf', '-y', '--refresh', 'shell', script.name])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker provisioning')
+    parser.add_argument('--manifest', required=True)
+    parser.add_argument('--max-age', type=int, default=24 * 60 * 60)
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('packages', nargs='+')
+    args = parser.parse_args()
+    packages = sorted(set(args.packages))
+
+    lockpath = args.manifest + '.lock'
+    if not os.path.isdir(os.path.dirname(lockpath) or '.'):
+        os.makedirs(os.path.dirname(lockpath))
+    with open(lockpath, 'w') as lock:
+        # Builds sharing the worker wait for each other
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_manifest(args.manifest)
+        reason = 'forced' if args.force else stale_reason(manifest, packages, args.max_age)
+        if reason is None:
+            log('provision: up to date')
+            return 0
+        log('provisioning %d packages: %s' % (len(packages), reason))
+        returncode = transaction(packages)
+        if returncode != 0:
+            return returncode
+        # Keep the packages other builds asked for, the update may have changed them
+        versions = installed_versions(sorted(set(packages) | set(manifest.get('packages', {}))))
+        missing = [package for package in packages if versions[package] is None]
+        if missing:
+            log('packages not installed: ' + ' '.join(missing))
+            return 1
+        save_manifest(args.manifest, {
+            'packages': versions,
+            'metadata': metadata_timestamp(),
+            'time': time.time(),
+        })
+        log('provision: installed')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+#
+# Local stand-in for a Slack incoming webhook: prints the messages
+# posted to it, and can answer slowly or with errors so that the
+# batching, rate limiting, retries and dead-letter log of the build
+# notifications can be tried without a real endpoint.  Point the "url"
+# of "slack-reporter" in config.json to it.
+#
+# Usage:
+#   webhookecho.py [--port 8099] [--delay SECONDS] [--fail-every N] [--status 503]
+#
+
+import argparse
+import json
+import sys
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def log(message):
+    print(message)
+    sys.stdout.flush()
+
+
+class Handler(BaseHTTPRequestHandler):
+    received = 0
+
+    def do_POST(self):
+        Handler.received += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.args.delay:
+            time.sleep(self.server.args.delay)
+        fail_every = self.server.args.fail_every
+        status = self.server.args.status if fail_every and Handler.received % fail_every == 0 else 200
+        try:
+            message = json.loads(body.decode('utf-8'))
+            attachments = message.get('attachments', [])
+            log('#%d %d: %s (%d builds)' % (Handler.received, status, message.get('text', '').strip(),
+                                           len(attachments)))
+            for attachment in attachments:
+                log('    ' + attachment.get('fallback', '').replace('\n', ' | '))
+        except ValueError:
+            status = 400
+            log('#%d %d: invalid payload %r' % (Handler.received, status, body[:200]))
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(b'ok' if status == 200 else b'error')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for a Slack webhook')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--delay', type=float, default=0, help='seconds before answering')
+    parser.add_argument('--fail-every', type=int, default=0, help='fail one request out of N')
+    parser.add_argument('--status', type=int, default=503, help='status of the failed requests')
+    args = parser.parse_args()
+
+    server = HTTPServer(('127.0.0.1', args.port), Handler)
+    server.args = args
+    log('listening on http://127.0.0.1:%d/' % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
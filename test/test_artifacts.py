@@ -0,0 +1,138 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Tests of the artifact store.
+"""
+
+import os
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import client
+
+from liribotcfg import artifacts
+
+KIB = 1024
+
+
+def write(path, size):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+class ArtifactStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        self.store = artifacts.ArtifactStore(os.path.join(self.basedir, 'store'), keep=10)
+
+    def generation(self, files):
+        """
+        Commits a generation with the files of the current one and
+        new files, a dictionary of sizes by name.
+        """
+        path = self.store.begin('flatpak', 'stable')
+        for name, size in files.items():
+            if os.path.lexists(os.path.join(path, name)):
+                os.unlink(os.path.join(path, name))
+            write(os.path.join(path, name), size)
+        self.store.commit('flatpak', 'stable', path)
+        return path
+
+    def generations(self):
+        return self.store._generations('flatpak', 'stable')
+
+    def test_size(self):
+        self.generation({'a': 10 * KIB})
+        self.generation({'b': 10 * KIB})
+        # The file a of both generations is counted once
+        self.assertEqual(self.store.size(), 20 * KIB)
+
+    def test_evict_oldest(self):
+        self.generation({'a': 10 * KIB})
+        self.generation({'a': 10 * KIB})
+        self.generation({'a': 10 * KIB})
+        self.store.max_size = 25 * KIB
+        self.store.evict('flatpak', 'stable')
+        self.assertEqual(self.generations(), ['00000002', '00000003'])
+        self.assertEqual(self.store.size(), 20 * KIB)
+
+    def test_evict_shared(self):
+        self.generation({'a': 10 * KIB})
+        self.generation({'b': 10 * KIB})
+        self.generation({'c': 10 * KIB})
+        # The files of the older generations are still in the current one
+        self.store.max_size = 20 * KIB
+        messages = []
+        self.store.evict('flatpak', 'stable', progress=messages.append)
+        self.assertEqual(self.generations(), ['00000001', '00000002', '00000003'])
+        self.assertIn('still over its size limit', messages[-1])
+
+    def test_evict_published(self):
+        first = self.generation({'a': 10 * KIB})
+        # Also published outside of the store
+        published = os.path.join(self.basedir, 'repo')
+        os.makedirs(published)
+        os.link(os.path.join(first, 'a'), os.path.join(published, 'a'))
+        self.generation({'a': 10 * KIB})
+        self.generation({'a': 10 * KIB})
+        self.store.max_size = 15 * KIB
+        self.store.evict('flatpak', 'stable')
+        # Evicting the first generation frees nothing, the second one does
+        self.assertEqual(self.generations(), ['00000003'])
+
+    def test_evict_stops(self):
+        self.generation({'a': 10 * KIB})
+        self.generation({'a': 10 * KIB})
+        self.generation({'c': 10 * KIB})
+        self.store.max_size = 5 * KIB
+        self.store.evict('flatpak', 'stable')
+        # The file a of the second generation is still in the current one
+        self.assertEqual(self.generations(), ['00000002', '00000003'])
+
+
+class ArtifactServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = artifacts.ArtifactStore(os.path.abspath(self.mktemp()))
+        port = artifacts.listen(self.store, [('ostree', 'unstable', 'export-repo')], interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.url = 'http://127.0.0.1:%d/ostree/unstable/' % port.getHost().port
+
+    def generation(self, content):
+        path = self.store.begin('ostree', 'unstable')
+        config = os.path.join(path, 'export-repo', 'config')
+        # Replaced, the clone shares it with the current generation
+        if os.path.exists(config):
+            os.unlink(config)
+        else:
+            os.makedirs(os.path.dirname(config))
+        with open(config, 'w') as f:
+            f.write(content)
+        self.store.commit('ostree', 'unstable', path)
+
+    @defer.inlineCallbacks
+    def get(self, path):
+        response = yield client.Agent(reactor).request(b'GET', (self.url + path).encode('ascii'))
+        body = yield client.readBody(response)
+        defer.returnValue((response.code, body))
+
+    @defer.inlineCallbacks
+    def test_current(self):
+        self.generation('[core]\nrepo_version=1\n')
+        code, body = yield self.get('config')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, b'[core]\nrepo_version=1\n')
+        # The link follows the commits
+        self.generation('[core]\nrepo_version=1\nmode=archive-z2\n')
+        code, body = yield self.get('config')
+        self.assertEqual(body, b'[core]\nrepo_version=1\nmode=archive-z2\n')
+
+    @defer.inlineCallbacks
+    def test_missing(self):
+        code, body = yield self.get('config')
+        self.assertEqual(code, 404)
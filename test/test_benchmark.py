@@ -0,0 +1,31 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Regression suite of the offline benchmark: the workers, schedulers,
+builders and steps produced by master.cfg must match the counts
+stored in scripts/benchmark-counts.json.
+"""
+
+import os
+import subprocess
+import sys
+
+from twisted.trial import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK = os.path.join(ROOT, 'scripts', 'benchmark.py')
+COUNTS = os.path.join(ROOT, 'scripts', 'benchmark-counts.json')
+
+
+class BenchmarkCountsTest(unittest.TestCase):
+
+    def benchmark(self, sizes):
+        process = subprocess.Popen([sys.executable, '-W', 'ignore', BENCHMARK, '--sizes', sizes, '--repeat', '1',
+                                    '--counts', COUNTS], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+
+    def test_counts(self):
+        self.benchmark('1,10,50')
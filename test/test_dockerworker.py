@@ -0,0 +1,171 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Tests of the warm Docker latent workers, against a stub Docker API.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from liribotcfg import dockerworker
+
+
+class DockerClient(object):
+    """
+    Stub of the Docker API client: the local image has the digest
+    "local", the registry has the one of the class.
+    """
+
+    remote = 'sha256:local'
+    pulls = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def inspect_image(self, image):
+        return {'RepoDigests': ['%s@sha256:local' % image]}
+
+    def inspect_distribution(self, image):
+        return {'Descriptor': {'digest': self.remote}}
+
+    def pull(self, image):
+        self.pulls.append(image)
+
+
+class Docker(object):
+    APIClient = DockerClient
+
+
+class BotMaster(object):
+
+    def maybeStartBuildsForWorker(self, name):
+        pass
+
+
+class Registration(object):
+
+    def update(self, worker, config):
+        return defer.succeed(None)
+
+
+class WorkerManager(object):
+
+    def register(self, worker):
+        return defer.succeed(Registration())
+
+
+class Master(object):
+    name = 'master'
+    config = None
+
+    def __init__(self):
+        self.botmaster = BotMaster()
+        self.workers = WorkerManager()
+        self.reactor = task.Clock()
+
+
+class Parent(object):
+
+    def __init__(self, master):
+        self.master = master
+
+
+class Builder(object):
+    """
+    Stands for the worker of a builder, busy while building.
+    """
+
+    def __init__(self, busy=False):
+        self.busy = busy
+
+    def isBusy(self):
+        return self.busy
+
+
+class WarmDockerLatentWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(dockerworker, 'docker', Docker)
+        self.patch(dockerworker, '_remote_digests', {})
+        self.patch(DockerClient, 'remote', 'sha256:local')
+        self.patch(DockerClient, 'pulls', [])
+        self.pool = dockerworker.WarmPool('fedora', size=1)
+        self.master = Master()
+        self.addCleanup(self.cancel_retry)
+
+    def cancel_retry(self):
+        if self.pool.timer is not None and self.pool.timer.active():
+            self.pool.timer.cancel()
+
+    @defer.inlineCallbacks
+    def make_worker(self, name, started=False):
+        w = dockerworker.WarmDockerLatentWorker(name, 'password', 'unix://fake', image='liri/fedora',
+                                                autopull=True, pool=self.pool)
+        w.parent = Parent(self.master)
+        yield w.reconfigService(name, 'password', 'unix://fake', image='liri/fedora',
+                                autopull=True, build_wait_timeout=300, pool=self.pool)
+        w.running = True
+        w.workerforbuilders = {'builder': Builder()}
+        w.prestarts = []
+        w.substantiate = lambda wfb, build: w.prestarts.append(build) or defer.succeed(True)
+        if started:
+            w.started = True
+            w.conn = object()
+        defer.returnValue(w)
+
+    @defer.inlineCallbacks
+    def test_digest_unchanged(self):
+        w = yield self.make_worker('fedora1')
+        w._refresh_image('liri/fedora')
+        w._refresh_image('liri/fedora')
+        self.assertEqual(DockerClient.pulls, [])
+        self.assertEqual(w.stats['pull_skips'], 2)
+        self.assertEqual(w.stats['pulls'], 0)
+
+    @defer.inlineCallbacks
+    def test_digest_changed(self):
+        w = yield self.make_worker('fedora1')
+        DockerClient.remote = 'sha256:remote'
+        w._refresh_image('liri/fedora')
+        self.assertEqual(DockerClient.pulls, ['liri/fedora'])
+        self.assertEqual(w.stats['pulls'], 1)
+
+    @defer.inlineCallbacks
+    def test_digest_ttl(self):
+        w = yield self.make_worker('fedora1')
+        w._refresh_image('liri/fedora')
+        # Within the TTL the cached digest is used
+        DockerClient.remote = 'sha256:remote'
+        w._refresh_image('liri/fedora')
+        self.assertEqual(DockerClient.pulls, [])
+        w.digest_ttl = 0
+        w._refresh_image('liri/fedora')
+        self.assertEqual(DockerClient.pulls, ['liri/fedora'])
+
+    @defer.inlineCallbacks
+    def test_refill(self):
+        warm = yield self.make_worker('fedora1', started=True)
+        cold = yield self.make_worker('fedora2')
+        self.pool.maintain()
+        self.assertEqual(cold.prestarts, [])
+        # A build takes the idle container
+        warm.workerforbuilders['builder'].busy = True
+        self.pool.maintain()
+        self.assertEqual(cold.prestarts, [None])
+        self.assertEqual(warm.prestarts, [])
+
+    @defer.inlineCallbacks
+    def test_build_finished(self):
+        first = yield self.make_worker('fedora1', started=True)
+        second = yield self.make_worker('fedora2', started=True)
+        first.workerforbuilders['builder'].busy = True
+        second.buildFinished(second.workerforbuilders['builder'])
+        # The only idle container is exempt from build_wait_timeout
+        self.assertEqual(second.build_wait_timeout, -1)
+        self.assertEqual(self.master.reactor.getDelayedCalls(), [])
+        first.workerforbuilders['builder'].busy = False
+        first.buildFinished(first.workerforbuilders['builder'])
+        self.assertEqual(first.build_wait_timeout, 300)
+        [timer] = self.master.reactor.getDelayedCalls()
+        self.assertEqual(timer.getTime(), 300)
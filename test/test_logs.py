@@ -0,0 +1,164 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Tests of the log budget of the steps with large logs.
+"""
+
+import gzip
+import os
+
+from buildbot.process import logobserver
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from liribotcfg.factories._logs import LogBudgetMixin
+
+
+class Log(object):
+    """
+    Stub of a stream log, records what is stored by stream.
+    """
+
+    type = u's'
+
+    def __init__(self, name):
+        self.name = name
+        self.stored = []
+        self.finished = False
+
+    def getName(self):
+        return self.name
+
+    def addStdout(self, text):
+        self.stored.append(('o', text))
+        return defer.succeed(None)
+
+    def addStderr(self, text):
+        self.stored.append(('e', text))
+        return defer.succeed(None)
+
+    def addHeader(self, text):
+        self.stored.append(('h', text))
+        return defer.succeed(None)
+
+    def finish(self):
+        self.finished = True
+        return defer.succeed(None)
+
+    def text(self):
+        return u''.join(text for stream, text in self.stored)
+
+
+class Step(object):
+    """
+    Stands for the BuildStep the mixin is used with.
+    """
+
+    name = 'build image'
+
+    def __init__(self):
+        self.logs = {}
+        self.observers = []
+        self.urls = {}
+
+    def addLog(self, name, type='s', logEncoding=None):
+        self.logs[name] = Log(name)
+        return defer.succeed(self.logs[name])
+
+    def addLogObserver(self, logname, observer):
+        observer.setStep(self)
+        self.observers.append((logname, observer))
+
+    def addURL(self, name, url):
+        self.urls[name] = url
+        return defer.succeed(None)
+
+    def getProperty(self, name, default=None):
+        return {'buildername': 'image-build', 'buildnumber': 7}.get(name, default)
+
+    def finishUnfinishedLogs(self):
+        for log in self.logs.values():
+            if not log.finished:
+                log.finish()
+        return defer.succeed(True)
+
+
+class BudgetedStep(LogBudgetMixin, Step):
+
+    def __init__(self, log_budget):
+        self.log_budget = log_budget
+        Step.__init__(self)
+
+
+class LineObserver(logobserver.LogLineObserver):
+
+    def __init__(self):
+        logobserver.LogLineObserver.__init__(self)
+        self.lines = []
+        self.finished = False
+
+    def outLineReceived(self, line):
+        self.lines.append(line)
+
+    def finishReceived(self):
+        self.finished = True
+
+
+class LogBudgetTest(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def run_step(self, budget, lines):
+        step = BudgetedStep(budget)
+        observer = LineObserver()
+        step.addLogObserver('stdio', observer)
+        log = yield step.addLog('stdio')
+        for line in lines:
+            yield log.addStdout(line + '\n')
+        yield step.finishUnfinishedLogs()
+        defer.returnValue((step, observer))
+
+    @defer.inlineCallbacks
+    def test_within_budget(self):
+        lines = ['line %d' % i for i in range(10)]
+        step, observer = yield self.run_step({}, lines)
+        self.assertEqual(step.logs['stdio'].text(), u''.join(line + '\n' for line in lines))
+        self.assertEqual(observer.lines, lines)
+        self.assertTrue(observer.finished)
+        self.assertTrue(step.logs['stdio'].finished)
+
+    @defer.inlineCallbacks
+    def test_over_budget(self):
+        lines = ['line %03d' % i for i in range(100)]
+        lines[50] = 'error: no space left'
+        budget = {'head': 18, 'tail': 18, 'context': 1024, 'context-lines': 1}
+        step, observer = yield self.run_step(budget, lines)
+        stored = step.logs['stdio'].stored
+        self.assertEqual(u''.join(text for stream, text in stored if stream == 'o'),
+                         u'line 000\nline 001\nline 049\nerror: no space left\nline 051\nline 098\nline 099\n')
+        markers = [text for stream, text in stored if stream == 'h']
+        self.assertEqual(len(markers), 3)
+        self.assertIn(u'47 lines', markers[0])
+        self.assertIn(u'46 lines', markers[1])
+        self.assertIn(u'kept the head, the tail and the lines around errors', markers[2])
+        # The observers see the lines that are not stored
+        self.assertEqual(observer.lines, lines)
+
+    @defer.inlineCallbacks
+    def test_archive(self):
+        archive_dir = os.path.abspath(self.mktemp())
+        lines = ['line %03d' % i for i in range(100)]
+        budget = {'head': 18, 'tail': 18, 'archive-dir': archive_dir, 'url': 'https://build.liri.io/logs/'}
+        step, observer = yield self.run_step(budget, lines)
+        self.assertEqual(step.urls, {'full stdio log': 'https://build.liri.io/logs/image-build/7-build_image-stdio.log.gz'})
+        with gzip.open(os.path.join(archive_dir, 'image-build', '7-build_image-stdio.log.gz')) as f:
+            self.assertEqual(f.read().decode('utf-8'), u''.join(line + '\n' for line in lines))
+
+    @defer.inlineCallbacks
+    def test_no_budget(self):
+        step = BudgetedStep(None)
+        observer = LineObserver()
+        step.addLogObserver('stdio', observer)
+        log = yield step.addLog('stdio')
+        self.assertIs(log, step.logs['stdio'])
+        self.assertEqual(step.observers, [('stdio', observer)])
@@ -0,0 +1,130 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Tests of the build notifications, against a local webhook.
+"""
+
+import json
+
+from buildbot.process.results import FAILURE, SUCCESS
+from buildbot.steps import http
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from liribotcfg import notifications
+
+
+class Webhook(resource.Resource):
+    """
+    Records the messages posted to it and answers with the given
+    statuses in turn, then with 200.
+    """
+
+    isLeaf = True
+
+    def __init__(self, statuses=None):
+        resource.Resource.__init__(self)
+        self.statuses = list(statuses or [])
+        self.messages = []
+
+    def render_POST(self, request):
+        self.messages.append(json.loads(request.content.read().decode('utf-8')))
+        request.setResponseCode(self.statuses.pop(0) if self.statuses else 200)
+        # No connection left behind for the reactor
+        request.setHeader(b'connection', b'close')
+        return b'ok'
+
+
+def make_build(buildid, results=SUCCESS, **properties):
+    return {
+        'buildid': buildid,
+        'builder': {'name': 'builder%d' % buildid},
+        'results': results,
+        'url': 'http://localhost/builds/%d' % buildid,
+        'properties': dict((name, (value, 'test')) for name, value in properties.items()),
+    }
+
+
+class SlackDigestReporterTest(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def start(self, statuses=None, **kwargs):
+        self.webhook = Webhook(statuses)
+        port = reactor.listenTCP(0, server.Site(self.webhook), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.addCleanup(http.closeSession)
+        self.dead_letter = self.mktemp()
+        options = dict(window=0.05, min_interval=0, retries=1, backoff=0.01, timeout=10,
+                       dead_letter=self.dead_letter)
+        options.update(kwargs)
+        url = 'http://127.0.0.1:%d/hook' % port.getHost().port
+        self.reporter = notifications.SlackDigestReporter(url, **options)
+        yield self.reporter.reconfigService(url, **options)
+
+    def enqueue(self, *builds):
+        for build in builds:
+            self.reporter._enqueue(None, notifications.format_build(build))
+
+    @defer.inlineCallbacks
+    def flushed(self):
+        while self.reporter.timer is not None or self.reporter.sending:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    def dead_letters(self):
+        with open(self.dead_letter) as f:
+            return [json.loads(line) for line in f]
+
+    @defer.inlineCallbacks
+    def test_coalescing(self):
+        yield self.start(max_builds=2)
+        self.enqueue(make_build(1), make_build(2, results=FAILURE), make_build(3))
+        self.assertEqual(self.reporter.stats['queue_depth'], 3)
+        yield self.flushed()
+        self.assertEqual([len(m['attachments']) for m in self.webhook.messages], [2, 1])
+        self.assertEqual(self.webhook.messages[0]['text'], '2 builds finished, 1 failed')
+        self.assertEqual(self.reporter.stats['delivered_messages'], 2)
+        self.assertEqual(self.reporter.stats['delivered_builds'], 3)
+        self.assertEqual(self.reporter.stats['queue_depth'], 0)
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        yield self.start(statuses=[503], retries=2)
+        self.enqueue(make_build(1))
+        yield self.flushed()
+        self.assertEqual(len(self.webhook.messages), 2)
+        self.assertEqual(self.reporter.stats['delivered_messages'], 1)
+        self.assertEqual(self.reporter.stats['failed_messages'], 0)
+
+    @defer.inlineCallbacks
+    def test_dead_letter(self):
+        yield self.start(statuses=[503, 503], retries=1)
+        self.enqueue(make_build(1), make_build(2))
+        yield self.flushed()
+        self.assertEqual(len(self.webhook.messages), 2)
+        self.assertEqual(self.reporter.stats['failed_messages'], 1)
+        self.assertEqual(self.reporter.stats['dead_letter_builds'], 2)
+        [entry] = self.dead_letters()
+        self.assertIn('status 503', entry['reason'])
+        self.assertEqual(len(entry['message']['attachments']), 2)
+
+    @defer.inlineCallbacks
+    def test_queue_full(self):
+        yield self.start(max_queue=1)
+        self.enqueue(make_build(1), make_build(2))
+        yield self.flushed()
+        [entry] = self.dead_letters()
+        self.assertEqual(entry['reason'], 'queue full')
+        self.assertIn('builder1', entry['message']['attachments'][0]['text'])
+        self.assertEqual(len(self.webhook.messages), 1)
+        self.assertIn('builder2', self.webhook.messages[0]['attachments'][0]['text'])
+
+    def test_empty_properties(self):
+        build = make_build(1, project='', repository='', branch='develop')
+        build['properties']['buildername'] = []
+        attachment = notifications.format_build(build)
+        self.assertIn('New build for builder1', attachment['text'])
+        self.assertEqual(attachment['fields'], [{'title': 'Branch', 'value': 'develop', 'short': True}])
+        build['properties'] = None
+        self.assertEqual(notifications.format_build(build)['fields'], [])
@@ -0,0 +1,213 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Tests of the batched git polling, against local bare repositories.
+"""
+
+import hashlib
+import hmac
+import io
+import json
+import os
+import subprocess
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from liribotcfg import polling
+
+# Git always knows the empty tree
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+SECRET = 'webhook-secret'
+
+
+def git(repo, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME='Liri', GIT_AUTHOR_EMAIL='ci@liri.io',
+               GIT_COMMITTER_NAME='Liri', GIT_COMMITTER_EMAIL='ci@liri.io')
+    return subprocess.check_output(('git', '--git-dir', repo) + args, env=env).decode('utf-8').strip()
+
+
+def commit(repo, branch, message):
+    """
+    Moves branch of the bare repository repo to a new commit.
+    """
+    args = ['commit-tree', EMPTY_TREE, '-m', message]
+    try:
+        args += ['-p', git(repo, 'rev-parse', '--verify', '--quiet', 'refs/heads/' + branch)]
+    except subprocess.CalledProcessError:
+        pass
+    sha = git(repo, *args)
+    git(repo, 'update-ref', 'refs/heads/' + branch, sha)
+    return sha
+
+
+class GitPoller(object):
+    """
+    Stands for the GitPoller of a repository, counts the polls it is
+    woken up for.
+    """
+
+    branch = None
+
+    def __init__(self, repourl, branches):
+        self.name = repourl
+        self.repourl = repourl
+        self.branches = branches
+        self.lastRev = {}
+        self.forced = 0
+
+    def force(self):
+        self.forced += 1
+
+
+class ChangeService(object):
+
+    def __init__(self):
+        self.namedServices = {}
+
+
+class Master(object):
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.change_svc = ChangeService()
+
+
+class Parent(object):
+
+    def __init__(self, master):
+        self.master = master
+
+
+class Request(object):
+    """
+    Webhook post of GitHub.
+    """
+
+    def __init__(self, event, payload, secret=SECRET):
+        body = json.dumps(payload).encode('utf-8')
+        signature = 'sha1=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha1).hexdigest()
+        self.headers = {b'X-GitHub-Event': event.encode('utf-8'), b'X-Hub-Signature': signature.encode('utf-8'),
+                        b'Content-Type': b'application/json'}
+        self.content = io.BytesIO(body)
+        self.args = {}
+
+    def getHeader(self, name):
+        return self.headers.get(name)
+
+
+class PollingTestCase(unittest.TestCase):
+    """
+    Two bare repositories with their GitPollers and the batched poller.
+    """
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.makedirs(self.basedir)
+        self.master = Master(self.basedir)
+        self.repos = {}
+        for name in ('packages', 'flatpak'):
+            repo = os.path.join(self.basedir, name + '.git')
+            git(repo, 'init', '--quiet', '--bare')
+            commit(repo, 'master', 'Initial commit')
+            self.repos[name] = repo
+            self.add_poller(repo, ['master'])
+        self.poller = yield self.make_poller()
+
+    def add_poller(self, url, branches):
+        poller = GitPoller(url, branches)
+        self.master.change_svc.namedServices[url] = poller
+        return poller
+
+    @defer.inlineCallbacks
+    def make_poller(self):
+        names = sorted(name for name, service in self.master.change_svc.namedServices.items()
+                       if isinstance(service, GitPoller))
+        poller = polling.BatchedGitPoller(pollerNames=names, workdir='gitpoller/batched')
+        poller.parent = Parent(self.master)
+        yield poller.reconfigService(pollerNames=names, workdir='gitpoller/batched')
+        self.master.change_svc.namedServices[poller.name] = poller
+        defer.returnValue(poller)
+
+    def git_poller(self, name):
+        return self.master.change_svc.namedServices[self.repos[name]]
+
+    def sync(self):
+        """
+        Makes the GitPollers up to date, as after their own poll.
+        """
+        for name, repo in self.repos.items():
+            self.git_poller(name).lastRev = {'master': git(repo, 'rev-parse', 'master')}
+            self.git_poller(name).forced = 0
+
+
+class BatchedGitPollerTest(PollingTestCase):
+
+    @defer.inlineCallbacks
+    def test_first_poll(self):
+        yield self.poller.poll()
+        self.assertEqual(self.git_poller('packages').forced, 1)
+        self.assertEqual(self.git_poller('flatpak').forced, 1)
+
+    @defer.inlineCallbacks
+    def test_branch_moved(self):
+        self.sync()
+        yield self.poller.poll()
+        self.assertEqual(self.git_poller('packages').forced, 0)
+        self.assertEqual(self.git_poller('flatpak').forced, 0)
+        commit(self.repos['flatpak'], 'master', 'Update the runtime')
+        yield self.poller.poll()
+        self.assertEqual(self.git_poller('packages').forced, 0)
+        self.assertEqual(self.git_poller('flatpak').forced, 1)
+
+    @defer.inlineCallbacks
+    def test_other_branch_moved(self):
+        self.sync()
+        commit(self.repos['packages'], 'develop', 'Work in progress')
+        yield self.poller.poll()
+        self.assertEqual(self.git_poller('packages').forced, 0)
+
+    @defer.inlineCallbacks
+    def test_unreachable(self):
+        missing = self.add_poller(os.path.join(self.basedir, 'missing.git'), ['master'])
+        self.poller = yield self.make_poller()
+        self.sync()
+        commit(self.repos['packages'], 'master', 'Add a package')
+        yield self.poller.poll()
+        self.assertEqual(missing.forced, 0)
+        self.assertEqual(self.git_poller('packages').forced, 1)
+        self.assertEqual(self.git_poller('flatpak').forced, 0)
+
+
+class GitHubPushHandlerTest(PollingTestCase):
+
+    def push(self, url):
+        handler = polling.GitHubPushHandler(SECRET, True, master=self.master)
+        return handler.process(Request('push', {
+            'ref': 'refs/heads/master',
+            'repository': {'html_url': url, 'clone_url': url + '.git'},
+        }))
+
+    @defer.inlineCallbacks
+    def test_push(self):
+        result = yield self.push(self.repos['flatpak'][:-len('.git')])
+        self.assertEqual(result, ([], 'git'))
+        self.assertEqual(self.git_poller('flatpak').forced, 1)
+        self.assertEqual(self.git_poller('packages').forced, 0)
+
+    @defer.inlineCallbacks
+    def test_push_not_polled(self):
+        result = yield self.push(os.path.join(self.basedir, 'other'))
+        self.assertEqual(result, ([], 'git'))
+        self.assertEqual(self.git_poller('flatpak').forced, 0)
+        self.assertEqual(self.git_poller('packages').forced, 0)
+
+    @defer.inlineCallbacks
+    def test_push_wrong_signature(self):
+        handler = polling.GitHubPushHandler(SECRET, True, master=self.master)
+        request = Request('push', {'repository': {'html_url': self.repos['flatpak'],
+                                                  'clone_url': self.repos['flatpak']}}, secret='other')
+        yield self.assertFailure(handler.process(request), ValueError)
+        self.assertEqual(self.git_poller('flatpak').forced, 0)
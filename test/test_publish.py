@@ -0,0 +1,61 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Tests of the publishing generations.
+"""
+
+import os
+
+from twisted.trial import unittest
+
+from liribotcfg import publish
+
+
+def write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class PublishRepoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        self.source = os.path.join(self.basedir, 'source')
+        self.live = os.path.join(self.basedir, 'published', 'repo')
+
+    def publish(self, commit):
+        write(os.path.join(self.source, 'refs', 'heads', 'master'), commit)
+        write(os.path.join(self.source, 'objects', commit[:2], commit[2:] + '.commit'), commit)
+        publish.publish_repo(self.source, self.live, keep=1)
+
+    def generations(self):
+        return [os.path.basename(path) for path in publish._generations(self.live)]
+
+    def test_sequence(self):
+        self.publish('aa01')
+        self.publish('aa02')
+        self.assertEqual(self.generations(), ['repo-00000001', 'repo-00000002'])
+        self.assertEqual(os.readlink(self.live), 'repo-00000002')
+        self.assertEqual(publish.read_refs(self.live), {'master': 'aa02'})
+        # The retired generation is staged again as the next one
+        self.publish('aa03')
+        self.assertEqual(self.generations(), ['repo-00000002', 'repo-00000003'])
+        self.assertEqual(os.readlink(self.live), 'repo-00000003')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.live, 'objects'))), ['aa'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.live, 'objects', 'aa'))),
+                         ['01.commit', '02.commit', '03.commit'])
+
+    def test_after_timestamps(self):
+        # Generations named after the clock by older configurations
+        self.publish('aa01')
+        os.rename(os.path.join(os.path.dirname(self.live), 'repo-00000001'),
+                  os.path.join(os.path.dirname(self.live), 'repo-20240101000000000000'))
+        os.unlink(self.live)
+        os.symlink('repo-20240101000000000000', self.live)
+        self.publish('aa02')
+        self.assertEqual(self.generations(), ['repo-20240101000000000000', 'repo-20240101000000000001'])
+        self.assertEqual(os.readlink(self.live), 'repo-20240101000000000001')
@@ -0,0 +1,155 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Tests of the concurrent webhook calls, against a local webhook.
+"""
+
+from buildbot.process.results import FAILURE, SUCCESS
+from buildbot.steps import http
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from liribotcfg import webhooks
+from liribotcfg.factories._docker import DockerHubTriggerStep
+
+
+class Webhook(resource.Resource):
+    """
+    Records the paths posted to and answers with the given statuses
+    in turn, then with 200, after delay seconds.
+    """
+
+    isLeaf = True
+
+    def __init__(self, statuses=None, delay=0):
+        resource.Resource.__init__(self)
+        self.statuses = list(statuses or [])
+        self.delay = delay
+        self.paths = []
+        self.running = 0
+        self.max_running = 0
+
+    def render_POST(self, request):
+        self.paths.append(request.path.decode('utf-8'))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        status = self.statuses.pop(0) if self.statuses else 200
+        reactor.callLater(self.delay, self.answer, request, status)
+        return server.NOT_DONE_YET
+
+    def answer(self, request, status):
+        self.running -= 1
+        request.setResponseCode(status)
+        # No connection left behind for the reactor
+        request.setHeader(b'connection', b'close')
+        request.write(b'ok')
+        request.finish()
+
+
+class WebhookTestCase(unittest.TestCase):
+
+    def start(self, statuses=None, delay=0):
+        self.webhook = Webhook(statuses, delay)
+        port = reactor.listenTCP(0, server.Site(self.webhook), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.addCleanup(http.closeSession)
+        self.base = 'http://127.0.0.1:%d' % port.getHost().port
+
+    def url(self, name):
+        return '%s/%s' % (self.base, name)
+
+
+class PostTest(WebhookTestCase):
+
+    @defer.inlineCallbacks
+    def test_success(self):
+        self.start()
+        result = yield webhooks.post(self.url('hook'), backoff=0.01)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.status, 200)
+        self.assertEqual(result.attempts, 1)
+        self.assertEqual(self.webhook.paths, ['/hook'])
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        self.start(statuses=[503, 502])
+        result = yield webhooks.post(self.url('hook'), retries=3, backoff=0.05)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.attempts, 3)
+        # Waited 0.05 then 0.1 seconds between the attempts
+        self.assertTrue(result.seconds >= 0.15, result.seconds)
+
+    @defer.inlineCallbacks
+    def test_retries_exhausted(self):
+        self.start(statuses=[500, 500, 500])
+        result = yield webhooks.post(self.url('hook'), names=['liri'], retries=2, backoff=0.01)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status, 500)
+        self.assertEqual(result.attempts, 3)
+        self.assertIn('liri: status 500', result.describe())
+
+    @defer.inlineCallbacks
+    def test_client_error(self):
+        self.start(statuses=[404])
+        result = yield webhooks.post(self.url('hook'), retries=3, backoff=0.01)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.attempts, 1)
+
+    @defer.inlineCallbacks
+    def test_connection_error(self):
+        self.start()
+        result = yield webhooks.post('http://127.0.0.1:1/hook', retries=1, backoff=0.01)
+        self.assertFalse(result.ok)
+        self.assertIsNone(result.status)
+        self.assertEqual(result.attempts, 2)
+        self.assertIn('failed', result.describe())
+
+
+class PostAllTest(WebhookTestCase):
+
+    @defer.inlineCallbacks
+    def test_dedupe(self):
+        self.start()
+        results = yield webhooks.post_all([('fedora', self.url('a')), ('arch', self.url('b')),
+                                           ('fedora-ostree', self.url('a'))], backoff=0.01)
+        self.assertEqual(sorted(self.webhook.paths), ['/a', '/b'])
+        self.assertEqual([result.names for result in results], [['fedora', 'fedora-ostree'], ['arch']])
+
+    @defer.inlineCallbacks
+    def test_concurrency(self):
+        self.start(delay=0.1)
+        hooks = [('hook%d' % i, self.url('hook%d' % i)) for i in range(6)]
+        results = yield webhooks.post_all(hooks, concurrency=2, backoff=0.01)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(len(self.webhook.paths), 6)
+        self.assertEqual(self.webhook.max_running, 2)
+
+
+class DockerHubTriggerStepTest(WebhookTestCase):
+
+    @defer.inlineCallbacks
+    def run_step(self, hooks):
+        step = DockerHubTriggerStep(hooks=hooks, concurrency=2, retries=1, backoff=0.01)
+        logs = {}
+        step.addCompleteLog = lambda name, text: defer.succeed(logs.__setitem__(name, text))
+        results = yield step.run()
+        defer.returnValue((results, step.descriptionDone, logs['triggers']))
+
+    @defer.inlineCallbacks
+    def test_triggered(self):
+        self.start()
+        results, description, log = yield self.run_step([('fedora', self.url('a')), ('arch', self.url('a'))])
+        self.assertEqual(results, SUCCESS)
+        self.assertEqual(description, ['triggered 1 rebuilds'])
+        self.assertIn('fedora, arch: status 200', log)
+        self.assertEqual(self.webhook.paths, ['/a'])
+
+    @defer.inlineCallbacks
+    def test_failed(self):
+        self.start(statuses=[503, 503])
+        results, description, log = yield self.run_step([('fedora', self.url('a'))])
+        self.assertEqual(results, FAILURE)
+        self.assertEqual(description, ['1 of 1 triggers failed'])
+        self.assertIn('fedora: status 503', log)
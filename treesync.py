@@ -0,0 +1,612 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Content-addressed incremental synchronization of directory trees.
+
+This module is imported by the master and is also downloaded to the
+workers, where it runs as a standalone script, so it must not depend
+on anything but the standard library.
+
+A manifest maps each path to a digest, a size and a modification time.
+OSTree objects are named after their checksum, so their path is their
+digest and they are never read; every other file is hashed, reusing the
+digest of a previous manifest when size and modification time match.
+
+Deltas can be compressed with zstd and streamed through a named pipe,
+the end of the pipe on the worker side runs in the background so that
+a file transfer step can read or write the other end.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import traceback
+
+__all__ = [
+    'build_manifest',
+    'load_manifest',
+    'save_manifest',
+    'diff_manifests',
+    'merge_manifests',
+    'describe_stats',
+    'write_delta',
+    'apply_delta',
+    'format_size',
+    'compress_stream',
+    'decompress_stream',
+    'CountingFile',
+    'describe_transfer',
+]
+
+DELETIONS_MEMBER = '.treesync-deletions'
+MANIFEST_MEMBER = '.treesync-manifest'
+OBJECT_DIGEST = 'object'
+DIRECTORY_DIGEST = 'directory'
+PROGRESS_INTERVAL = 5000
+ZSTD = 'zstd'
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
+def is_object(relpath):
+    """
+    Returns whether the path is a content-addressed OSTree object,
+    such as "repo/objects/ab/cdef....filez".
+    """
+    parts = relpath.split('/')
+    return len(parts) >= 3 and parts[-3] == 'objects' and len(parts[-2]) == 2
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _walk(root, paths):
+    for path in paths:
+        top = os.path.join(root, path)
+        if os.path.islink(top) or os.path.isfile(top):
+            yield path
+            continue
+        if not os.path.isdir(top):
+            continue
+        for dirpath, dirnames, filenames in os.walk(top):
+            reldir = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            yield reldir
+            for name in dirnames:
+                # os.walk() does not descend into symbolic links
+                if os.path.islink(os.path.join(dirpath, name)):
+                    yield reldir + '/' + name
+            for name in filenames:
+                yield reldir + '/' + name
+
+
+def build_manifest(root, paths, previous=None, progress=None):
+    """
+    Builds the manifest of the given paths, relative to root.
+
+    Digests of regular files are taken from the previous manifest,
+    when size and modification time did not change.
+    """
+    previous = previous or {}
+    manifest = {}
+    for relpath in _walk(root, paths):
+        fullpath = os.path.join(root, relpath)
+        st = os.lstat(fullpath)
+        mtime = st.st_mtime
+        if os.path.islink(fullpath):
+            digest = 'link:' + os.readlink(fullpath)
+            size = 0
+        elif os.path.isdir(fullpath):
+            digest = DIRECTORY_DIGEST
+            size = 0
+        elif is_object(relpath):
+            digest = OBJECT_DIGEST
+            size = st.st_size
+        else:
+            size = st.st_size
+            old = previous.get(relpath)
+            if old and old[1] == size and old[2] == mtime and old[0] not in (OBJECT_DIGEST, DIRECTORY_DIGEST):
+                digest = old[0]
+            else:
+                digest = file_digest(fullpath)
+        manifest[relpath] = [digest, size, mtime]
+        if progress and len(manifest) % PROGRESS_INTERVAL == 0:
+            progress('scanned %d entries' % len(manifest))
+    return manifest
+
+
+def load_manifest(path):
+    """
+    Loads a manifest, an empty one is returned if it doesn't exist
+    or cannot be parsed.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest, path):
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.rename(tmppath, path)
+
+
+def diff_manifests(source, target):
+    """
+    Returns the paths that must be sent and deleted to turn
+    target into source, and the statistics of the transfer.
+    """
+    changed = sorted(path for path, entry in source.items()
+                     if path not in target or target[path][0] != entry[0])
+    deleted = sorted((path for path in target if path not in source), reverse=True)
+    stats = {
+        'total_files': len(source),
+        'total_bytes': sum(entry[1] for entry in source.values()),
+        'changed_files': len(changed),
+        'changed_bytes': sum(source[path][1] for path in changed),
+        'deleted_files': len(deleted),
+    }
+    stats['saved_bytes'] = stats['total_bytes'] - stats['changed_bytes']
+    return changed, deleted, stats
+
+
+def merge_manifests(source, target):
+    """
+    Returns the manifest of target once it mirrors source, keeping
+    the sizes and modification times of target for the entries
+    that were not transferred.
+    """
+    merged = {}
+    for path, entry in source.items():
+        old = target.get(path)
+        merged[path] = old if old and old[0] == entry[0] else entry
+    return merged
+
+
+def describe_stats(stats):
+    return ('%(changed_files)d of %(total_files)d entries changed, %(deleted_files)d deleted, '
+            'sending %(changed)s of %(total)s (%(saved)s saved)') % dict(
+        stats,
+        changed=format_size(stats['changed_bytes']),
+        total=format_size(stats['total_bytes']),
+        saved=format_size(stats['saved_bytes']),
+    )
+
+
+def _add_json(tar, name, value):
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_delta(fileobj, root, changed, deleted, manifest=None, progress=None):
+    """
+    Writes a tar stream with the changed paths and the list of deleted
+    paths into fileobj.
+
+    The manifest the receiver ends up with can be embedded, so that
+    it does not have to scan its trees again.
+    """
+    tar = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT)
+    try:
+        _add_json(tar, DELETIONS_MEMBER, deleted)
+        if manifest is not None:
+            _add_json(tar, MANIFEST_MEMBER, manifest)
+        for count, relpath in enumerate(changed, 1):
+            tar.add(os.path.join(root, relpath), arcname=relpath, recursive=False)
+            if progress and count % PROGRESS_INTERVAL == 0:
+                progress('packed %d of %d entries' % (count, len(changed)))
+    finally:
+        tar.close()
+
+
+def _safe_path(root, relpath):
+    if relpath.startswith('/') or '..' in relpath.split('/'):
+        raise ValueError('refusing to write outside of %s: %s' % (root, relpath))
+    return os.path.join(root, relpath)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def apply_delta(fileobj, root, progress=None):
+    """
+    Applies a tar stream written by write_delta() to root.
+
+    Existing files are unlinked before being replaced, so that
+    hard links to them elsewhere keep their content.
+    Returns the number of extracted and deleted entries, and the
+    embedded manifest if any.
+    """
+    extracted = 0
+    deleted = []
+    manifest = None
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    try:
+        for member in tar:
+            if member.name == DELETIONS_MEMBER:
+                deleted = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                continue
+            if member.name == MANIFEST_MEMBER:
+                manifest = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                continue
+            path = _safe_path(root, member.name)
+            if not member.isdir():
+                _remove(path)
+            elif os.path.lexists(path) and not os.path.isdir(path):
+                os.unlink(path)
+            tar.extract(member, root)
+            extracted += 1
+            if progress and extracted % PROGRESS_INTERVAL == 0:
+                progress('extracted %d entries' % extracted)
+    finally:
+        tar.close()
+    for relpath in deleted:
+        _remove(_safe_path(root, relpath))
+    return extracted, len(deleted), manifest
+
+
+def compress_stream(fileobj, level):
+    """
+    Starts a zstd process compressing what is written
+    to its stdin into fileobj.
+    """
+    return subprocess.Popen([ZSTD, '-q', '-c', '-T0', '-%d' % level],
+                            stdin=subprocess.PIPE, stdout=fileobj)
+
+
+def decompress_stream(fileobj):
+    """
+    Starts a zstd process decompressing fileobj to its stdout.
+    """
+    return subprocess.Popen([ZSTD, '-q', '-d', '-c'], stdin=fileobj, stdout=subprocess.PIPE)
+
+
+def _check_zstd(process):
+    if process.wait() != 0:
+        raise IOError('zstd exited with status %d' % process.returncode)
+
+
+class CountingFile(object):
+    """
+    File object wrapper counting the bytes read or written.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        return data
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.count += len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def describe_transfer(raw, compressed, seconds):
+    """
+    Describes the throughput of a transfer, compressed is None
+    when the delta was not compressed.
+    """
+    rate = raw / (1024.0 * 1024.0) / seconds if seconds > 0 else 0.0
+    message = 'transferred %s in %.1f s, %.1f MB/s' % (format_size(raw), seconds, rate)
+    if compressed is not None:
+        ratio = float(raw) / compressed if compressed else 0.0
+        message += ', %s compressed, ratio %.2f' % (format_size(compressed), ratio)
+    return message
+
+
+def _stdio(name, mode):
+    if name == '-':
+        stream = sys.stdout if 'w' in mode else sys.stdin
+        return getattr(stream, 'buffer', stream)
+    return open(name, mode)
+
+
+def _progress(message):
+    print(message, file=sys.stderr)
+    sys.stderr.flush()
+
+
+def _cmd_manifest(args):
+    previous = load_manifest(args.previous) if args.previous else {}
+    manifest = build_manifest(args.root, args.paths, previous, progress=_progress)
+    save_manifest(manifest, args.output)
+    _progress('manifest: %d entries' % len(manifest))
+
+
+def _write_output(args, write):
+    """
+    Calls write with the output file, through zstd when compressing.
+    """
+    started = time.time()
+    with _stdio(args.output, 'wb') as f:
+        if args.compress:
+            process = compress_stream(f, args.compress)
+            out = CountingFile(process.stdin)
+            try:
+                write(out)
+            finally:
+                process.stdin.close()
+            _check_zstd(process)
+        else:
+            out = CountingFile(f)
+            write(out)
+    if args.output != '-':
+        _progress(describe_transfer(out.count, None, time.time() - started))
+
+
+def _read_input(args, read):
+    """
+    Calls read with the input file, through zstd when decompressing.
+    """
+    started = time.time()
+    with _stdio(args.input, 'rb') as f:
+        if args.decompress:
+            process = decompress_stream(f)
+            source = CountingFile(process.stdout)
+            try:
+                result = read(source)
+                # Drain what follows the end of the tar stream
+                while source.read(1024 * 1024):
+                    pass
+            finally:
+                process.stdout.close()
+            _check_zstd(process)
+        else:
+            source = CountingFile(f)
+            result = read(source)
+    if args.input != '-':
+        _progress(describe_transfer(source.count, None, time.time() - started))
+    return result
+
+
+def _pack_into(args, write):
+    """
+    Applies the delta written by write to the target directory
+    as it is written, without storing it.
+    """
+    rfd, wfd = os.pipe()
+    result = {}
+
+    def apply():
+        with os.fdopen(rfd, 'rb') as f:
+            try:
+                result['applied'] = apply_delta(f, args.target, progress=_progress)
+            finally:
+                # Unblocks the writer if applying failed
+                while f.read(1024 * 1024):
+                    pass
+
+    started = time.time()
+    thread = threading.Thread(target=apply)
+    thread.start()
+    with os.fdopen(wfd, 'wb') as f:
+        out = CountingFile(f)
+        write(out)
+    thread.join()
+    if 'applied' not in result:
+        raise IOError('cannot apply the delta to %s' % args.target)
+    extracted, deleted, manifest = result['applied']
+    _progress('applied to %s: %d entries extracted, %d deleted' % (args.target, extracted, deleted))
+    _progress(describe_transfer(out.count, None, time.time() - started))
+    if args.target_manifest and manifest is not None:
+        save_manifest(manifest, args.target_manifest)
+
+
+def _background(status, func, args):
+    """
+    Runs func(args) in a detached process, which records its output
+    in status.log and its exit status in status.
+    """
+    for path in (status, status + '.log'):
+        if os.path.exists(path):
+            os.unlink(path)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        with open(status + '.pid', 'w') as f:
+            f.write('%d\n' % pid)
+        _progress('running in the background as process %d' % pid)
+        return
+    code = 1
+    try:
+        os.setsid()
+        log = os.open(status + '.log', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        func(args)
+        code = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with open(status + '.tmp', 'w') as f:
+            f.write('%d\n' % code)
+        os.rename(status + '.tmp', status)
+        os._exit(code)
+
+
+def _make_fifo(path):
+    if os.path.lexists(path):
+        os.unlink(path)
+    os.mkfifo(path)
+
+
+def _pack(args):
+    base = load_manifest(args.base)
+    if not base:
+        _progress('no usable baseline, sending everything')
+    if args.source_manifest:
+        # Trusted manifest of a tree that does not change, such as
+        # a store generation, the receiver gets its merged manifest
+        manifest = load_manifest(args.source_manifest)
+        embedded = merge_manifests(manifest, base)
+    else:
+        manifest = build_manifest(args.root, args.paths, base, progress=_progress)
+        embedded = None
+    changed, deleted, stats = diff_manifests(manifest, base)
+    _progress(describe_stats(stats))
+    if args.target:
+        _pack_into(args, lambda f: write_delta(f, args.root, changed, deleted, manifest=embedded, progress=_progress))
+    else:
+        _write_output(args, lambda f: write_delta(f, args.root, changed, deleted, manifest=embedded, progress=_progress))
+    if args.manifest_output:
+        save_manifest(manifest, args.manifest_output)
+
+
+def _cmd_pack(args):
+    if not args.output and not args.target:
+        raise SystemExit('pack needs --output or --target')
+    if args.background:
+        _make_fifo(args.output)
+        _background(args.background, _pack, args)
+    else:
+        _pack(args)
+
+
+def _apply(args):
+    extracted, deleted, manifest = _read_input(args, lambda f: apply_delta(f, args.root, progress=_progress))
+    _progress('applied: %d entries extracted, %d deleted' % (extracted, deleted))
+    if args.manifest_output and manifest is not None:
+        save_manifest(manifest, args.manifest_output)
+
+
+def _cmd_apply(args):
+    if args.background:
+        _make_fifo(args.input)
+        _background(args.background, _apply, args)
+    else:
+        _apply(args)
+
+
+def _unblock(fifo):
+    """
+    Opens and closes the other end of fifo, so that a background
+    process waiting for a transfer that never started gives up.
+    """
+    for flags in (os.O_RDONLY | os.O_NONBLOCK, os.O_WRONLY | os.O_NONBLOCK):
+        try:
+            os.close(os.open(fifo, flags))
+        except OSError:
+            pass
+
+
+def _cmd_wait(args):
+    status = args.status
+    if not os.path.exists(status + '.pid'):
+        _progress('no background process to wait for')
+        return 1
+    if args.fifo and os.path.exists(args.fifo):
+        _unblock(args.fifo)
+    deadline = time.time() + args.timeout
+    while not os.path.exists(status) and time.time() < deadline:
+        time.sleep(0.2)
+    if os.path.exists(status):
+        with open(status, 'r') as f:
+            code = int(f.read().strip() or 1)
+    else:
+        _progress('the background process did not finish in %d seconds' % args.timeout)
+        code = 1
+        try:
+            with open(status + '.pid', 'r') as f:
+                os.killpg(int(f.read().strip()), signal.SIGTERM)
+        except (IOError, OSError, ValueError):
+            pass
+    if os.path.exists(status + '.log'):
+        with open(status + '.log', 'r') as f:
+            sys.stderr.write(f.read())
+    for path in (status, status + '.log', status + '.pid', args.fifo):
+        if path and os.path.lexists(path):
+            os.unlink(path)
+    return code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Incremental tree synchronization')
+    parser.add_argument('--root', default='.', help='directory the paths are relative to')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('manifest', help='write the manifest of the paths')
+    p.add_argument('--previous', help='manifest whose digests can be reused')
+    p.add_argument('--output', required=True)
+    p.add_argument('paths', nargs='+')
+    p.set_defaults(func=_cmd_manifest)
+
+    p = subparsers.add_parser('pack', help='write the changes since a base manifest')
+    p.add_argument('--base', required=True, help='manifest of the last synchronized state')
+    p.add_argument('--output', help='delta file, or - for stdout')
+    p.add_argument('--manifest-output', help='where to save the manifest of the paths')
+    p.add_argument('--source-manifest', help='manifest of the paths, instead of scanning them')
+    p.add_argument('--target', help='apply the delta to this directory instead of writing it')
+    p.add_argument('--target-manifest', help='where to save the manifest embedded in the delta applied to the target')
+    p.add_argument('--compress', type=int, default=0, metavar='LEVEL', help='zstd compression level')
+    p.add_argument('--background', metavar='STATUS',
+                   help='make the output a named pipe and write it in the background')
+    p.add_argument('paths', nargs='+')
+    p.set_defaults(func=_cmd_pack)
+
+    p = subparsers.add_parser('apply', help='apply a delta')
+    p.add_argument('--input', required=True, help='delta file, or - for stdin')
+    p.add_argument('--manifest-output', help='where to save the manifest embedded in the delta')
+    p.add_argument('--decompress', action='store_true', help='the delta is compressed with zstd')
+    p.add_argument('--background', metavar='STATUS',
+                   help='make the input a named pipe and read it in the background')
+    p.set_defaults(func=_cmd_apply)
+
+    p = subparsers.add_parser('wait', help='wait for a background pack or apply')
+    p.add_argument('--status', required=True)
+    p.add_argument('--fifo', help='named pipe of the background process')
+    p.add_argument('--timeout', type=int, default=600)
+    p.set_defaults(func=_cmd_wait)
+
+    args = parser.parse_args(argv)
+    if not getattr(args, 'func', None):
+        parser.error('a command is required')
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
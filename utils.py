@@ -1,6 +1,7 @@
 # -*- python -*-
 # ex: set filetype=python:
 
+import os
 import sys
 
 PY2 = sys.version_info[0] == 2
@@ -22,4 +23,11 @@ def json_to_ascii(value):
             l.append(json_to_ascii(list_value))
         return l
     else:
-        return asciiize(value)
\ No newline at end of file
+        return asciiize(value)
+
+
+def config_path(*parts):
+    """
+    Returns the absolute path of a file shipped with this configuration.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), *parts)
@@ -0,0 +1,93 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Concurrent webhook calls over the shared HTTP session of the
+buildbot HTTP steps, with bounded parallelism and retries.
+"""
+
+import time
+
+from buildbot.steps import http
+from buildbot.util import asyncSleep
+from twisted.internet import defer
+
+__all__ = [
+    'post',
+    'post_all',
+]
+
+
+class Result(object):
+    """
+    Outcome of a webhook call.
+    """
+
+    def __init__(self, url, names):
+        self.url = url
+        self.names = names
+        self.status = None
+        self.error = None
+        self.attempts = 0
+        self.seconds = 0.0
+
+    @property
+    def ok(self):
+        return self.status is not None and self.status < 400
+
+    def describe(self):
+        if self.status is not None:
+            outcome = 'status %d' % self.status
+        else:
+            outcome = 'failed: %s' % self.error
+        return '%s: %s in %.2f s (%d attempts)' % (', '.join(self.names), outcome, self.seconds, self.attempts)
+
+
+def _should_retry(status):
+    return status == 429 or status >= 500
+
+
+@defer.inlineCallbacks
+def post(url, names=None, retries=3, backoff=1.0, **kwargs):
+    """
+    Posts to url, retrying on connection errors and server errors
+    after backoff seconds, doubled on each attempt.  kwargs are
+    passed to the requests session.  Returns a Result.
+    """
+    result = Result(url, names or [url])
+    session = http.getSession()
+    started = time.time()
+    delay = backoff
+    while True:
+        result.attempts += 1
+        try:
+            response = yield session.post(url, **kwargs)
+            result.status = response.status_code
+            result.error = None
+            if not _should_retry(response.status_code):
+                break
+        except Exception as e:
+            result.status = None
+            result.error = e
+        if result.attempts > retries:
+            break
+        yield asyncSleep(delay)
+        delay *= 2
+    result.seconds = time.time() - started
+    defer.returnValue(result)
+
+
+def post_all(hooks, concurrency=4, **kwargs):
+    """
+    Posts to the URLs of hooks, a list of (name, url) pairs, at most
+    concurrency at a time.  Each URL is called once, whatever the
+    number of names it has.  Returns the Results in the order of hooks.
+    """
+    urls = []
+    names = {}
+    for name, url in hooks:
+        if url not in names:
+            urls.append(url)
+        names.setdefault(url, []).append(name)
+    semaphore = defer.DeferredSemaphore(concurrency)
+    return defer.gatherResults([semaphore.run(post, url, names=names[url], **kwargs) for url in urls])
@@ -0,0 +1,201 @@
+# -*- python -*-
+# ex: set filetype=python:
+
+"""
+Pool of builds running on the master host.
+
+The pool is a single LocalWorker that admits builds: the total number
+of builds is capped, each class of builder has its own cap, and builds
+only start while the host has CPU, memory and disk bandwidth to spare.
+
+Builders use the admission policy of their class as canStartBuild.
+"""
+
+import multiprocessing
+import os
+import time
+
+from buildbot.plugins import worker
+from buildbot.process.workerforbuilder import States
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+__all__ = [
+    'LocalWorkerPool',
+]
+
+
+def _memory_available():
+    """
+    Returns the memory available on the host in MiB.
+    """
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    return None
+
+
+def _io_ticks():
+    """
+    Returns the time spent doing I/O by each disk in milliseconds.
+    """
+    ticks = {}
+    with open('/proc/diskstats', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 12 and not fields[2].startswith(('loop', 'ram')):
+                ticks[fields[2]] = int(fields[12])
+    return ticks
+
+
+class _IOSampler(object):
+    """
+    Utilization of the busiest disk since the previous sample.
+    """
+
+    def __init__(self):
+        self.time = None
+        self.ticks = {}
+
+    def utilization(self):
+        now = time.time()
+        try:
+            ticks = _io_ticks()
+        except (IOError, OSError):
+            return None
+        previous, before = self.time, self.ticks
+        self.time, self.ticks = now, ticks
+        if previous is None or now <= previous:
+            return None
+        busiest = max([ticks[disk] - before.get(disk, ticks[disk]) for disk in ticks] or [0])
+        return min(busiest / ((now - previous) * 1000), 1.0)
+
+
+class LocalWorkerPool(object):
+    """
+    Local worker that admits builds by class.
+
+    max_builds caps the builds running on the pool.  Each class in
+    classes maps to a dictionary with the max_builds of that class
+    and optionally max_load (load average per CPU), min_memory (MiB
+    available) and max_io (utilization of the busiest disk, 0 to 1).
+    A refused build request is tried again after retry seconds.
+    """
+
+    def __init__(self, workername='MasterWorker', max_builds=4, classes=None, retry=30):
+        self.workername = workername
+        self.max_builds = max_builds
+        self.classes = classes or {}
+        self.retry = retry
+        self.builder_classes = {}
+        self.io = _IOSampler()
+        self.retries = {}
+        # Request ids refused by the policy and when they were first refused
+        self.waiting = {}
+        self.stats = {'admitted': 0, 'refused': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def worker(self):
+        return worker.LocalWorker(self.workername, max_builds=self.max_builds)
+
+    def admission(self, buildclass):
+        """
+        Returns the canStartBuild function for builders of a class.
+        """
+        if buildclass not in self.classes:
+            raise ValueError('Unknown build class %s' % buildclass)
+
+        def canStartBuild(builder, wfb, breq):
+            self.builder_classes[builder.name] = buildclass
+            return self.canStartBuild(buildclass, builder, wfb, breq)
+        return canStartBuild
+
+    def running(self, master):
+        """
+        Returns the number of builds running on the pool, in total and by class.
+        """
+        total = 0
+        by_class = dict((name, 0) for name in self.classes)
+        w = master.workers.workers.get(self.workername)
+        if w is None:
+            return total, by_class
+        for buildername, wfb in w.workerforbuilders.items():
+            if wfb.state == States.BUILDING:
+                total += 1
+                buildclass = self.builder_classes.get(buildername)
+                if buildclass is not None:
+                    by_class[buildclass] += 1
+        return total, by_class
+
+    def queue(self):
+        """
+        Returns the number of requests waiting for admission and
+        the time the oldest one has been waiting.
+        """
+        if not self.waiting:
+            return 0, 0.0
+        return len(self.waiting), time.time() - min(self.waiting.values())
+
+    @defer.inlineCallbacks
+    def queue_depth(self, master):
+        """
+        Returns the number of unclaimed build requests of the pool builders.
+        """
+        depth = 0
+        for buildername in self.builder_classes:
+            builderid = yield master.data.updates.findBuilderId(buildername)
+            requests = yield master.db.buildrequests.getBuildRequests(builderid=builderid, claimed=False)
+            depth += len(requests)
+        defer.returnValue(depth)
+
+    def host_limit(self, limits):
+        """
+        Returns why the host cannot take one more build, or None.
+        """
+        if limits.get('max_load') is not None:
+            load = os.getloadavg()[0] / multiprocessing.cpu_count()
+            if load > limits['max_load']:
+                return 'load %.2f per CPU' % load
+        if limits.get('min_memory') is not None:
+            memory = _memory_available()
+            if memory is not None and memory < limits['min_memory']:
+                return '%d MiB available' % memory
+        if limits.get('max_io') is not None:
+            io = self.io.utilization()
+            if io is not None and io > limits['max_io']:
+                return 'disk %.0f%% busy' % (io * 100)
+        return None
+
+    def _refuse(self, builder, breq, reason):
+        # Requests are polled again until admitted, count them once
+        if breq.id not in self.waiting:
+            self.stats['refused'] += 1
+            self.waiting[breq.id] = time.time()
+        log.msg('localworkerpool: holding request %d of %s, %s' % (breq.id, builder.name, reason))
+        # Nothing else wakes the builder up when the host load goes down
+        call = self.retries.get(builder.name)
+        if call is None or not call.active():
+            self.retries[builder.name] = reactor.callLater(
+                self.retry, builder.master.botmaster.maybeStartBuildsForBuilder, builder.name)
+        return False
+
+    def canStartBuild(self, buildclass, builder, wfb, breq):
+        limits = self.classes[buildclass]
+        total, by_class = self.running(builder.master)
+        if total >= self.max_builds:
+            return self._refuse(builder, breq, '%d builds running' % total)
+        if by_class[buildclass] >= limits.get('max_builds', self.max_builds):
+            return self._refuse(builder, breq, '%d %s builds running' % (by_class[buildclass], buildclass))
+        # An idle host always takes a build, whatever else runs on it
+        if total > 0:
+            reason = self.host_limit(limits)
+            if reason is not None:
+                return self._refuse(builder, breq, reason)
+        self.waiting.pop(breq.id, None)
+        waited = max(time.time() - breq.submittedAt, 0)
+        self.stats['admitted'] += 1
+        self.stats['wait_seconds'] += waited
+        self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], waited)
+        log.msg('localworkerpool: starting request %d of %s after %d seconds (%d queued)' %
+                (breq.id, builder.name, waited, len(self.waiting)))
+        return True